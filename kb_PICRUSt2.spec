@@ -13,4 +13,10 @@ module kb_PICRUSt2 {
     */
     funcdef run_picrust2_pipeline(mapping<string,UnspecifiedObject> params) returns (ReportResults output) authentication required;
 
+    /*
+        Run PICRUSt2 on each AmpliconMatrix in `amplicon_matrix_upa_l`, with otherwise the same params,
+        in one job with one KBaseReport
+    */
+    funcdef run_picrust2_pipeline_batch(mapping<string,UnspecifiedObject> params) returns (ReportResults output) authentication required;
+
 };
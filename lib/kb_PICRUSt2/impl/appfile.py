@@ -15,7 +15,7 @@ from ..util.debug import dprint
 def check_dropped_sample_ids(tsv_flpth, amp_mat):
 
     df_partial = pd.read_csv(tsv_flpth, sep='\t', index_col=0).T
-    id_l_full = amp_mat.obj['data']['col_ids']
+    id_l_full = list(amp_mat.col_ids)
 
     assert sorted(df_partial.index) == sorted(id_l_full), '%d vs %d' % (len(df_partial.index), len(id_l_full))
 
@@ -39,15 +39,18 @@ def check_dropped_amplicon_ids(tsv_flpth, amp_mat):
 
     #
     id_l_partial = pd.read_csv(tsv_flpth, sep='\t', index_col=0).index
-    id_l_full = amp_mat.obj['data']['row_ids']
+    id_l_full = list(amp_mat.row_ids)
 
-    # check align/nsti
-    dropped_align, dropped_nsti = _get_dropped_ids(amp_mat)
+    # check filter/align/nsti
+    dropped_filter, dropped_align, dropped_nsti = _get_dropped_ids(amp_mat)
 
     difference0 = sorted(set(id_l_partial) - set(id_l_full))
     difference1 = sorted(set(id_l_full) - set(id_l_partial))
     assert difference0 == []
-    assert difference1 == sorted(dropped_align) or difference1 == sorted(dropped_align + dropped_nsti)
+    assert (
+        difference1 == sorted(dropped_filter + dropped_align) or
+        difference1 == sorted(dropped_filter + dropped_align + dropped_nsti)
+    )
 
 
 
@@ -55,8 +58,9 @@ def check_dropped_amplicon_ids(tsv_flpth, amp_mat):
 ####################################################################################################
 def _get_dropped_ids(amp_mat, nsti_max=2):
     '''
-    Parse amplicon ids that were dropped due to not aligning to
-    or being too distant from
+    Parse amplicon ids that were dropped due to
+    the abundance pre-filter (never input to PICRUSt2),
+    or not aligning to or being too distant from
     reference genomes
     '''
     # get this from globals because ...
@@ -65,15 +69,17 @@ def _get_dropped_ids(amp_mat, nsti_max=2):
 
     df = pd.read_csv(nsti_flpth, sep='\t', index_col=0, header=0)
 
-    ids_all = amp_mat.obj['data']['row_ids']
-    dropped_align = list(set(ids_all) - set(df.index))
+    ids_all = list(amp_mat.row_ids)
+    dropped_filter = list(amp_mat.filtered_ids)
+    dropped_align = list(set(ids_all) - set(df.index) - set(dropped_filter))
     dropped_nsti = list(df.index[df['metadata_NSTI'] > nsti_max])
 
     # should be disjoint
     assert len(set(dropped_align) & set(dropped_nsti)) == 0
     assert len(set(dropped_nsti) & set(dropped_align)) == 0, len(set(dropped_nsti) - set(dropped_align))
+    assert len(set(dropped_filter) & set(df.index)) == 0
     
-    return dropped_align, dropped_nsti
+    return dropped_filter, dropped_align, dropped_nsti
 
 
 
@@ -1,3 +1,4 @@
+import os
 from dotmap import DotMap # TODO make so fails when accessing something non-existent
 import pandas as pd
 
@@ -20,6 +21,51 @@ _config = DotMap(
     metacyc_pathway_code2desc_tsvgz=
         '/miniconda/envs/picrust2/lib/python3.6/site-packages/picrust2/default_files/description_mapfiles/metacyc_pathways_info.txt.gz', 
     picrust2_pipeline_flpth='/miniconda/envs/picrust2/bin/picrust2_pipeline.py',
+    metacyc_pathway_map_flpth=
+        '/miniconda/envs/picrust2/lib/python3.6/site-packages/picrust2/default_files/pathway_mapfiles/metacyc_path2rxn_struc_filt_pro.txt',
+    picrust2_version='2.3.0_b', # keep in sync with Dockerfile. keys caches
+    max_nsti=2, # metagenome_pipeline.py default
+
+#-------- caching ----------------------------------------------------------------------------------
+
+    result_cache_dirname='picrust2_result_cache', # in `shared_folder`
+    result_cache_max_gb=50,
+    placement_cache_flnm='picrust2_placement_cache.sqlite', # in `shared_folder`
+    hsp_store_flnm='picrust2_hsp_store.sqlite', # in `shared_folder`
+
+#-------- stage scheduling -------------------------------------------------------------------------
+
+    max_cores=None, # cap on detected cores. None for all usable cores
+    max_mem_gb=None, # cap on detected memory. None for all available memory
+    batch_min_cores=4, # cores per matrix when a batch runs matrices side by side
+    stage_mem_gb=dict( # rough peak memory estimates per stage kind
+        place=8,
+        description=1,
+        hsp=4,
+        metagenome=2,
+        pathways=4,
+    ),
+    stage_timeout_h=dict( # wall-clock limit per cmd stage, by stage name prefix, e.g., `place` for `place_0`
+        default=12,
+        place=24,
+        pathways=24,
+    ),
+    stage_mem_limit_frac=None, # cmd stages are killed over this fraction of the run's memory budget. None for no limit,
+                               # since the budget is one reading of available memory, shared by concurrent stages
+    io_workers=4, # concurrent background client calls, e.g., fetches, saves, FunctionalProfile imports
+    fp_import_retries=3, # FunctionalProfile imports are retried, with backoff, this many times
+    stream_get_objects=True, # parse AmpliconMatrix values from the streamed fetch response straight into an array
+    place_shard=dict( # splitting novel sequences into concurrent place_seqs.py runs
+        min_seqs=2000, # don't make shards smaller than this
+        mem_gb_per_kseq=0.5, # peak memory growth per 1000 sequences, on top of `stage_mem_gb.place`
+    ),
+
+#-------- preflight --------------------------------------------------------------------------------
+
+    preflight='log', # 'log' the estimate and what looks like it won't fit, or 'off'
+    preflight_calibration_flpth=os.path.join(os.path.dirname(__file__), 'preflight_calibration.json'),
+    preflight_max_wall_h=48, # job time limit
+    preflight_disk_headroom=1.2, # need this times the estimated scratch use free
 
 #-------- these file names/paths should all be in corresponding order ------------------------------
 
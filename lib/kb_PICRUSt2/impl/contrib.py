@@ -0,0 +1,122 @@
+import os
+import gzip
+import shutil
+import logging
+import pandas as pd
+
+from .config import Var
+from ..util.debug import dprint
+
+
+PER_SEQ_FLNM_L = [ # pathway_pipeline.py's `--per_sequence_contrib` outputs
+    'path_abun_predictions.tsv.gz',
+    'path_abun_unstrat_per_seq.tsv.gz',
+    'path_abun_contrib.tsv.gz',
+]
+
+
+
+####################################################################################################
+####################################################################################################
+def subset_inputs(unstrat_flpth, seqtab_norm_flpth, contrib_dir, pathway_l=None, sample_l=None) -> dict:
+    '''
+    Write pathway_pipeline.py inputs for per-sequence contributions in just `sample_l`,
+    from a finished run's EC metagenome outputs
+    Empty/None means all
+
+    Pathways aren't subset here, since which ones MinPath keeps depends on all of them,
+    so `pathway_l` is only checked against the pathway map, and outputs are subset after (see `collect_outputs`)
+    Samples are inferred independently, so subsetting them gives the same results for those samples
+
+    Return paths of subset EC unstratified table and normalized sequence table
+    '''
+    os.makedirs(contrib_dir, exist_ok=True)
+
+    if pathway_l:
+        check_pathways(Var.metacyc_pathway_map_flpth, pathway_l)
+
+    unstrat = pd.read_csv(unstrat_flpth, sep='\t', index_col=0)
+    seqtab_norm = pd.read_csv(seqtab_norm_flpth, sep='\t', index_col=0)
+
+    if sample_l:
+        missing = sorted(set(sample_l) - set(seqtab_norm.columns))
+        if missing:
+            raise Exception('Samples requested for contributions not in results: %s' % missing)
+        unstrat = unstrat[list(sample_l)]
+        seqtab_norm = seqtab_norm[list(sample_l)]
+        # sequences absent from those samples contribute nothing
+        seqtab_norm = seqtab_norm.loc[~(seqtab_norm == 0).all(axis=1)]
+
+    flpths = dict(
+        unstrat=os.path.join(contrib_dir, 'EC_pred_metagenome_unstrat.tsv.gz'),
+        seqtab_norm=os.path.join(contrib_dir, 'seqtab_norm.tsv.gz'),
+    )
+
+    unstrat.to_csv(flpths['unstrat'], sep='\t', index_label='function', compression='gzip')
+    seqtab_norm.to_csv(flpths['seqtab_norm'], sep='\t', index_label='normalized', compression='gzip')
+
+    logging.info(
+        'Subset per-sequence contribution inputs to %s pathways, %d samples, %d sequences' % (
+            len(pathway_l) if pathway_l else 'all', seqtab_norm.shape[1], seqtab_norm.shape[0])
+    )
+
+    return flpths
+
+
+####################################################################################################
+####################################################################################################
+def check_pathways(map_flpth, pathway_l):
+    '''
+    PICRUSt2 pathway map is one pathway per line, pathway ID first
+    '''
+    found = set()
+
+    open_ = gzip.open if map_flpth.endswith('.gz') else open
+    with open_(map_flpth, 'rt') as fh:
+        for line in fh:
+            tok_l = line.split()
+            if tok_l:
+                found.add(tok_l[0])
+
+    missing = sorted(set(pathway_l) - found)
+    if missing:
+        raise Exception('Pathways requested for contributions not in MetaCyc pathway map: %s' % missing)
+
+
+####################################################################################################
+####################################################################################################
+def subset_pathways(src_flpth, dst_flpth, pathway_l):
+    '''
+    Keep only `pathway_l`'s columns in per-sequence predictions,
+    and their rows in the per-sequence unstratified table and long-format contributions
+    Values are kept as text, so verbatim
+    '''
+    pathway_s = set(pathway_l)
+    df = pd.read_csv(src_flpth, sep='\t', dtype=str, keep_default_na=False)
+
+    flnm = os.path.basename(src_flpth)
+    if flnm == 'path_abun_predictions.tsv.gz': # sequence x pathway
+        df = df[[df.columns[0]] + [col for col in df.columns[1:] if col in pathway_s]]
+    elif flnm == 'path_abun_contrib.tsv.gz': # long format
+        df = df[df['function'].isin(pathway_s)]
+    else: # pathway x sample
+        df = df[df[df.columns[0]].isin(pathway_s)]
+
+    df.to_csv(dst_flpth, sep='\t', index=False, compression='gzip')
+
+
+####################################################################################################
+####################################################################################################
+def collect_outputs(contrib_out_dir, pathways_out_dir, pathway_l=None):
+    '''
+    Copy per-sequence outputs to where a `--per_sequence_contrib` run would have put them,
+    subset to `pathway_l` if given
+    '''
+    for flnm in PER_SEQ_FLNM_L:
+        flpth = os.path.join(contrib_out_dir, flnm)
+        if not os.path.exists(flpth):
+            continue
+        if pathway_l:
+            subset_pathways(flpth, os.path.join(pathways_out_dir, flnm), pathway_l)
+        else:
+            shutil.copyfile(flpth, os.path.join(pathways_out_dir, flnm))
@@ -0,0 +1,80 @@
+import os
+import logging
+import pandas as pd
+
+from .placement import hash_seq
+from ..util.file import read_fasta, write_fasta
+from ..util.debug import dprint
+
+
+
+####################################################################################################
+####################################################################################################
+def collapse(seq_flpth, uniq_seq_flpth, rep_flpth) -> int:
+    '''
+    Collapse amplicons with identical sequences (see `hash_seq`) into the first one's id
+
+    Predictions only depend on the sequence, so placement and hsp.py can run on unique sequences,
+    and metagenome prediction on their predictions (see `predict_metagenomes`' `id2rep`)
+    Writes the id to representative id map for it and `expand_outputs`
+    Return number of unique sequences
+    '''
+    id_seq_l = read_fasta(seq_flpth)
+
+    hash2rep = {}
+    id2rep = {}
+    uniq_l = []
+    for id, seq in id_seq_l:
+        seq_hash = hash_seq(seq)
+        if seq_hash not in hash2rep:
+            hash2rep[seq_hash] = id
+            uniq_l.append((id, seq))
+        id2rep[id] = hash2rep[seq_hash]
+
+    write_fasta(uniq_l, uniq_seq_flpth)
+
+    pd.Series(id2rep, name='rep').to_csv(rep_flpth, sep='\t', index_label='id', header=True)
+
+    logging.info('Collapsed %d amplicons into %d unique sequences' % (len(id_seq_l), len(uniq_l)))
+
+    return len(uniq_l)
+
+
+####################################################################################################
+####################################################################################################
+def read_rep(rep_flpth) -> dict:
+    df = pd.read_csv(rep_flpth, sep='\t', index_col=0, dtype=str, keep_default_na=False)
+    return df['rep'].to_dict()
+
+
+####################################################################################################
+####################################################################################################
+def expand_table(src_flpth, dst_flpth, id2rep):
+    '''
+    Write TSV(.gz) with a row per amplicon id, copied verbatim from its representative's row
+    Amplicons whose representative has no row (e.g., unplaced) stay dropped
+    '''
+    df = pd.read_csv(src_flpth, sep='\t', index_col=0, dtype=str, keep_default_na=False)
+    present = set(df.index)
+    id_l = [id for id, rep in id2rep.items() if rep in present]
+
+    df_expanded = df.loc[[id2rep[id] for id in id_l]]
+    df_expanded.index = pd.Index(id_l, name=df.index.name)
+    df_expanded.to_csv(dst_flpth, sep='\t', compression='gzip' if dst_flpth.endswith('.gz') else None)
+
+
+####################################################################################################
+####################################################################################################
+def expand_outputs(collapsed_dir, out_dir, FUNC_l, rep_flpth):
+    '''
+    Back to the input amplicon ids for the marker/function predictions in `collapsed_dir`,
+    copied from the representative, to the same file names in `out_dir`
+    Normalized abundances already have every amplicon id (see `predict_metagenomes`' `id2rep`)
+    '''
+    id2rep = read_rep(rep_flpth)
+
+    for FUNC in FUNC_l:
+        flnm = 'marker_predicted_and_nsti.tsv.gz' if FUNC == '16S' else f'{FUNC}_predicted.tsv.gz'
+        expand_table(os.path.join(collapsed_dir, flnm), os.path.join(out_dir, flnm), id2rep)
+
+    logging.info('Expanded amplicon-level outputs back to %d amplicon ids' % len(id2rep))
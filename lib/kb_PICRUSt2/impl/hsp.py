@@ -0,0 +1,241 @@
+import os
+import json
+import sqlite3
+import logging
+import contextlib
+import numpy as np
+import pandas as pd
+
+from .config import Var
+from .placement import hash_seq, chunks
+from ..util.file import read_fasta
+from ..util.checkpoint import hash_inputs
+from ..util.debug import dprint
+
+
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+class HSPStore:
+    '''
+    Persistent per-sequence hidden-state predictions,
+    keyed by sequence hash, function (e.g., 16S, EC), reference version,
+    and tree key (see `get_tree_key`),
+    since hsp.py's prediction for a sequence depends on which others are grafted onto the tree with it
+
+    Each row is one sequence's vector over the function's columns,
+    stored as a blob of the function's dtype (see `get_dtype`)
+    Columns and dtype are kept per function and reference version
+    A tree's predictions for a function are stored all at once, and marked complete with them
+    '''
+
+    @staticmethod
+    def get_dtype(func) -> np.dtype:
+        '''
+        16S has NSTI alongside its copy numbers, so float64
+        Other functions are copy numbers only, so int32
+        '''
+        return np.dtype('<f8') if func == '16S' else np.dtype('<i4')
+
+
+####################################################################################################
+####################################################################################################
+    def __init__(self, db_flpth, ref_version):
+        self.db_flpth = db_flpth
+        self.ref_version = ref_version
+
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS hsp_tree_seq ('
+                'seq_hash TEXT, func TEXT, ref_version TEXT, tree_key TEXT, vec BLOB, '
+                'PRIMARY KEY (tree_key, func, ref_version, seq_hash))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS hsp_tree ('
+                'tree_key TEXT, func TEXT, ref_version TEXT, '
+                'PRIMARY KEY (tree_key, func, ref_version))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS hsp_meta ('
+                'func TEXT, ref_version TEXT, cols TEXT, dtype TEXT, '
+                'PRIMARY KEY (func, ref_version))'
+            )
+
+
+####################################################################################################
+####################################################################################################
+    @contextlib.contextmanager
+    def _connect(self):
+        '''
+        New connection per call since stages can run in other threads
+        Commit on success and always close
+        '''
+        conn = sqlite3.connect(self.db_flpth, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+####################################################################################################
+####################################################################################################
+    def get_meta(self, func):
+        '''
+        Return (cols, dtype) or None
+        '''
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT cols, dtype FROM hsp_meta WHERE func = ? AND ref_version = ?',
+                [func, self.ref_version]
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), np.dtype(row[1])
+
+
+####################################################################################################
+####################################################################################################
+    def has(self, func, tree_key) -> bool:
+        '''
+        Whether `func`'s predictions on tree `tree_key` are stored
+        '''
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT 1 FROM hsp_tree WHERE tree_key = ? AND func = ? AND ref_version = ?',
+                [tree_key, func, self.ref_version]
+            ).fetchone()
+        return row is not None
+
+
+####################################################################################################
+####################################################################################################
+    def insert(self, func, tree_key, df: pd.DataFrame):
+        '''
+        All of `func`'s predictions on tree `tree_key`
+        `df` - rows are seq hashes, columns are the function's columns
+        '''
+        meta = self.get_meta(func)
+        values = df.values
+        dtype = self.get_dtype(func)
+
+        if meta is None:
+            cols = df.columns.tolist()
+        else:
+            cols, dtype_stored = meta
+            if df.columns.tolist() != cols:
+                raise Exception(
+                    'Columns of new `%s` predictions differ from stored ones for reference version `%s`' % (
+                        func, self.ref_version)
+                )
+            if dtype_stored != dtype:
+                raise Exception('Stored `%s` predictions are %s, not %s' % (func, dtype_stored, dtype))
+        if dtype.kind == 'i' and not np.array_equal(values, np.round(values)):
+            raise Exception('New `%s` predictions are not integers as copy numbers should be' % func)
+
+        values = values.astype(dtype)
+
+        with self._connect() as conn:
+            if meta is None:
+                conn.execute(
+                    'INSERT OR IGNORE INTO hsp_meta VALUES (?, ?, ?, ?)', # another process may have beaten us
+                    [func, self.ref_version, json.dumps(cols), dtype.str]
+                )
+            conn.executemany(
+                'INSERT OR REPLACE INTO hsp_tree_seq VALUES (?, ?, ?, ?, ?)',
+                [
+                    (seq_hash, func, self.ref_version, tree_key, values[i].tobytes())
+                    for i, seq_hash in enumerate(df.index)
+                ]
+            )
+            conn.execute(
+                'INSERT OR IGNORE INTO hsp_tree VALUES (?, ?, ?)',
+                [tree_key, func, self.ref_version]
+            )
+
+
+####################################################################################################
+####################################################################################################
+    def lookup(self, func, tree_key, seq_hash_l) -> pd.DataFrame:
+        '''
+        Rows for `seq_hash_l`, in that order, as one block
+        Fails if any is missing
+        '''
+        cols, dtype = self.get_meta(func)
+        seq_hash_l = list(seq_hash_l)
+
+        hash2vec = {}
+        with self._connect() as conn:
+            for chunk in chunks(list(set(seq_hash_l))):
+                rows = conn.execute(
+                    'SELECT seq_hash, vec FROM hsp_tree_seq '
+                    'WHERE tree_key = ? AND func = ? AND ref_version = ? AND seq_hash IN (%s)' %
+                    ','.join('?' * len(chunk)),
+                    [tree_key, func, self.ref_version] + chunk
+                )
+                for seq_hash, vec in rows:
+                    hash2vec[seq_hash] = vec
+
+        missing = set(seq_hash_l) - set(hash2vec)
+        if missing:
+            raise Exception('`%s` predictions missing from store for %d sequences' % (func, len(missing)))
+
+        values = np.empty((len(seq_hash_l), len(cols)), dtype=dtype)
+        for i, seq_hash in enumerate(seq_hash_l):
+            values[i] = np.frombuffer(hash2vec[seq_hash], dtype=dtype)
+
+        return pd.DataFrame(values, index=seq_hash_l, columns=cols)
+
+
+
+####################################################################################################
+####################################################################################################
+def get_hsp_store() -> HSPStore:
+    return HSPStore(
+        os.path.join(Var.shared_folder, Var.hsp_store_flnm),
+        ref_version=Var.picrust2_version,
+    )
+
+
+####################################################################################################
+####################################################################################################
+def get_tree_key(seq_flpth) -> str:
+    '''
+    Key of the tree hsp.py predicts on,
+    the reference tree with the study's placed sequences grafted, like `picrust2_pipeline.py`'s `out.tre`,
+    which follow from the distinct sequences for a reference version
+    '''
+    return hash_inputs(str_l=sorted({hash_seq(seq) for _, seq in read_fasta(seq_flpth)}))
+
+
+####################################################################################################
+####################################################################################################
+def store_and_assemble(func, seq_flpth, tree_key, store, placement_cache, out_flpth, predicted_flpth=None):
+    '''
+    Store hsp.py's predictions on tree `tree_key`, from `predicted_flpth` if given,
+    named by amplicon id
+    Then write `func`'s predictions for all placed study sequences, named by amplicon id,
+    from the store, like hsp.py would have
+    '''
+    id2hash = {id: hash_seq(seq) for id, seq in read_fasta(seq_flpth)}
+
+    if predicted_flpth is not None:
+        df = pd.read_csv(predicted_flpth, sep='\t', index_col=0, dtype={'sequence': str})
+        df.index = [id2hash[id] for id in df.index.astype(str)]
+        df = df.loc[~df.index.duplicated()] # identical sequences, e.g., if not collapsed
+        store.insert(func, tree_key, df)
+        logging.info('Stored `%s` predictions for %d sequences' % (func, df.shape[0]))
+
+    hash2p = placement_cache.lookup(list(id2hash.values()))
+    id2hash = {id: seq_hash for id, seq_hash in id2hash.items() if hash2p.get(seq_hash) is not None}
+
+    df = store.lookup(func, tree_key, id2hash.values())
+    df.index = list(id2hash.keys())
+    df.index.name = 'sequence'
+
+    logging.info('Assembled `%s` predictions for %d study sequences' % (func, df.shape[0]))
+
+    os.makedirs(os.path.dirname(out_flpth), exist_ok=True)
+    df.to_csv(out_flpth, sep='\t', compression='gzip')
@@ -12,7 +12,41 @@ from .config import Var
 from .error import * # custom Exceptions
 from ..util import validate as vd
 from ..util.debug import dprint
-from ..util.file import get_numbered_duplicate
+from ..util.rpc import can_stream, run_job_streamed
+from ..util.file import get_numbered_duplicate, read_fasta, write_fasta, write_tsv
+
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+def get_object(ref, included=None, array_path=None) -> dict:
+    '''
+    Workspace object data and info
+
+    `included` - only fetch these paths into the object, e.g., `['/data/row_ids']`,
+    with workspace `get_objects2`. Without a workspace client, the whole object is fetched
+    `array_path` - into the whole object's data and info, e.g., `('data', 'data', 'values')`,
+    a nested number list to stream straight into a float array, see `run_job_streamed`
+    '''
+    if included is not None and 'ws' in Var:
+        return Var.ws.get_objects2({
+            'objects': [{'ref': ref, 'included': included}]
+        })['data'][0]
+
+    params = {
+        'object_refs': [ref]
+    }
+
+    if array_path is not None and Var.stream_get_objects and can_stream(Var.dfu):
+        res, a = run_job_streamed(Var.dfu, 'DataFileUtil.get_objects', [params], ('data', None) + tuple(array_path))
+        obj = res['data'][0]
+        if a is not None:
+            functools.reduce(lambda d, k: d[k], array_path[:-1], obj)[array_path[-1]] = a
+        return obj
+
+    return Var.dfu.get_objects(params)['data'][0]
+
 
 
 ####################################################################################################
@@ -20,31 +54,180 @@ from ..util.file import get_numbered_duplicate
 ####################################################################################################
 ####################################################################################################
 class AmpliconMatrix:
+    '''
+    Compact in-memory model of the workspace object:
+    values as a float array with NaN for missing, and the missing mask,
+    row/col ids as arrays, row mapping as an array aligned to the row ids,
+    and the rest of the object as a small dict
+
+    The workspace object isn't kept, and is only rebuilt by `to_obj` to save
+    Only the ids and row AttributeMapping ref are fetched at first,
+    and the rest on first access to any of `LAZY`, or with `fetch_values`.
+    Copying and pickling take only what's fetched, without fetching
+    '''
+
+    __slots__ = (
+        'upa',
+        'name',
+        'row_attrmap_upa',
+        'filtered_ids', # left out of PICRUSt2 inputs by `prefilter`
+        'row_ids',
+        'col_ids',
+        'row_mapping', # AttributeMapping id per row, or None
+        'values',
+        'missing',
+        'meta', # everything else in the object
+    )
+
+    HEAD_PATHS = ['/row_attributemapping_ref', '/data/row_ids', '/data/col_ids']
+    LAZY = ('row_mapping', 'values', 'missing', 'meta')
 
 ####################################################################################################
 ####################################################################################################
     def __init__(self, upa):
         self.upa = upa
+        self.filtered_ids = []
         self._get_obj()
 
 
+####################################################################################################
+####################################################################################################
+    def __getattr__(self, name):
+        '''
+        Only called for unset slots and missing attributes, e.g., dunder probes by `copy` or `pickle`
+        Only fetches for `LAZY` fields of a constructed instance, e.g., not one being unpickled
+        '''
+        if name not in self.LAZY or not self._is_set('upa'):
+            raise AttributeError(name)
+        self.fetch_values()
+        return object.__getattribute__(self, name)
+
+
+    def _is_set(self, name) -> bool:
+        try:
+            object.__getattribute__(self, name)
+            return True
+        except AttributeError:
+            return False
+
+
+    def __getstate__(self) -> dict:
+        '''
+        Set slots only, so copying/pickling doesn't fetch
+        '''
+        return {name: object.__getattribute__(self, name) for name in self.__slots__ if self._is_set(name)}
+
+
+    def __setstate__(self, state: dict):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+
 ####################################################################################################
 ####################################################################################################
     def _get_obj(self):
-        logging.info('Loading AmpliconMatrix object')
+        logging.info('Loading AmpliconMatrix object ids')
 
-        obj = Var.dfu.get_objects({
-            'object_refs': [self.upa]
-            })
+        obj = get_object(self.upa, included=self.HEAD_PATHS)
 
-        self.name = obj['data'][0]['info'][1]
-        self.row_attrmap_upa = obj['data'][0]['data'].get('row_attributemapping_ref')
-        self.obj = obj['data'][0]['data']
+        self.name = obj['info'][1]
+
+        if 'values' in obj['data']['data']: # got the whole object anyway
+            self._load(obj['data'])
+        else:
+            self.row_attrmap_upa = obj['data'].get('row_attributemapping_ref')
+            self.row_ids = np.array(obj['data']['data']['row_ids'], dtype=object)
+            self.col_ids = np.array(obj['data']['data']['col_ids'], dtype=object)
         
         if 'run_dir' in Var: # comment directory with AmpMat name. optional since unit tests may not have run_dir
             dprint('touch %s' % os.path.join(Var.run_dir, '#' + self.name), run='cli')
 
 
+####################################################################################################
+####################################################################################################
+    def fetch_values(self):
+        '''
+        Fetch the rest of the object, if not yet
+        '''
+        if self._is_set('values'):
+            return
+
+        logging.info('Loading AmpliconMatrix object values')
+
+        obj = get_object(self.upa, array_path=('data', 'data', 'values'))
+        row_attrmap_upa = self.row_attrmap_upa # may have been updated since
+        self._load(obj['data'])
+        self.row_attrmap_upa = row_attrmap_upa
+
+
+####################################################################################################
+####################################################################################################
+    def _load(self, obj: dict):
+        obj = dict(obj)
+        data = obj.pop('data')
+        row_mapping = obj.pop('row_mapping', None)
+
+        self.row_attrmap_upa = obj.pop('row_attributemapping_ref', None)
+        self.set_data(data['row_ids'], data['col_ids'], data['values'])
+        self.row_mapping = (
+            np.array([row_mapping.get(id) for id in data['row_ids']], dtype=object)
+            if row_mapping is not None else None
+        )
+        self.meta = obj
+
+
+####################################################################################################
+####################################################################################################
+    def set_data(self, row_ids: list, col_ids: list, values: list):
+        self.row_ids = np.array(row_ids, dtype=object)
+        self.col_ids = np.array(col_ids, dtype=object)
+        self.set_values(values)
+        self.values = self.values.reshape(len(row_ids), len(col_ids))
+        self.missing = self.missing.reshape(len(row_ids), len(col_ids))
+
+
+####################################################################################################
+####################################################################################################
+    def set_values(self, values: list):
+        '''
+        Parse nested list of numbers and missing values
+        '''
+        try:
+            self.values = vd.to_float_array(values)
+        except ValueError:
+            raise vd.ValidationException(
+                'Input AmpliconMatrix must have numeric or missing values in matrix'
+            )
+        self.missing = np.isnan(self.values)
+
+
+####################################################################################################
+####################################################################################################
+    def to_obj(self) -> dict:
+        '''
+        Rebuild the workspace object
+        '''
+        values = self.values.astype(object)
+        values[self.missing] = None
+
+        obj = dict(
+            self.meta,
+            data=dict(
+                row_ids=self.row_ids.tolist(),
+                col_ids=self.col_ids.tolist(),
+                values=values.tolist(),
+            ),
+        )
+        if self.row_attrmap_upa is not None:
+            obj['row_attributemapping_ref'] = self.row_attrmap_upa
+        if self.row_mapping is not None:
+            obj['row_mapping'] = {
+                id: mapped for id, mapped in zip(self.row_ids.tolist(), self.row_mapping.tolist())
+                if mapped is not None
+            }
+        return obj
+
+
 ####################################################################################################
 ####################################################################################################
     def to_seq_abundance_table(self, flpth):
@@ -53,33 +236,75 @@ class AmpliconMatrix:
         '''
         logging.info(f"Writing sequence abundance table to %s" % flpth)
 
-        def copy_replace(nested: list, rep=None):
-            nested_ = []
-            for l in nested:
-                l_ = l.copy()
-                nested_.append(l_)
-                for i, e in enumerate(l_):
-                    if e == '':
-                        l_[i] = None
-            return nested_
-
-        data = np.array(copy_replace(self.obj['data']['values']), dtype=float) 
-        row_ids = self.obj['data']['row_ids']
-        col_ids = self.obj['data']['col_ids']
-
-        data = pd.DataFrame(
-            data, 
-            index=row_ids, # Amplicon Ids 
-            columns=col_ids # sample names
-            )
-        data.index.name = Var.amplicon_header_name
-        data.to_csv(flpth, sep='\t', float_format='%g')
+        data = self.values
+        row_ids = self.row_ids
+        col_ids = self.col_ids
+
+        if self.filtered_ids:
+            keep = ~np.isin(row_ids, self.filtered_ids)
+            data = data[keep]
+            row_ids = row_ids[keep]
+
+        write_tsv(data, row_ids, col_ids, flpth, index_name=Var.amplicon_header_name, float_format='%g')
 
 ####################################################################################################
 ####################################################################################################
-    def to_fasta(self, flpth):
-        fetched_flpth = Var.gapi.fetch_sequence(self.upa)
-        shutil.copyfile(fetched_flpth, flpth)
+    def to_fasta(self, flpth, fetched_flpth=None):
+        '''
+        `fetched_flpth` - from `gapi.fetch_sequence`, if already fetched, e.g., in the background
+        '''
+        if fetched_flpth is None:
+            fetched_flpth = Var.gapi.fetch_sequence(self.upa)
+        if not self.filtered_ids:
+            shutil.copyfile(fetched_flpth, flpth)
+            return
+
+        filtered = set(self.filtered_ids)
+        write_fasta([(id, seq) for id, seq in read_fasta(fetched_flpth) if id not in filtered], flpth)
+
+####################################################################################################
+####################################################################################################
+    def prefilter(self, min_total_count=0, min_prevalence=0, top_n=0) -> list:
+        '''
+        Leave low-abundance amplicons out of `to_fasta` and `to_seq_abundance_table`,
+        but not out of this object, which is saved with all its rows
+
+        `min_total_count` - minimum count summed over samples
+        `min_prevalence` - minimum number of samples present in
+        `top_n` - keep at most this many amplicons, by total count
+        0 turns a criterion off. Missing values count as 0
+
+        Prerequisite: validate first with `validate_amplicon_abundance_data`
+        Return filtered amplicon ids
+        '''
+        row_ids = self.row_ids.tolist()
+        a = np.nan_to_num(self.values)
+
+        total = a.sum(axis=1)
+        keep = np.ones(len(row_ids), dtype=bool)
+
+        if min_total_count:
+            keep &= total >= min_total_count
+        if min_prevalence:
+            keep &= (a > 0).sum(axis=1) >= min_prevalence
+        if top_n and keep.sum() > top_n:
+            # stable, so ties keep the earlier rows
+            ind_l = [ind for ind in np.argsort(-total, kind='mergesort') if keep[ind]]
+            keep[:] = False
+            keep[ind_l[:top_n]] = True
+
+        if not keep.any():
+            raise vd.ValidationException(
+                'Abundance pre-filter would leave no amplicons. '
+                'Try a lower minimum total count or prevalence'
+            )
+
+        self.filtered_ids = [id for id, k in zip(row_ids, keep) if not k]
+
+        logging.info(
+            'Abundance pre-filter kept %d of %d amplicons' % (len(row_ids) - len(self.filtered_ids), len(row_ids)))
+
+        return self.filtered_ids
 
 ####################################################################################################
 ####################################################################################################
@@ -92,20 +317,18 @@ class AmpliconMatrix:
         Because of KBase float types, which this is composed of,
         don't have to worry about complex, inf, etc.
         '''
-        a = np.array(self.obj['data']['values'])
+        base_msg = (
+            'Input AmpliconMatrix must have count data (missing values allowed) in matrix. '
+        )
+
+        a, missing = self.values, self.missing
 
         # Can't be all missing
-        if vd.get_num_missing(a) == a.size:
+        if missing.all():
             raise vd.ValidationException(
                 'Input AmpliconMatrix cannot have all missing matrix values'
             )
 
-        a = vd.as_numeric(a, dtype=float) # casting as int will truncate floats into ints
-
-        base_msg = (
-            'Input AmpliconMatrix must have count data (missing values allowed) in matrix. '
-        )
-
         # Integer
         if not vd.is_int_like(a):
             raise vd.ValidationException(
@@ -127,11 +350,19 @@ class AmpliconMatrix:
         Swap those ids out for the AttributeMapping ids
         '''
 
-        if f'{axis}_mapping' not in self.obj:
+        if axis == 'row':
+            mapping = (
+                dict(zip(self.row_ids.tolist(), self.row_mapping.tolist()))
+                if self.row_mapping is not None else None
+            )
+        else:
+            mapping = self.meta.get(f'{axis}_mapping')
+
+        if mapping is None:
             return id2attr # should have row_mapping, but if none then it doesn't matter
 
         id2attr = {
-            self.obj[f'{axis}_mapping'][id]: attr
+            mapping[id]: attr
             for id, attr in id2attr.items()
         }
 
@@ -146,7 +377,7 @@ class AmpliconMatrix:
         upa_new = Var.gapi.save_object({
             'obj_type': 'KBaseMatrices.AmpliconMatrix', # TODO version
             'obj_name': name if name is not None else self.name,
-            'data': self.obj,
+            'data': self.to_obj(),
             'workspace_id': Var.params['workspace_id'],
         })['obj_ref']
 
@@ -159,6 +390,10 @@ class AmpliconMatrix:
 ####################################################################################################
 ####################################################################################################
 class AttributeMapping:
+    '''
+    Fetched whole, unlike `AmpliconMatrix`, since it's only loaded to save an updated copy,
+    which needs all the instances anyway
+    '''
 
 ####################################################################################################
 ####################################################################################################
@@ -175,12 +410,10 @@ class AttributeMapping:
     def _get_obj(self):
         logging.info('Loading AttributeMapping object')
 
-        obj = Var.dfu.get_objects({
-            'object_refs': ['%s;%s' %(self.amp_mat.upa, self.upa)]
-            })
+        obj = get_object('%s;%s' %(self.amp_mat.upa, self.upa))
 
-        self.name = obj['data'][0]['info'][1]
-        self.obj = obj['data'][0]['data']
+        self.name = obj['info'][1]
+        self.obj = obj['data']
 
 
 ####################################################################################################
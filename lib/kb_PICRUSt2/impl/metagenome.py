@@ -0,0 +1,142 @@
+import os
+import time
+import logging
+import numpy as np
+import pandas as pd
+
+from .config import Var
+from ..util.debug import dprint
+
+
+MARKER_COL = '16S_rRNA_Count'
+NSTI_COL = 'metadata_NSTI'
+ROUND_DECIMAL = 2
+FUNC_CHUNK = 2000 # function columns per matrix product, bounds temporaries
+
+
+
+####################################################################################################
+####################################################################################################
+def read_seqabun(flpth) -> pd.DataFrame:
+    df = pd.read_csv(flpth, sep='\t', index_col=0, dtype={Var.amplicon_header_name: str})
+    df.index = df.index.astype(str)
+    return df
+
+
+####################################################################################################
+####################################################################################################
+def read_predicted(flpth) -> pd.DataFrame:
+    df = pd.read_csv(flpth, sep='\t', index_col=0, dtype={'sequence': str})
+    df.index = df.index.astype(str)
+    return df
+
+
+####################################################################################################
+####################################################################################################
+def unstrat(func_mat, norm_mat):
+    '''
+    Function x sample abundances, i.e., `func_mat.T @ norm_mat`,
+    a block of function columns at a time
+    '''
+    out = np.empty((func_mat.shape[1], norm_mat.shape[1]))
+    for i in range(0, func_mat.shape[1], FUNC_CHUNK):
+        out[i:i+FUNC_CHUNK] = np.dot(func_mat[:, i:i+FUNC_CHUNK].T.astype(float), norm_mat)
+    return out.round(ROUND_DECIMAL)
+
+
+####################################################################################################
+####################################################################################################
+def predict_metagenomes(seq_abundance_table_flpth, marker_flpth, func2flpths, max_nsti=None, id2rep=None):
+    '''
+    In-process `metagenome_pipeline.py` for several functions,
+    with its defaults and unstratified output only
+
+    The abundance table and marker predictions are read once,
+    and normalized abundances are computed once per set of overlapping sequences
+
+    `func2flpths` - FUNC to (predicted table, out dir)
+    `id2rep` - for predictions of only representatives of identical sequences (see `dedup.collapse`).
+               Abundances are still normalized and rounded per amplicon, like `metagenome_pipeline.py` would,
+               then summed per representative, so the outputs are the same as from predictions for all amplicons
+
+    Writes `seqtab_norm.tsv.gz`, `weighted_nsti.tsv.gz`, `pred_metagenome_unstrat.tsv.gz`
+    to each out dir
+    '''
+    max_nsti = max_nsti if max_nsti is not None else Var.max_nsti
+
+    t0 = time.time()
+
+    seqabun = read_seqabun(seq_abundance_table_flpth)
+    marker = read_predicted(marker_flpth)
+
+    nsti = marker[NSTI_COL]
+    marker = marker[nsti <= max_nsti]
+
+    get_rep = (lambda seq: id2rep[seq]) if id2rep is not None else (lambda seq: seq)
+
+    # in abundance table's order
+    marker_seq_set = set(marker.index)
+    seq_l = [seq for seq in seqabun.index if get_rep(seq) in marker_seq_set]
+
+    overlap2norm = {}
+
+    for FUNC, (predicted_flpth, out_dir) in func2flpths.items():
+        func = read_predicted(predicted_flpth)
+
+        func_seq_set = set(func.index)
+        overlap = tuple(seq for seq in seq_l if get_rep(seq) in func_seq_set)
+        rep_l = [get_rep(seq) for seq in overlap]
+
+        if len(overlap) == 0:
+            raise Exception(
+                'No sequence ids overlap between abundance table, marker predictions, '
+                'and `%s` predictions' % FUNC
+            )
+
+        os.makedirs(out_dir, exist_ok=True)
+
+        ##
+        ## normalize
+
+        if overlap not in overlap2norm:
+            counts = seqabun.loc[list(overlap)]
+            norm = counts.div(marker.loc[rep_l, MARKER_COL].values, axis='index').round(ROUND_DECIMAL)
+
+            weighted_nsti = pd.DataFrame(
+                counts.mul(nsti.loc[rep_l].values, axis='index').sum(axis=0) / counts.sum(axis=0),
+                columns=['weighted_NSTI'],
+            )
+            weighted_nsti.index.name = 'sample'
+
+            # summed after rounding
+            norm_rep = norm.groupby(rep_l, sort=False).sum() if id2rep is not None else norm
+
+            overlap2norm[overlap] = norm, norm_rep, weighted_nsti
+
+        norm, norm_rep, weighted_nsti = overlap2norm[overlap]
+
+        norm.to_csv(
+            os.path.join(out_dir, 'seqtab_norm.tsv.gz'), sep='\t', index_label='normalized', compression='gzip')
+        weighted_nsti.to_csv(
+            os.path.join(out_dir, 'weighted_nsti.tsv.gz'), sep='\t', compression='gzip')
+
+        ##
+        ## unstratified
+
+        func = func.loc[norm_rep.index]
+        df = pd.DataFrame(
+            unstrat(func.values, norm_rep.values),
+            index=func.columns,
+            columns=norm_rep.columns,
+        )
+        df = df.loc[~(df == 0).all(axis=1)]
+
+        df.to_csv(
+            os.path.join(out_dir, 'pred_metagenome_unstrat.tsv.gz'), sep='\t', index_label='function', compression='gzip')
+
+        logging.info(
+            'Predicted `%s` metagenome: %d functions x %d samples from %d sequences' % (
+                FUNC, df.shape[0], df.shape[1], len(overlap))
+        )
+
+    logging.info('Metagenome prediction for %d functions took %.2fs' % (len(func2flpths), time.time() - t0))
@@ -31,6 +31,12 @@ class Params:
         'metacyc': 1,
         'create_amplicon_fps': True,
         'create_sample_fps': True,
+        'per_sequence_contrib': 0,
+        'contrib_pathways': [], # empty for all
+        'contrib_samples': [], # empty for all
+        'min_total_count': 0, # 0 for off
+        'min_prevalence': 0,
+        'top_n': 0,
     }
 
 
@@ -40,6 +46,8 @@ class Params:
         #---
         'functions',
         'fp_options',
+        'contrib_options',
+        'filter_options',
         #---
         'cog',
         'ec',
@@ -50,6 +58,12 @@ class Params:
         'metacyc',
         'create_amplicon_fps', 
         'create_sample_fps',
+        'per_sequence_contrib',
+        'contrib_pathways',
+        'contrib_samples',
+        'min_total_count',
+        'min_prevalence',
+        'top_n',
         #---
         'workspace_id',
         'workspace_name',
@@ -68,8 +82,17 @@ class Params:
             'pfam',
             'tigrfam',
             'pheno',
+            'per_sequence_contrib',
         ]:
             self._rep_as_bool(params, param)
+
+        # narrative text inputs default to `[""]`
+        for param in [
+            'contrib_pathways',
+            'contrib_samples',
+        ]:
+            if param in params:
+                params[param] = [v.strip() for v in params[param] if v and v.strip()]
        
         ##
         self.params = params
@@ -115,6 +138,25 @@ class Params:
         return self.params.get(key, self.DEFAULTS[key])
 
 
+    def has_full_contrib(self) -> bool:
+        '''
+        Per-sequence contributions for all pathways and samples,
+        which the per-amplicon MetaCyc predictions need to be complete
+        '''
+        return (
+            bool(self.getd('per_sequence_contrib')) 
+            and not self.getd('contrib_pathways') 
+            and not self.getd('contrib_samples')
+        )
+
+
+    def has_amplicon_output(self, func) -> bool:
+        '''
+        Per-amplicon MetaCyc predictions only come with full per-sequence contributions
+        '''
+        return func != 'metacyc' or self.has_full_contrib()
+
+
     def __repr__(self) -> str:
         return 'Wrapper for params:\n%s' % (json.dumps(self.params, indent=4))
 
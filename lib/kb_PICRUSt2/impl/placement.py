@@ -0,0 +1,298 @@
+import os
+import re
+import json
+import glob
+import sqlite3
+import hashlib
+import logging
+import contextlib
+
+from .config import Var
+from ..util.file import read_fasta, write_fasta
+from ..util.debug import dprint
+
+
+SQLITE_MAX_VARS = 900 # stay under sqlite's default 999 bound variables per statement
+JPLACE_VERSION = 3
+
+
+
+####################################################################################################
+####################################################################################################
+def hash_seq(seq) -> str:
+    '''
+    Hash of normalized sequence, i.e., case, gaps, whitespace, and U/T don't matter
+    '''
+    seq = re.sub(r'[\s\-\.]', '', seq).upper().replace('U', 'T')
+    return hashlib.sha1(seq.encode()).hexdigest()
+
+
+####################################################################################################
+####################################################################################################
+def chunks(l, n=SQLITE_MAX_VARS):
+    for i in range(0, len(l), n):
+        yield l[i:i+n]
+
+
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+class PlacementCache:
+    '''
+    Persistent per-sequence placements, keyed by sequence hash and reference version
+
+    A placement is a jplace placement's `p` list,
+    or None for a sequence PICRUSt2 dropped before placement (e.g., poor alignment)
+    The reference jplace tree is kept per reference version
+    since placements' edge numbers are only meaningful against it
+    '''
+
+####################################################################################################
+####################################################################################################
+    def __init__(self, db_flpth, ref_version):
+        self.db_flpth = db_flpth
+        self.ref_version = ref_version
+
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS placement ('
+                'seq_hash TEXT, ref_version TEXT, p TEXT, '
+                'PRIMARY KEY (seq_hash, ref_version))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jplace_meta ('
+                'ref_version TEXT PRIMARY KEY, tree TEXT, fields TEXT)'
+            )
+
+
+####################################################################################################
+####################################################################################################
+    @contextlib.contextmanager
+    def _connect(self):
+        '''
+        New connection per call since stages can run in other threads
+        Commit on success and always close
+        '''
+        conn = sqlite3.connect(self.db_flpth, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+####################################################################################################
+####################################################################################################
+    def lookup(self, seq_hash_l) -> dict:
+        '''
+        Return dict of cached seq hash to placement (possibly None)
+        Hashes not in the return are novel
+        '''
+        hash2p = {}
+        with self._connect() as conn:
+            for chunk in chunks(list(set(seq_hash_l))):
+                rows = conn.execute(
+                    'SELECT seq_hash, p FROM placement WHERE ref_version = ? AND seq_hash IN (%s)' %
+                    ','.join('?' * len(chunk)),
+                    [self.ref_version] + chunk
+                )
+                for seq_hash, p in rows:
+                    hash2p[seq_hash] = json.loads(p) if p is not None else None
+        return hash2p
+
+
+####################################################################################################
+####################################################################################################
+    def get_meta(self):
+        '''
+        Return (tree, fields) or None
+        '''
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT tree, fields FROM jplace_meta WHERE ref_version = ?', [self.ref_version]
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+
+####################################################################################################
+####################################################################################################
+    def insert(self, hash2p: dict, tree, fields):
+        '''
+        Fails if `tree` differs from the one already cached for this reference version
+        '''
+        meta = self.get_meta()
+        if meta is not None and (meta[0] != tree or meta[1] != fields):
+            raise Exception(
+                'Placement reference tree differs from cached one for reference version `%s`. '
+                'Cached placements cannot be merged with new ones' % self.ref_version
+            )
+
+        with self._connect() as conn:
+            if meta is None:
+                conn.execute(
+                    'INSERT OR REPLACE INTO jplace_meta VALUES (?, ?, ?)',
+                    [self.ref_version, tree, json.dumps(fields)]
+                )
+            conn.executemany(
+                'INSERT OR REPLACE INTO placement VALUES (?, ?, ?)',
+                [
+                    (seq_hash, self.ref_version, json.dumps(p) if p is not None else None)
+                    for seq_hash, p in hash2p.items()
+                ]
+            )
+
+
+
+####################################################################################################
+####################################################################################################
+def get_placement_cache() -> PlacementCache:
+    return PlacementCache(
+        os.path.join(Var.shared_folder, Var.placement_cache_flnm),
+        ref_version=Var.picrust2_version,
+    )
+
+
+####################################################################################################
+####################################################################################################
+def stage_novel(seq_flpth, novel_seq_flpth, cache) -> int:
+    '''
+    Write sequences not in `cache` to `novel_seq_flpth`,
+    one per distinct sequence and named by hash
+    so the new placements can be stored directly
+
+    Return number of novel sequences
+    '''
+    id_seq_l = read_fasta(seq_flpth)
+    hash2seq = {hash_seq(seq): seq for _, seq in id_seq_l}
+
+    hash2p = cache.lookup(list(hash2seq))
+    novel_l = [(seq_hash, seq) for seq_hash, seq in hash2seq.items() if seq_hash not in hash2p]
+
+    logging.info(
+        'Placement cache has %d/%d distinct sequences, %d novel to place' % (
+            len(hash2p), len(hash2seq), len(novel_l))
+    )
+
+    write_fasta(novel_l, novel_seq_flpth)
+
+    return len(novel_l)
+
+
+####################################################################################################
+####################################################################################################
+def shard_fasta(seq_flpth, shard_flpth_l):
+    '''
+    Split sequences across `shard_flpth_l`, balanced by total sequence length,
+    i.e., longest first into the currently smallest shard
+    '''
+    id_seq_l = sorted(read_fasta(seq_flpth), key=lambda id_seq: len(id_seq[1]), reverse=True)
+
+    shard_l = [[] for _ in shard_flpth_l]
+    size_l = [0] * len(shard_flpth_l)
+    for id, seq in id_seq_l:
+        i = size_l.index(min(size_l))
+        shard_l[i].append((id, seq))
+        size_l[i] += len(seq)
+
+    for shard, flpth in zip(shard_l, shard_flpth_l):
+        write_fasta(shard, flpth)
+
+    logging.info(
+        'Split %d sequences into %d shards of %s sequences' % (
+            len(id_seq_l), len(shard_l), [len(shard) for shard in shard_l])
+    )
+
+
+####################################################################################################
+####################################################################################################
+def find_jplace(intermediate_dir):
+    '''
+    place_seqs.py's epa-ng result in its `--intermediate` dir
+    '''
+    flpth_l = sorted(glob.glob(os.path.join(intermediate_dir, '**', '*.jplace'), recursive=True))
+    for flpth in flpth_l:
+        if os.path.basename(flpth) == 'epa_result.jplace':
+            return flpth
+    if flpth_l:
+        return flpth_l[0]
+    raise Exception('No jplace found in `%s`' % intermediate_dir)
+
+
+####################################################################################################
+####################################################################################################
+def merge_placements(seq_flpth, novel_seq_flpth, intermediate_dir_l, merged_jplace_flpth, cache):
+    '''
+    Store the novel sequences' placements, including drops, in `cache`
+    Then write jplace for all study sequences, named by their amplicon ids,
+    from cached placements
+
+    `intermediate_dir_l` - place_seqs.py's `--intermediate` dirs, one per shard,
+                           empty if there were no novel sequences
+    '''
+
+    ##
+    ## cache novel
+
+    if intermediate_dir_l:
+        hash2p = {seq_hash: None for seq_hash, _ in read_fasta(novel_seq_flpth)} # default dropped
+
+        tree = fields = None
+        for intermediate_dir in intermediate_dir_l:
+            with open(find_jplace(intermediate_dir)) as fh:
+                jplace = json.load(fh)
+
+            if tree is not None and (jplace['tree'] != tree or jplace['fields'] != fields):
+                raise Exception('Placement shards differ in reference tree and cannot be merged')
+            tree, fields = jplace['tree'], jplace['fields']
+
+            for placement in jplace['placements']:
+                name_l = (
+                    placement['n'] if 'n' in placement else
+                    [name for name, _ in placement['nm']]
+                )
+                for name in name_l:
+                    hash2p[name] = placement['p']
+
+        cache.insert(hash2p, tree, fields)
+
+        logging.info(
+            'Cached placements for %d novel sequences, %d of which were dropped' % (
+                len(hash2p), len([p for p in hash2p.values() if p is None]))
+        )
+
+    ##
+    ## merge all
+
+    id_seq_l = read_fasta(seq_flpth)
+    id2hash = {id: hash_seq(seq) for id, seq in id_seq_l}
+    hash2p = cache.lookup(list(id2hash.values()))
+
+    missing = sorted(set(id2hash.values()) - set(hash2p))
+    if missing:
+        raise Exception('Placements missing from cache for %d sequences' % len(missing))
+
+    placement_l = [
+        {'p': hash2p[seq_hash], 'n': [id]}
+        for id, seq_hash in id2hash.items()
+        if hash2p[seq_hash] is not None
+    ]
+
+    if not placement_l:
+        raise Exception('None of the %d study sequences could be placed' % len(id2hash))
+
+    tree, fields = cache.get_meta()
+
+    logging.info('Merged %d placements for %d study sequences' % (len(placement_l), len(id2hash)))
+
+    with open(merged_jplace_flpth, 'w') as fh:
+        json.dump({
+            'tree': tree,
+            'placements': placement_l,
+            'fields': fields,
+            'version': JPLACE_VERSION,
+            'metadata': {'invocation': 'kb_PICRUSt2 placement cache merge'},
+        }, fh)
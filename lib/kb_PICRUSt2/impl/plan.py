@@ -0,0 +1,138 @@
+import logging
+import json
+import math
+
+from .config import Var
+from ..util.resource import get_num_cores, get_mem_bytes, GB
+from ..util.debug import dprint
+
+
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+class ResourcePlan:
+    '''
+    Decide process counts per stage from the node's cores/memory
+    so that stages running at the same time don't oversubscribe
+
+    * Pathway inference is a single wide stage, so it gets all cores
+    * Placement is split into shards of novel sequences, see `plan_place`
+    * The `hsp.py` runs (16S, EC, KO, optional functions) run alongside each other,
+      so cores are split between as many of them as fit in memory
+    '''
+
+####################################################################################################
+####################################################################################################
+    def __init__(self, num_hsp, ncores=None, mem=None, share=1):
+        '''
+        `num_hsp` - number of hsp.py runs that could go at once
+        `ncores`, `mem` - override detection (mostly for testing)
+        `share` - number of runs side by side on the node (batch), each getting an even split
+        '''
+        self.ncores = ncores if ncores is not None else get_num_cores()
+        self.mem = mem if mem is not None else get_mem_bytes()
+
+        # app config can only shrink what's detected
+        if Var.max_cores is not None:
+            self.ncores = min(self.ncores, Var.max_cores)
+        if Var.max_mem_gb is not None:
+            self.mem = min(self.mem, Var.max_mem_gb * GB) if self.mem is not None else Var.max_mem_gb * GB
+
+        self.ncores = max(1, self.ncores // share)
+        self.mem = self.mem // share if self.mem is not None else None
+
+        self.p_pathway = self.ncores
+        self.plan_place(0)
+
+        # how many hsp.py can run at once
+        num_concurrent_hsp = min(num_hsp, self.ncores)
+        if self.mem is not None:
+            num_concurrent_hsp = min(num_concurrent_hsp, int(self.mem // (Var.stage_mem_gb.hsp * GB)))
+        self.num_concurrent_hsp = max(1, num_concurrent_hsp) if num_hsp else 0
+
+        self.p_hsp = max(1, self.ncores // max(1, self.num_concurrent_hsp))
+
+        logging.info('Resource plan: %s' % json.dumps(self.to_dict()))
+
+
+####################################################################################################
+####################################################################################################
+    def plan_place(self, num_seqs):
+        '''
+        Split `num_seqs` novel sequences into shards for place_seqs.py
+
+        As many shards run at once as fit in cores and memory,
+        and shards are as even as possible over those slots,
+        but no smaller than `place_shard.min_seqs` (per-run reference overhead)
+        and no larger than fits a slot's share of memory
+        '''
+        cfg = Var.place_shard
+        base_mem = Var.stage_mem_gb.place * GB
+        mem_per_seq = cfg.mem_gb_per_kseq * GB / 1000
+
+        num_concurrent = self.ncores
+        if self.mem is not None:
+            num_concurrent = min(num_concurrent, int(self.mem // (base_mem + mem_per_seq * cfg.min_seqs)))
+        num_concurrent = max(1, num_concurrent)
+
+        shard_size = max(cfg.min_seqs, math.ceil(num_seqs / num_concurrent))
+        if self.mem is not None:
+            shard_size = min(shard_size, max(cfg.min_seqs, int((self.mem / num_concurrent - base_mem) / mem_per_seq)))
+
+        self.num_place_shards = math.ceil(num_seqs / shard_size)
+        self.place_shard_size = shard_size
+        self.num_concurrent_place = max(1, min(num_concurrent, self.num_place_shards))
+        self.p_place = max(1, self.ncores // self.num_concurrent_place)
+        self.place_mem = int(base_mem + mem_per_seq * min(shard_size, num_seqs))
+
+        if num_seqs:
+            logging.info(
+                'Placement plan: %d novel sequences in %d shards of up to %d, %d at once with %d cores each' % (
+                    num_seqs, self.num_place_shards, shard_size, self.num_concurrent_place, self.p_place)
+            )
+
+
+####################################################################################################
+####################################################################################################
+    def to_dict(self) -> dict:
+        return dict(
+            ncores=self.ncores,
+            mem_gb=round(self.mem / GB, 2) if self.mem is not None else None,
+            p_place=self.p_place,
+            num_place_shards=self.num_place_shards,
+            place_shard_size=self.place_shard_size,
+            num_concurrent_place=self.num_concurrent_place,
+            p_hsp=self.p_hsp,
+            p_pathway=self.p_pathway,
+            num_concurrent_hsp=self.num_concurrent_hsp,
+        )
+
+
+####################################################################################################
+####################################################################################################
+    def __repr__(self) -> str:
+        return 'ResourcePlan(%s)' % json.dumps(self.to_dict())
+
+
+####################################################################################################
+####################################################################################################
+def get_num_concurrent_runs(num_runs, ncores=None, mem=None) -> int:
+    '''
+    How many whole PICRUSt2 runs (e.g., matrices in a batch) to do side by side,
+    such that each still gets `batch_min_cores` and enough memory to place
+    '''
+    ncores = ncores if ncores is not None else get_num_cores()
+    mem = mem if mem is not None else get_mem_bytes()
+
+    if Var.max_cores is not None:
+        ncores = min(ncores, Var.max_cores)
+    if Var.max_mem_gb is not None:
+        mem = min(mem, Var.max_mem_gb * GB) if mem is not None else Var.max_mem_gb * GB
+
+    num_concurrent = min(num_runs, ncores // Var.batch_min_cores)
+    if mem is not None:
+        num_concurrent = min(num_concurrent, int(mem // (Var.stage_mem_gb.place * GB)))
+
+    return max(1, num_concurrent)
@@ -0,0 +1,260 @@
+import os
+import re
+import json
+import shutil
+import logging
+
+from .config import Var
+from ..util.resource import GB
+from ..util.debug import dprint
+
+
+
+####################################################################################################
+####################################################################################################
+def get_seq_stats(seq_flpth) -> tuple:
+    '''
+    Number of sequences and total length in FASTA
+    '''
+    num_seqs = 0
+    total_len = 0
+    with open(seq_flpth) as fh:
+        for line in fh:
+            if line.startswith('>'):
+                num_seqs += 1
+            else:
+                total_len += len(line.strip())
+    return num_seqs, total_len
+
+
+####################################################################################################
+####################################################################################################
+def load_calibration(flpth=None) -> dict:
+    with open(flpth or Var.preflight_calibration_flpth) as fh:
+        return json.load(fh)
+
+
+####################################################################################################
+####################################################################################################
+def estimate(num_seqs, num_samples, total_seq_len, FUNC_l, contrib_num_samples, ncores, calib) -> dict:
+    '''
+    Rough CPU time, wall time, peak memory and scratch disk of a run from the calibration table
+
+    Placement peak memory is for the smallest shard, since `ResourcePlan` shards to fit memory
+    Wall time assumes everything but the in-process metagenome stage spreads over `ncores`
+    `contrib_num_samples` - samples to compute per-sequence contributions for, 0 for none
+    '''
+    kseq = num_seqs / 1e3
+    kbp = total_seq_len / 1e3
+    num_features = calib['num_features']
+
+    cfg = calib['place']
+    place = dict(
+        cpu_s=cfg['cpu_s_per_kbp'] * kbp,
+        mem_bytes=(cfg['mem_gb_base'] + cfg['mem_gb_per_kseq'] * min(kseq, Var.place_shard.min_seqs / 1e3)) * GB,
+        disk_bytes=cfg['disk_bytes_per_kbp'] * kbp,
+    )
+
+    cfg = calib['hsp']
+    hsp = dict(
+        cpu_s=sum(cfg['cpu_s_per_kseq'][FUNC] * kseq for FUNC in FUNC_l),
+        mem_bytes=cfg['mem_gb'] * GB,
+        disk_bytes=sum(cfg['disk_bytes_per_cell'] * num_seqs * num_features[FUNC] for FUNC in FUNC_l),
+    )
+
+    cfg = calib['metagenome']
+    metagenome = dict(
+        cpu_s=sum(cfg['cpu_s_per_gcell'] * num_seqs * num_samples * num_features[FUNC] / 1e9 for FUNC in FUNC_l),
+        mem_bytes=(
+            cfg['mem_gb_base'] * GB +
+            cfg['mem_bytes_per_cell'] * num_seqs * max(num_features[FUNC] for FUNC in FUNC_l)
+        ),
+        disk_bytes=0,
+    )
+
+    cfg = calib['pathways']
+    pathways = dict(
+        cpu_s=cfg['cpu_s_per_sample'] * num_samples,
+        mem_bytes=cfg['mem_gb'] * GB,
+        disk_bytes=0,
+    )
+
+    by_stage = dict(place=place, hsp=hsp, metagenome=metagenome, pathways=pathways)
+
+    if contrib_num_samples:
+        cfg = calib['contrib']
+        by_stage['contrib'] = dict(
+            cpu_s=cfg['cpu_s_per_mcell'] * num_seqs * contrib_num_samples / 1e6,
+            mem_bytes=cfg['mem_bytes_per_cell'] * num_seqs * contrib_num_samples,
+            disk_bytes=cfg['disk_bytes_per_cell'] * num_seqs * contrib_num_samples,
+        )
+
+    cpu_s = sum(est['cpu_s'] for est in by_stage.values())
+    wall_s = metagenome['cpu_s'] + (cpu_s - metagenome['cpu_s']) / max(1, ncores)
+
+    return dict(
+        cpu_s=round(cpu_s, 1),
+        wall_s=round(wall_s, 1),
+        peak_mem_bytes=int(max(est['mem_bytes'] for est in by_stage.values())),
+        scratch_bytes=int(sum(est['disk_bytes'] for est in by_stage.values())),
+        by_stage={
+            stage: {k: round(v, 1) for k, v in est.items()}
+            for stage, est in by_stage.items()
+        },
+    )
+
+
+####################################################################################################
+####################################################################################################
+def _get_shortfalls(est, mem, disk_free) -> list:
+    '''
+    Human-readable reasons the estimate doesn't fit
+    '''
+    shortfall_l = []
+    if mem is not None and est['peak_mem_bytes'] > mem:
+        shortfall_l.append('~%.1fGB peak memory, but %.1fGB available' % (est['peak_mem_bytes'] / GB, mem / GB))
+    if disk_free is not None and est['scratch_bytes'] * Var.preflight_disk_headroom > disk_free:
+        shortfall_l.append(
+            '~%.1fGB scratch disk, but %.1fGB free' % (est['scratch_bytes'] / GB, disk_free / GB))
+    if est['wall_s'] > Var.preflight_max_wall_h * 3600:
+        shortfall_l.append(
+            '~%.1fh, but jobs are limited to %dh' % (est['wall_s'] / 3600, Var.preflight_max_wall_h))
+    return shortfall_l
+
+
+####################################################################################################
+####################################################################################################
+def preflight(num_seqs, num_samples, total_seq_len, FUNC_l, params, plan, scratch_dir, calib=None, mode=None):
+    '''
+    Estimate the run on this node before doing anything expensive, and log it,
+    with what looks like it won't fit
+
+    Only logged, since the calibration table is unmeasured placeholders until refreshed from a benchmark run,
+    and threads and placement sharding are already sized to the node by `plan`
+
+    `mode` - 'log', or 'off' to skip
+    Return dict of dims, estimate, and shortfalls
+    '''
+    mode = mode or Var.preflight
+    per_sequence_contrib = bool(params.getd('per_sequence_contrib'))
+    contrib_num_samples = (len(params.getd('contrib_samples')) or num_samples) if per_sequence_contrib else 0
+    dims = dict(
+        num_seqs=num_seqs,
+        num_samples=num_samples,
+        total_seq_len=total_seq_len,
+        FUNC_l=FUNC_l,
+        contrib_num_samples=contrib_num_samples,
+        full_contrib=params.has_full_contrib(), # in the `pathways` stage rather than its own
+    )
+    if mode == 'off':
+        return dict(dims=dims, estimate=None, shortfalls=[])
+
+    calib = calib or load_calibration()
+    disk_free = shutil.disk_usage(scratch_dir).free
+
+    est = estimate(num_seqs, num_samples, total_seq_len, FUNC_l, contrib_num_samples, plan.ncores, calib)
+    logging.info('Preflight estimate%s: %s' % (
+        '' if calib.get('measured') else ' from unmeasured calibration', json.dumps(est)))
+
+    shortfall_l = _get_shortfalls(est, plan.mem, disk_free)
+    if shortfall_l:
+        logging.warning('Preflight estimates this job needs %s' % '; '.join(shortfall_l))
+
+    return dict(
+        dims=dims,
+        estimate=est,
+        shortfalls=shortfall_l,
+    )
+
+
+####################################################################################################
+####################################################################################################
+def refresh_calibration(return_dir, calib_flpth=None) -> dict:
+    '''
+    Refit the calibration table's time and memory coefficients from one finished run's
+    `preflight.json`, `timings.json` and `process_summary.json`, and write it back
+
+    Placement only sees sequences not in its cache, and hsp.py doesn't run for sequence sets in the HSP store,
+    so calibrate from a run on cold caches, like a benchmark
+    '''
+    calib_flpth = calib_flpth or Var.preflight_calibration_flpth
+    calib = load_calibration(calib_flpth)
+
+    def load(flnm):
+        with open(os.path.join(return_dir, flnm)) as fh:
+            return json.load(fh)
+
+    dims = load('preflight.json')['dims']
+    span_l = load('timings.json')['spans']
+    stage_2_summary = load('process_summary.json')
+
+    kseq = dims['num_seqs'] / 1e3
+    kbp = dims['total_seq_len'] / 1e3
+    num_samples = dims['num_samples']
+
+    # by stage name regex
+    # from each cmd stage's own sampled process tree.
+    # the in-process metagenome stage isn't sampled, so from its span's CPU of the thread running it
+    def get_cpu_s(stage_re):
+        cpu_s_l = [
+            summary['cpu_s'] for stage, summary in stage_2_summary.items()
+            if re.fullmatch(stage_re, stage)
+        ]
+        if cpu_s_l:
+            return sum(cpu_s_l)
+        return sum(
+            span['cpu_s'] for span in span_l
+            if re.fullmatch('stage:' + stage_re, span['name'])
+        )
+
+    def get_peak_gb(stage_re):
+        return max(
+            [
+                summary['peak_tree_rss_bytes'] for stage, summary in stage_2_summary.items()
+                if re.fullmatch(stage_re, stage)
+            ],
+            default=0,
+        ) / GB
+
+    if kbp and get_cpu_s(r'place_\d+'):
+        calib['place']['cpu_s_per_kbp'] = round(get_cpu_s(r'place_\d+') / kbp, 4)
+
+    for FUNC in dims['FUNC_l']:
+        if kseq and get_cpu_s('hsp_' + FUNC):
+            calib['hsp']['cpu_s_per_kseq'][FUNC] = round(get_cpu_s('hsp_' + FUNC) / kseq, 4)
+    hsp_re = 'hsp_(%s)' % '|'.join(dims['FUNC_l'])
+    if get_peak_gb(hsp_re):
+        calib['hsp']['mem_gb'] = round(get_peak_gb(hsp_re), 2)
+
+    gcells = sum(
+        dims['num_seqs'] * num_samples * calib['num_features'][FUNC] / 1e9 for FUNC in dims['FUNC_l'])
+    if gcells and get_cpu_s('metagenome'):
+        calib['metagenome']['cpu_s_per_gcell'] = round(get_cpu_s('metagenome') / gcells, 4)
+
+    # full contributions come from the `pathways` stage,
+    # so are what it took beyond the pathway coefficient's share
+    contrib_stage = 'pathways' if dims.get('full_contrib') else 'pathways_contrib'
+
+    if not dims.get('full_contrib'):
+        if num_samples and get_cpu_s('pathways'):
+            calib['pathways']['cpu_s_per_sample'] = round(get_cpu_s('pathways') / num_samples, 4)
+        if get_peak_gb('pathways'):
+            calib['pathways']['mem_gb'] = round(get_peak_gb('pathways'), 2)
+
+    mcells = dims['num_seqs'] * dims['contrib_num_samples'] / 1e6
+    contrib_cpu_s = get_cpu_s(contrib_stage) - (
+        calib['pathways']['cpu_s_per_sample'] * num_samples if dims.get('full_contrib') else 0)
+    if mcells and contrib_cpu_s > 0:
+        calib['contrib']['cpu_s_per_mcell'] = round(contrib_cpu_s / mcells, 4)
+        calib['contrib']['mem_bytes_per_cell'] = round(get_peak_gb(contrib_stage) * GB / (mcells * 1e6), 1)
+
+    calib['picrust2_version'] = Var.picrust2_version
+    calib['measured'] = True
+    calib.pop('_comment', None) # placeholder note
+
+    with open(calib_flpth, 'w') as fh:
+        json.dump(calib, fh, indent=2)
+
+    logging.info('Refreshed preflight calibration `%s` from `%s`' % (calib_flpth, return_dir))
+
+    return calib
@@ -9,14 +9,23 @@ import time
 import plotly
 import plotly.graph_objects as go
 import itertools
+import json
+import gzip
+import resource
+import functools
 
 from .config import Var
 from ..util.debug import dprint
+from ..util.dag import Stage, run_stages
+from ..util.fork import fork_map
+from ..util.resource import GB, get_num_cores, get_mem_bytes
 
 REPORT_HEIGHT = 800 # px
 MAX_TOTAL_DATA = 4000
 MAX_DYN_LEN = 400
 #MAX_DYN_SIZE = MAX_DYN_LEN ** 2
+HEATMAP_MEM_BASE = 0.5 * GB # interpreter, plotly
+HEATMAP_MEM_PER_CELL = 24 # parsed float, subset and reordered copies
 
 '''
 Max matrix dim lengths, (sometimes assuming squarishness as upper bound):
@@ -103,6 +112,66 @@ def do_heatmap(tsv_fp, html_fp, axis_labels): # TODO log coloring for func x sam
 
         
 
+####################################################################################################
+####################################################################################################
+def get_tsv_shape(tsv_fp) -> tuple:
+    '''
+    Number of data rows and columns of TSV(.gz) with header and index column, without parsing it
+    '''
+    opener = gzip.open if tsv_fp.endswith('.gz') else open
+    with opener(tsv_fp, 'rb') as fh:
+        num_cols = fh.readline().count(b'\t')
+        num_rows = sum(chunk.count(b'\n') for chunk in iter(lambda: fh.read(2**20), b''))
+    return num_rows, num_cols
+
+
+####################################################################################################
+####################################################################################################
+def estimate_heatmap_mem(tsv_fp) -> int:
+    num_rows, num_cols = get_tsv_shape(tsv_fp)
+    return int(HEATMAP_MEM_BASE + HEATMAP_MEM_PER_CELL * num_rows * num_cols)
+
+
+####################################################################################################
+####################################################################################################
+def _do_heatmap_measured(args) -> dict:
+    '''
+    Runs in child started from the fork server, so needs nothing of the parent beyond its args
+    Doesn't log, since the child's logging isn't configured
+    '''
+    t0 = time.time()
+    do_heatmap(*args)
+    return dict(
+        wall_s=time.time() - t0,
+        peak_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, # KiB on linux
+    )
+
+
+####################################################################################################
+####################################################################################################
+def render_heatmap(fig_id, tsv_fp, html_fp, axis_labels, mem=None):
+    '''
+    `do_heatmap` in a child process, so figures can render on separate cores,
+    and each figure's memory goes back to the OS when it's done
+    Started from the fork server, since this runs in a scheduler thread while other stages' threads are alive
+
+    `mem` - estimated peak memory, logged against the actual
+    '''
+    res = fork_map(
+        _do_heatmap_measured, [(tsv_fp, html_fp, axis_labels)], num_workers=1, start_method='forkserver')[0]
+
+    logging.info('Heatmap `%s` took %.2fs with peak RSS %.2fGB%s' % (
+        fig_id, 
+        res['wall_s'], 
+        res['peak_rss_bytes'] / GB,
+        ' (estimated %.2fGB)' % (mem / GB) if mem is not None else '',
+    ))
+
+    if mem is not None and res['peak_rss_bytes'] > mem:
+        logging.warning(
+            'Heatmap `%s` peaked over its memory estimate. Consider raising `HEATMAP_MEM_PER_CELL`' % fig_id)
+
+
 ####################################################################################################
 ####################################################################################################
 ####################################################################################################
@@ -115,14 +184,17 @@ class HTMLReportWriter:
 
 ####################################################################################################
 ####################################################################################################
-    def __init__(self, cmd_l): 
+    def __init__(self, cmd_l, pending=None): 
         '''
+        `pending` - blocks on work still running, e.g., background uploads,
+                    called before the performance tab so it has them
         '''
 
         self.replacement_d = {}
 
         #
         self.cmd_l = cmd_l
+        self.pending = pending
 
         if not os.path.exists(Var.report_dir):
             os.mkdir(Var.report_dir)
@@ -147,16 +219,100 @@ class HTMLReportWriter:
 
 ####################################################################################################
 ####################################################################################################
-    def _compile_figures(self):
+    def _compile_resources(self):
+        '''
+        Resource plan decided at runtime, for auditing
+        '''
 
+        if 'resource_plan' not in Var:
+            self.replacement_d['RESOURCES_TAG'] = '<p>No resource plan recorded</p>'
+            return
 
+        txt = (
+            '<p class="fixwhitespace">\n'
+            '<code>' + json.dumps(Var.resource_plan.to_dict(), indent=4) + '</code>\n'
+            '</p>\n'
+        )
 
-        button_l = []
-        content_l = []
+        self.replacement_d['RESOURCES_TAG'] = txt
+
+
+####################################################################################################
+####################################################################################################
+    def _compile_performance(self):
+        '''
+        Timing/resource spans recorded so far,
+        with each cmd stage's CPU, peak RSS and IO from sampling its own process tree,
+        since its span's thread only waits on it
+        '''
+
+        if 'spans' not in Var:
+            self.replacement_d['PERFORMANCE_TAG'] = '<p>No timings recorded</p>'
+            return
+
+        rec_l = Var.spans.to_list()
+
+        stage_2_summary = {}
+        if 'return_dir' in Var and os.path.exists(os.path.join(Var.return_dir, 'process_summary.json')):
+            with open(os.path.join(Var.return_dir, 'process_summary.json')) as fh:
+                stage_2_summary = json.load(fh)
+
+        def get(rec, key):
+            '''
+            From the cmd stage's sampled process tree, if it is one, otherwise the span's
+            '''
+            summary = (
+                stage_2_summary.get(rec['name'][len('stage:'):]) if rec['name'].startswith('stage:') else None)
+            if summary is not None:
+                return summary.get(key)
+            return rec.get(key)
+
+        fmt_bytes = lambda b: '' if b is None else '%.1f MB' % (b / 1024**2)
+
+        row_l = [
+            '<tr>' + ''.join('<td>%s</td>' % cell for cell in [
+                rec['name'],
+                rec['parent'] or '',
+                '%.1f' % rec['start_s'],
+                '%.2f' % rec['wall_s'],
+                '%.2f' % get(rec, 'cpu_s'),
+                fmt_bytes(get(rec, 'peak_tree_rss_bytes')),
+                fmt_bytes(get(rec, 'read_bytes')),
+                fmt_bytes(get(rec, 'write_bytes')),
+                '' if rec['ok'] else 'failed',
+            ]) + '</tr>'
+            for rec in rec_l
+        ]
+
+        txt = (
+            '<table class="performance">\n'
+            '<tr>' + ''.join('<th>%s</th>' % col for col in [
+                'Span', 'Parent', 'Start (s)', 'Wall (s)', 'CPU (s)',
+                'Stage peak RSS', 'Read', 'Written', '',
+            ]) + '</tr>\n' +
+            '\n'.join(row_l) + '\n'
+            '</table>\n'
+        )
+
+        self.replacement_d['PERFORMANCE_TAG'] = txt
+
+
+####################################################################################################
+####################################################################################################
+    def _compile_figures(self):
+        '''
+        Heatmaps render in forked processes, as many at a time as fit in the cores and memory,
+        each clamped to run alone if its estimated memory is more than available
+        Buttons/tabs stay in `Var.func_l` order
+        '''
+
+        fig_l = []
         for per in ['amplicon', 'metagenome']:
             for func in Var.func_l:
                 if not Var.params.getd(func):
                     continue
+                if per == 'amplicon' and not Var.params.has_amplicon_output(func):
+                    continue
 
 
                 fig_id = per + '_' + func
@@ -172,25 +328,45 @@ class HTMLReportWriter:
                     (func_name, 'Sample')
                 )
 
-                do_heatmap(tsv_fp, html_fp, axis_labels)
+                fig_l.append((fig_id, fig_title, tsv_fp, html_fp, axis_labels))
+
+        stage_l = []
+        for fig_id, _, tsv_fp, html_fp, axis_labels in fig_l:
+            mem = estimate_heatmap_mem(tsv_fp)
+            stage_l.append(Stage(
+                'heatmap_' + fig_id,
+                functools.partial(render_heatmap, fig_id, tsv_fp, html_fp, axis_labels, mem=mem),
+                mem=mem,
+            ))
+
+        plan = Var.resource_plan if 'resource_plan' in Var else None
+        run_stages(
+            stage_l,
+            max_cores=plan.ncores if plan is not None else get_num_cores(),
+            max_mem=plan.mem if plan is not None else get_mem_bytes(),
+            spans=Var.spans if 'spans' in Var else None,
+        )
 
-                button_l.append(
-                    '''<button class="tablinks %s" onclick="openTab(event, '%s')">%s</button>'''  
-                    % (
-                        'active' if fig_id == 'metagenome_metacyc' else '',
-                        fig_id, 
-                        fig_title,
-                    ) 
-                )
+        button_l = []
+        content_l = []
+        for fig_id, fig_title, _, html_fp, _ in fig_l:
+            button_l.append(
+                '''<button class="tablinks %s" onclick="openTab(event, '%s')">%s</button>'''  
+                % (
+                    'active' if fig_id == 'metagenome_metacyc' else '',
+                    fig_id, 
+                    fig_title,
+                ) 
+            )
 
-                content_l.append(
-                    '<div id="%s" class="tabcontent" %s>\n' % (
-                        fig_id,
-                        ('style="display:inline-flex;"' if fig_id == 'metagenome_metacyc' else ''),
-                    ) +
-                    '<iframe src="%s" scrolling="no" seamless="seamless"></iframe>\n' % os.path.basename(html_fp) +
-                    '</div>\n'
-                )
+            content_l.append(
+                '<div id="%s" class="tabcontent" %s>\n' % (
+                    fig_id,
+                    ('style="display:inline-flex;"' if fig_id == 'metagenome_metacyc' else ''),
+                ) +
+                '<iframe src="%s" scrolling="no" seamless="seamless"></iframe>\n' % os.path.basename(html_fp) +
+                '</div>\n'
+            )
 
         self.replacement_d['HEATMAP_BUTTON_TAG'] = '\n'.join(button_l)
         self.replacement_d['HEATMAP_CONTENT_TAG'] = '\n'.join(content_l)
@@ -200,7 +376,11 @@ class HTMLReportWriter:
 ####################################################################################################
     def write(self):
         self._compile_cmd()
+        self._compile_resources()
         self._compile_figures() # TODO stress test heatmaps
+        if self.pending is not None:
+            self.pending()
+        self._compile_performance()
 
         
         REPORT_HTML_TEMPLATE_FLPTH = '/kb/module/lib/kb_PICRUSt2/template/report.html'
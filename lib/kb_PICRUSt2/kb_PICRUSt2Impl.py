@@ -16,15 +16,31 @@ from installed_clients.KBaseReportClient import KBaseReport
 from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.FunctionalProfileUtilClient import FunctionalProfileUtil
 from installed_clients.GenericsAPIClient import GenericsAPI
+from installed_clients.WorkspaceClient import Workspace
 
 from .impl.kbase_obj import AmpliconMatrix, AttributeMapping
 from .impl import appfile
 from .impl.config import Var, reset_Var
 from .impl import report
+from .impl import placement
+from .impl import hsp
+from .impl import metagenome
+from .impl import contrib
+from .impl import preflight
+from .impl import dedup
 from .impl.params import Params
+from .impl.plan import ResourcePlan, get_num_concurrent_runs
 from .util.debug import dprint
-from .util.cli import run_check, gunzip
-from .util.file import gunzip_out
+from .util.cli import run_check, gunzip, forward_signals
+from .util.dag import Stage, run_stages, run_func
+from .util.fork import fork_map
+from .util.span import SpanRecorder
+from .util.background import IOPool
+from .util.sampler import collect_summaries
+from .util.checkpoint import Checkpoint, hash_inputs
+from .util.cache import ResultCache
+from .util.resource import GB
+from .util.file import gunzip_out, lock_dir
 
 
 #END_HEADER
@@ -50,41 +66,26 @@ class kb_PICRUSt2:
     GIT_COMMIT_HASH = ""
 
     #BEGIN_CLASS_HEADER
-    #END_CLASS_HEADER
-
-    # config contains contents of config file in a hash or None if it couldn't
-    # be found
-    def __init__(self, config):
-        #BEGIN_CONSTRUCTOR
-        logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
-                            level=logging.INFO)
-
-        self.callback_url = os.environ['SDK_CALLBACK_URL']
-        self.workspace_url = config['workspace-url']
-        self.shared_folder = config['scratch']
-       
-        
-        #END_CONSTRUCTOR
-        pass
+    def _get_clients(self, ctx) -> dict:
+        '''
+        Made once per API-method call, and shared by all matrices in a batch
+        '''
+        return dict(
+            ws=Workspace(self.workspace_url, token=ctx['token']), # for fetching parts of objects
+            dfu=DataFileUtil(self.callback_url),
+            kbr=KBaseReport(self.callback_url),
+            fpu=FunctionalProfileUtil(self.callback_url, service_ver='dev'),
+            gapi=GenericsAPI(self.callback_url, service_ver='dev'),
+        )
 
 
-    def run_picrust2_pipeline(self, ctx, params):
-        """
-        This example function accepts any number of parameters and returns results in a KBaseReport
-        :param params: instance of mapping from String to unspecified object
-        :returns: instance of type "ReportResults" -> structure: parameter
-           "report_name" of String, parameter "report_ref" of String
-        """
-        # ctx is the context object
-        # return Variables are: output
-        #BEGIN run_picrust2_pipeline
-####################################################################################################
-####################################################################################################
-####################################################################################################
-####################################################################################################
-####################################################################################################
+    def _run_picrust2(self, params, clients, share=1) -> dict:
+        '''
+        Run PICRUSt2 on one AmpliconMatrix, save objects, and write its html report and return files
+        Return what's needed to make the KBaseReport
 
-        logging.info(params)
+        `share` - number of these running side by side on this node, which split its cores/memory
+        '''
 
         #
         ##
@@ -102,310 +103,781 @@ class kb_PICRUSt2:
 
         Var.update(
             params=params,
-            dfu=DataFileUtil(self.callback_url),
-            kbr=KBaseReport(self.callback_url),
-            fpu=FunctionalProfileUtil(self.callback_url, service_ver='dev'),
-            gapi=GenericsAPI(self.callback_url, service_ver='dev'),
+            **clients,
             shared_folder=self.shared_folder,
-            run_dir=os.path.join(self.shared_folder, 'run_dir_picrust2_' + str(uuid.uuid4())),
+            # same params land in same `run_dir` so finished stages can be resumed from
+            run_dir=os.path.join(
+                self.shared_folder, 
+                'run_dir_picrust2_' + hash_inputs(str_l=[json.dumps(params.params, sort_keys=True)])[:16]
+            ),
             warnings=[],
             objects_created=[],
+            spans=SpanRecorder(), # timing/resources of each part, for `timings.json` and report
         )
 
-        os.mkdir(Var.run_dir) # for this API-method run
+        spans = Var.spans
 
-        Var.update(
-            return_dir=os.path.join(Var.run_dir, 'return'),
-        )
+        # so a cancelled job takes its running tools with it
+        forward_signals()
 
-        os.mkdir(Var.return_dir) # for return input/output/logs etc.
+        os.makedirs(Var.run_dir, exist_ok=True) # for this API-method run, or resuming one
 
-        if Var.debug:
-            with open(os.path.join(Var.run_dir, '#params'), 'w') as fh:
-                json.dump(params.params, fh)
-    
-        # TODO document `run_dir` structure
+        # held for the whole run, so only a `run_dir` whose job has exited is resumed from.
+        # a job with the same params still running in it gets this one its own
+        run_dir_lock = lock_dir(Var.run_dir)
+        if run_dir_lock is None:
+            logging.warning('Run dir %s is in use by another job, so not resuming from it' % Var.run_dir)
+            Var.run_dir += '_' + str(uuid.uuid4())
+            os.makedirs(Var.run_dir)
+            run_dir_lock = lock_dir(Var.run_dir)
 
-        #
-        ##
-        ### obj
-        ####
-        #####
+        # network-bound client calls run in the background, alongside compute,
+        # wherever what comes next doesn't need their results yet
+        with run_dir_lock, IOPool(max_workers=Var.io_workers, spans=spans) as io_pool: # cancels what hasn't started on failure
 
+            Var.update(
+                return_dir=os.path.join(Var.run_dir, 'return'),
+            )
 
-        # instantiate
+            os.makedirs(Var.return_dir, exist_ok=True) # for return input/output/logs etc.
 
-        amp_mat = AmpliconMatrix(params['amplicon_matrix_upa']) 
-        if 'row_attributemapping_ref' in amp_mat.obj:
-            row_attrmap = AttributeMapping(amp_mat.obj['row_attributemapping_ref'], amp_mat)
-        else:
-            msg = (
-                "Input AmpliconMatrix "
-                "does not have a row AttributeMapping to assign PICRUSt2 functions to."
-            )
-            logging.warning(msg)
-            Var.warnings.append(msg)
+            if Var.debug:
+                with open(os.path.join(Var.run_dir, '#params'), 'w') as fh:
+                    json.dump(params.params, fh)
+        
+            # TODO document `run_dir` structure
 
+            #
+            ##
+            ### obj
+            ####
+            #####
 
 
-        # validate input data
+            # instantiate
+            # only ids and refs at first, so the FASTA and the row AttributeMapping
+            # are fetched while the values are, and while validating and planning.
+            # the row AttributeMapping is only loaded to save it with MetaCyc traits
 
-        amp_mat.validate_amplicon_abundance_data()
+            with spans.span('load_objects'):
+                amp_mat = AmpliconMatrix(params['amplicon_matrix_upa']) 
 
+            io_pool.submit('fetch_fasta', Var.gapi.fetch_sequence, amp_mat.upa)
+            if amp_mat.row_attrmap_upa is not None and params.has_full_contrib():
+                io_pool.submit('load_row_attrmap', AttributeMapping, amp_mat.row_attrmap_upa, amp_mat)
 
-        # generate input files
-        
-        seq_flpth = os.path.join(Var.return_dir, 'study_seqs.fna')
-        seq_abundance_table_flpth = os.path.join(Var.return_dir, 'study_seqs.tsv') 
+            with spans.span('load_values'):
+                amp_mat.fetch_values()
 
-        amp_mat.to_fasta(seq_flpth)
-        amp_mat.to_seq_abundance_table(seq_abundance_table_flpth)
+            if amp_mat.row_attrmap_upa is None:
+                msg = (
+                    "Input AmpliconMatrix "
+                    "does not have a row AttributeMapping to assign PICRUSt2 functions to."
+                )
+                logging.warning(msg)
+                Var.warnings.append(msg)
 
 
-        # objs should be app globals
-        Var.amp_mat = amp_mat
 
+            # validate input data
 
-        #
-        ##
-        ### args
-        ####
-        #####
-        
-        # TODO get tee functionality working in run_check
-        # to avoid extra cmd
-        
-        Var.out_dir = os.path.join(Var.return_dir, 'PICRUSt2_output')
-        log_flpth = os.path.join(Var.return_dir, 'log.txt')
-        p = 4
-
-        cmd_pipeline = ' '.join([
-            'set -o pipefail &&',
-            'source activate picrust2 &&',
-            'picrust2_pipeline.py',
-            '-s', seq_flpth,
-            '-i', seq_abundance_table_flpth,
-            '-o', Var.out_dir,
-            '--per_sequence_contrib',
-            '-p', str(p),
-            '|& tee', log_flpth,
-        ])
-
-        cmd_description = ' \\\n'.join([
-            'cd %s &&' % Var.out_dir,
-            'source activate picrust2 &&',
-            'add_descriptions.py -i EC_metagenome_out/pred_metagenome_unstrat.tsv.gz -m EC',
-            '                    -o EC_metagenome_out/pred_metagenome_unstrat_descrip.tsv.gz',
-            '&&',
-            'add_descriptions.py -i KO_metagenome_out/pred_metagenome_unstrat.tsv.gz -m KO',
-            '                    -o KO_metagenome_out/pred_metagenome_unstrat_descrip.tsv.gz',
-            '&&',
-            'add_descriptions.py -i pathways_out/path_abun_unstrat.tsv.gz -m METACYC',
-            '                    -o pathways_out/path_abun_unstrat_descrip.tsv.gz'
-        ])
-
-        get_cmd_func_l = lambda FUNC:  [ 
-            (
-                'cd %s && ' % Var.out_dir +
-                'source activate picrust2 && '
-                f'hsp.py -i {FUNC} -t out.tre -o {FUNC}_predicted.tsv.gz -p {p}'
-            ),
-            (
-                'cd %s && ' % Var.out_dir +
-                'source activate picrust2 && '
-                'metagenome_pipeline.py '
-                '-i ../%s ' % os.path.basename(seq_abundance_table_flpth) +
-                '-m marker_predicted_and_nsti.tsv.gz '
-                f'-f {FUNC}_predicted.tsv.gz '
-                f'-o {FUNC}_metagenome_out'
-            )
-        ] + (
-            [] if FUNC == 'PHENO' else [ # no descriptions for IMG phenotype
-                (
-                    'cd %s && ' % Var.out_dir +
-                    'source activate picrust2 && '
-                    f'add_descriptions.py -i {FUNC}_metagenome_out/pred_metagenome_unstrat.tsv.gz -m {FUNC} '
-                                        f'-o {FUNC}_metagenome_out/pred_metagenome_unstrat_descrip.tsv.gz'
-                ),
-            ]
-        ) 
+            with spans.span('validate'):
+                amp_mat.validate_amplicon_abundance_data()
 
-        cmd_func_l = []
-        for func in ['cog', 'pfam', 'tigrfam', 'pheno']:
-            if params.getd(func) == 1:
-                cmd_func_l.extend(
-                    get_cmd_func_l(func.upper())
-                )
 
+            # optional fast mode leaving out long-tail amplicons
 
-        #
-        ##
-        ### run
-        ####
-        #####
+            with spans.span('prefilter'):
+                amp_mat.prefilter(
+                    min_total_count=params.getd('min_total_count'),
+                    min_prevalence=params.getd('min_prevalence'),
+                    top_n=params.getd('top_n'),
+                )
 
-        run_check(cmd_pipeline)
-        run_check(cmd_description)
-        for cmd_func in cmd_func_l:
-            run_check(cmd_func)
+            if amp_mat.filtered_ids:
+                msg = (
+                    '%d of %d amplicons were left out by the abundance pre-filter, '
+                    'and are dropped from results like amplicons PICRUSt2 could not place' % (
+                        len(amp_mat.filtered_ids), len(amp_mat.row_ids))
+                )
+                logging.warning(msg)
+                Var.warnings.append(msg)
 
 
-        #
-        ##
-        ### sanity checks
-        ####
-        #####
+            # generate input files
+        
+            seq_flpth = os.path.join(Var.return_dir, 'study_seqs.fna')
+            seq_abundance_table_flpth = os.path.join(Var.return_dir, 'study_seqs.tsv') 
+
+            with spans.span('write_fasta'):
+                amp_mat.to_fasta(seq_flpth, fetched_flpth=io_pool.result('fetch_fasta'))
+            with spans.span('write_seq_abundance_table'):
+                amp_mat.to_seq_abundance_table(seq_abundance_table_flpth)
+
+
+            # objs should be app globals
+            Var.amp_mat = amp_mat
+
+
+            #
+            ##
+            ### args
+            ####
+            #####
+
+            Var.out_dir = os.path.join(Var.return_dir, 'PICRUSt2_output')
+            log_flpth = os.path.join(Var.return_dir, 'log.txt')
+            open(log_flpth, 'w').close() # cmds append to it, so start it fresh on resuming
+
+            # amplicons with identical sequences only need one pass through
+            # placement and hsp.py,
+            # after which amplicon-level predictions are expanded back to all ids
+            study_seq_flpth, study_seq_abundance_table_flpth = seq_flpth, seq_abundance_table_flpth
+            dedup_dir = os.path.join(Var.run_dir, 'dedup')
+            rep_flpth = os.path.join(dedup_dir, 'rep.tsv')
+            os.makedirs(dedup_dir, exist_ok=True)
+
+            with spans.span('collapse_duplicates'):
+                num_uniq = dedup.collapse(
+                    study_seq_flpth,
+                    os.path.join(dedup_dir, 'uniq_seqs.fna'),
+                    rep_flpth,
+                )
+            is_collapsed = num_uniq < len(amp_mat.row_ids) - len(amp_mat.filtered_ids)
+            if is_collapsed:
+                seq_flpth = os.path.join(dedup_dir, 'uniq_seqs.fna')
+
+            # process counts per stage for this node
+            # hsp.py runs for 16S, EC, KO, and each optional function
+            Var.resource_plan = plan = ResourcePlan(
+                num_hsp=3 + len([func for func in ['cog', 'pfam', 'tigrfam', 'pheno'] if params.getd(func)]),
+                share=share,
+            )
 
-        if Var.debug:
-            for func in Var.func_l:
-                if not Var.params.getd(func): 
-                    continue
-                    
-                fp0 = os.path.join(Var.out_dir, Var.func_2_cfg[func]['relfp'][0])
-                fp1 = os.path.join(Var.out_dir, Var.func_2_cfg[func]['relfp'][1])
+            FUNC_l = ['16S'] + [ # EC, KO always computed, like picrust2_pipeline.py
+                func.upper() for func in ['cog', 'ec', 'ko', 'pfam', 'tigrfam', 'pheno']
+                if func in ['ec', 'ko'] or params.getd(func)
+            ]
 
-                # Check dropped amplicons are the unaligned/distant ones (debug)
-                appfile.check_dropped_amplicon_ids(fp0, amp_mat)
-                # Check no samples dropped (debug)
-                appfile.check_dropped_sample_ids(fp1, amp_mat)
+            # estimate time/memory/disk on this node before anything expensive, and log it
+            with spans.span('preflight'):
+                num_seqs, total_seq_len = preflight.get_seq_stats(seq_flpth)
+                Var.preflight_res = preflight.preflight(
+                    num_seqs,
+                    len(amp_mat.col_ids),
+                    total_seq_len,
+                    FUNC_l,
+                    params,
+                    plan,
+                    Var.run_dir,
+                )
+            with open(os.path.join(Var.return_dir, 'preflight.json'), 'w') as fh:
+                json.dump(Var.preflight_res, fh, indent=2)
+
+            # only place sequences not in the placement cache
+            # split into shards sized for this node
+            place_dir = os.path.join(Var.run_dir, 'place_seqs')
+            novel_seq_flpth = os.path.join(place_dir, 'novel_seqs.fna')
+            merged_jplace_flpth = os.path.join(place_dir, 'merged.jplace')
+            os.makedirs(place_dir, exist_ok=True)
+
+            placement_cache = placement.get_placement_cache()
+            with spans.span('stage_novel_placements'):
+                num_novel = placement.stage_novel(seq_flpth, novel_seq_flpth, placement_cache)
+
+            plan.plan_place(num_novel)
+            shard_dir_l = [
+                os.path.join(place_dir, 'shard%d' % i) for i in range(plan.num_place_shards)
+            ]
+            intermediate_dir_l = [os.path.join(shard_dir, 'intermediate') for shard_dir in shard_dir_l]
+            shard_seq_flpth_l = [os.path.join(shard_dir, 'novel_seqs.fna') for shard_dir in shard_dir_l]
+            for shard_dir in shard_dir_l:
+                os.makedirs(shard_dir, exist_ok=True)
+            if num_novel > 0:
+                with spans.span('shard_fasta'):
+                    placement.shard_fasta(novel_seq_flpth, shard_seq_flpth_l)
+
+            # the steps of `picrust2_pipeline.py`, so placement can be cached
+            # and independent steps can run alongside each other
+            get_cmd = lambda cmd, dir=Var.out_dir: (
+                'set -o pipefail && '
+                'mkdir -p %s && cd %s && ' % (dir, dir) +
+                'source activate picrust2 && ' +
+                cmd
+            )
+            # thread counts depend on the node, not the results, so are left out of checkpoint keys
+            get_key = lambda cmd, p: cmd.replace(f' -p {p}', '')
+
+            mem_gb = Var.stage_mem_gb
+
+            stage_l = []
+            for i, (shard_dir, shard_seq_flpth, intermediate_dir) in enumerate(
+                    zip(shard_dir_l, shard_seq_flpth_l, intermediate_dir_l)):
+                place_cmd = get_cmd(
+                    f'place_seqs.py -s {shard_seq_flpth} -o novel_out.tre -p {plan.p_place} '
+                    f'--intermediate {intermediate_dir}',
+                    dir=shard_dir,
+                )
+                stage_l += [
+                    Stage(
+                        'place_%d' % i,
+                        place_cmd,
+                        ncores=plan.p_place,
+                        mem=plan.place_mem,
+                        inputs=[shard_seq_flpth],
+                        key=get_key(place_cmd, plan.p_place),
+                        clean=[intermediate_dir],
+                    ),
+                ]
+
+            stage_l += [
+                Stage(
+                    'merge_placements',
+                    functools.partial(
+                        placement.merge_placements,
+                        seq_flpth, 
+                        novel_seq_flpth, 
+                        intermediate_dir_l, 
+                        merged_jplace_flpth, 
+                        placement_cache,
+                    ),
+                    deps=[stage.name for stage in stage_l],
+                    inputs=[seq_flpth, novel_seq_flpth],
+                ),
+                Stage(
+                    'graft',
+                    get_cmd(
+                        f'gappa examine graft --jplace-path {merged_jplace_flpth} --fully-resolve --out-dir {place_dir} && '
+                        f'cp {os.path.join(place_dir, "merged.newick")} out.tre'
+                    ),
+                    deps=['merge_placements'],
+                    mem=mem_gb.description * GB,
+                    inputs=[merged_jplace_flpth],
+                    clean=[os.path.join(place_dir, 'merged.newick'), os.path.join(Var.out_dir, 'out.tre')], # gappa won't overwrite
+                ),
+            ]
 
+            # hsp.py's predictions for a sequence depend on which others are grafted alongside it,
+            # so are stored per tree, i.e., per set of distinct sequences,
+            # and it only runs for functions the HSP store doesn't have for this one,
+            # e.g., when rerunning the same amplicons with other functions or options
+            hsp_dir = os.path.join(Var.run_dir, 'hsp')
+            os.makedirs(hsp_dir, exist_ok=True)
+
+            # predictions for only representatives of identical sequences are assembled aside,
+            # then expanded to all amplicon ids in `out_dir`, so no stage rewrites another's checkpointed inputs
+            pred_dir = dedup_dir if is_collapsed else Var.out_dir
+
+            hsp_store = hsp.get_hsp_store()
+            with spans.span('stage_hsp'):
+                tree_key = hsp.get_tree_key(seq_flpth)
+                hsp_FUNC_l = [FUNC for FUNC in FUNC_l if not hsp_store.has(FUNC, tree_key)]
+            logging.info('Functions needing hidden-state prediction: %s' % hsp_FUNC_l)
+
+            for FUNC in FUNC_l:
+                predicted_flpth = os.path.join(hsp_dir, f'{FUNC}_predicted.tsv.gz')
+                out_flnm = 'marker_predicted_and_nsti.tsv.gz' if FUNC == '16S' else f'{FUNC}_predicted.tsv.gz'
+                hsp_cmd = get_cmd(
+                    f'hsp.py -i {FUNC} -t out.tre -o {predicted_flpth} {"-n " if FUNC == "16S" else ""}-p {plan.p_hsp}'
+                )
 
+                stage_l += [
+                    Stage(
+                        f'hsp_{FUNC}',
+                        hsp_cmd,
+                        deps=['graft'],
+                        ncores=plan.p_hsp,
+                        mem=mem_gb.hsp * GB,
+                        inputs=[os.path.join(Var.out_dir, 'out.tre')],
+                        key=get_key(hsp_cmd, plan.p_hsp),
+                        clean=[predicted_flpth],
+                    ),
+                ] if FUNC in hsp_FUNC_l else []
+
+                stage_l += [
+                    Stage(
+                        f'store_{FUNC}',
+                        functools.partial(
+                            hsp.store_and_assemble,
+                            FUNC,
+                            seq_flpth,
+                            tree_key,
+                            hsp_store,
+                            placement_cache,
+                            os.path.join(pred_dir, out_flnm),
+                            predicted_flpth=predicted_flpth if FUNC in hsp_FUNC_l else None,
+                        ),
+                        deps=[f'hsp_{FUNC}'] if FUNC in hsp_FUNC_l else ['merge_placements'],
+                        inputs=[seq_flpth] + ([predicted_flpth] if FUNC in hsp_FUNC_l else []),
+                        mem=mem_gb.hsp * GB,
+                    ),
+                ]
+
+            # all functions' metagenomes in one in-process pass over the abundance table
+            stage_l += [
+                Stage(
+                    'metagenome',
+                    functools.partial(
+                        metagenome.predict_metagenomes,
+                        seq_abundance_table_flpth,
+                        os.path.join(pred_dir, 'marker_predicted_and_nsti.tsv.gz'),
+                        {
+                            FUNC: (
+                                os.path.join(pred_dir, f'{FUNC}_predicted.tsv.gz'),
+                                os.path.join(Var.out_dir, f'{FUNC}_metagenome_out'),
+                            )
+                            for FUNC in FUNC_l[1:]
+                        },
+                        id2rep=dedup.read_rep(rep_flpth) if is_collapsed else None,
+                    ),
+                    deps=[f'store_{FUNC}' for FUNC in FUNC_l],
+                    inputs=[seq_abundance_table_flpth, os.path.join(pred_dir, 'marker_predicted_and_nsti.tsv.gz')] + [
+                        os.path.join(pred_dir, f'{FUNC}_predicted.tsv.gz') for FUNC in FUNC_l[1:]
+                    ] + ([rep_flpth] if is_collapsed else []),
+                    mem=mem_gb.metagenome * GB,
+                ),
+            ]
 
-        #
-        ##
-        ### update/save Amplicon workflow objects 
-        ####
-        #####
+            if is_collapsed:
+                stage_l += [
+                    Stage(
+                        'expand_duplicates',
+                        functools.partial(
+                            dedup.expand_outputs,
+                            dedup_dir,
+                            Var.out_dir,
+                            FUNC_l,
+                            rep_flpth,
+                        ),
+                        deps=[f'store_{FUNC}' for FUNC in FUNC_l],
+                        inputs=[rep_flpth] + [
+                            os.path.join(pred_dir, 'marker_predicted_and_nsti.tsv.gz')
+                        ] + [
+                            os.path.join(pred_dir, f'{FUNC}_predicted.tsv.gz') for FUNC in FUNC_l[1:]
+                        ],
+                        mem=mem_gb.metagenome * GB,
+                    ),
+                ]
+
+            for FUNC in FUNC_l[1:]:
+                if FUNC == 'PHENO': # no descriptions for IMG phenotype
+                    continue
+                stage_l += [
+                    Stage(
+                        f'description_{FUNC}',
+                        get_cmd(
+                            f'add_descriptions.py -i {FUNC}_metagenome_out/pred_metagenome_unstrat.tsv.gz -m {FUNC} '
+                                                f'-o {FUNC}_metagenome_out/pred_metagenome_unstrat_descrip.tsv.gz'
+                        ),
+                        deps=['metagenome'],
+                        mem=mem_gb.description * GB,
+                        inputs=[os.path.join(Var.out_dir, f'{FUNC}_metagenome_out/pred_metagenome_unstrat.tsv.gz')],
+                    ),
+                ]
+
+            # MetaCyc pathways from EC
+            # per-sequence contributions are slow and memory hungry, so off by default.
+            # for all pathways and samples, they come from the same pathway_pipeline.py run
+            full_contrib = params.has_full_contrib()
+            pathways_cmd = get_cmd(
+                'pathway_pipeline.py '
+                '-i EC_metagenome_out/pred_metagenome_unstrat.tsv.gz '
+                '-o pathways_out ' + (
+                    '--per_sequence_contrib '
+                    '--per_sequence_abun EC_metagenome_out/seqtab_norm.tsv.gz '
+                    '--per_sequence_function EC_predicted.tsv.gz '
+                    if full_contrib else ''
+                ) +
+                f'-p {plan.p_pathway}'
+            )
+            stage_l += [
+                Stage(
+                    'pathways',
+                    pathways_cmd,
+                    deps=['metagenome'] + (['expand_duplicates'] if full_contrib and is_collapsed else []),
+                    ncores=plan.p_pathway,
+                    mem=mem_gb.pathways * GB,
+                    inputs=[os.path.join(Var.out_dir, 'EC_metagenome_out/pred_metagenome_unstrat.tsv.gz')] + ([
+                        os.path.join(Var.out_dir, 'EC_metagenome_out/seqtab_norm.tsv.gz'),
+                        os.path.join(Var.out_dir, 'EC_predicted.tsv.gz'),
+                    ] if full_contrib else []),
+                    key=get_key(pathways_cmd, plan.p_pathway),
+                    clean=[os.path.join(Var.out_dir, 'pathways_out')],
+                ),
+                Stage(
+                    'description_METACYC',
+                    get_cmd(
+                        'add_descriptions.py -i pathways_out/path_abun_unstrat.tsv.gz -m METACYC '
+                                            '-o pathways_out/path_abun_unstrat_descrip.tsv.gz'
+                    ),
+                    deps=['pathways'],
+                    mem=mem_gb.description * GB,
+                    inputs=[os.path.join(Var.out_dir, 'pathways_out/path_abun_unstrat.tsv.gz')],
+                ),
+            ]
 
 
-        path_abun_predictions_tsv_gz_flpth = os.path.join(
-            Var.out_dir, 'pathways_out/path_abun_predictions.tsv.gz') 
+            #
+            ##
+            ### run
+            ####
+            #####
+
+            # per-sequence contributions for just the requested pathways/samples
+            # are computed from the main outputs, whether fresh or restored,
+            # so a later run asking for them reuses those.
+            # on the full pathway map, since which pathways MinPath keeps depends on all of them,
+            # then subset to the requested ones
+            contrib_dir = os.path.join(Var.run_dir, 'contrib')
+            contrib_out_dir = os.path.join(contrib_dir, 'pathways_out')
+            contrib_pathway_l = params.getd('contrib_pathways')
+            contrib_sample_l = params.getd('contrib_samples')
+
+            contrib_stage_l = [
+                Stage(
+                    'contrib_inputs',
+                    functools.partial(
+                        contrib.subset_inputs,
+                        os.path.join(Var.out_dir, 'EC_metagenome_out/pred_metagenome_unstrat.tsv.gz'),
+                        os.path.join(Var.out_dir, 'EC_metagenome_out/seqtab_norm.tsv.gz'),
+                        contrib_dir,
+                        contrib_pathway_l,
+                        contrib_sample_l,
+                    ),
+                ),
+                Stage(
+                    'pathways_contrib',
+                    get_cmd(
+                        'pathway_pipeline.py '
+                        f'-i {contrib_dir}/EC_pred_metagenome_unstrat.tsv.gz '
+                        f'-o {contrib_out_dir} '
+                        '--per_sequence_contrib '
+                        f'--per_sequence_abun {contrib_dir}/seqtab_norm.tsv.gz '
+                        f'--per_sequence_function {Var.out_dir}/EC_predicted.tsv.gz '
+                        f'-p {plan.p_pathway}',
+                        dir=contrib_dir,
+                    ),
+                    deps=['contrib_inputs'],
+                    ncores=plan.p_pathway,
+                    mem=mem_gb.pathways * GB,
+                    clean=[contrib_out_dir],
+                ),
+                Stage(
+                    'collect_contrib',
+                    functools.partial(
+                        contrib.collect_outputs,
+                        contrib_out_dir,
+                        os.path.join(Var.out_dir, 'pathways_out'),
+                        contrib_pathway_l,
+                    ),
+                    deps=['pathways_contrib'],
+                ),
+            ] if params.getd('per_sequence_contrib') and not full_contrib else []
+
+            # log each cmd stage's output, tagged with the stage name,
+            # and sample its process tree's per-executable CPU/RSS
+            # to find which tool is heavy, e.g., the one that gets OOM-killed,
+            # and kill it past its time limit or the run's memory budget
+            sample_dir = os.path.join(Var.return_dir, 'process_samples')
+            if os.path.exists(sample_dir): # so a resumed run's summary doesn't count stages it skipped
+                shutil.rmtree(sample_dir)
+            os.makedirs(sample_dir)
+            cmd_2_name = {
+                stage.cmd: stage.name for stage in stage_l + contrib_stage_l if isinstance(stage.cmd, str)}
+
+            def run_sampled(cmd):
+                name = cmd_2_name[cmd]
+                return run_check(
+                    cmd,
+                    sample_flpth=os.path.join(sample_dir, name + '.json'),
+                    log_flpth=log_flpth,
+                    tag=name,
+                    timeout_s=Var.stage_timeout_h.get(name.split('_')[0], Var.stage_timeout_h['default']) * 3600,
+                    max_mem_bytes=(
+                        plan.mem * Var.stage_mem_limit_frac
+                        if plan.mem is not None and Var.stage_mem_limit_frac is not None else None
+                    ),
+                )
 
-        attribute = 'MetaCyc Predictions'
-        source = 'PICRUSt2'
+            #
+            ##
+            ### FunctionalProfile imports
+            ####
+            #####
+
+            # imported in the background as soon as the stages writing their files are done,
+            # alongside the remaining stages,
+            # unless they have to reference the AmpliconMatrix saved at the end
+            saves_objects = amp_mat.row_attrmap_upa is not None and full_contrib
+            eager_fps = Var.debug or not saves_objects
+
+            def get_FP_amp_mat_ref():
+                if Var.debug:
+                    return params['amplicon_matrix_upa']  # this makes mocking more flexible in case something makes a fake UPA
+                if saves_objects:
+                    return io_pool.result('save_objects')[0] # this AmpliconMatrix is new one with new AttributeMapping
+                return params['amplicon_matrix_upa']
+
+            # gunzip TSVs out to another directory
+            tsv_dir = os.path.join(Var.run_dir, 'decompressed_tsv')
+            os.makedirs(tsv_dir, exist_ok=True)
+
+            def import_fp(id, fp_src, desc, **kw) -> str:
+                fp_dst = os.path.join(tsv_dir, id + '.tsv')
+                with spans.span('gunzip:' + id):
+                    gunzip(fp_src, fp_dst)
 
-        # if row AttributeMapping, 
-        # update that and referencing objs
-        if amp_mat.row_attrmap_upa is not None: 
+                return Var.fpu.import_func_profile(dict(
+                    workspace_id=Var.params['workspace_id'],
+                    func_profile_obj_name='%s.%s' % (Var.params['output_name'], id),
+                    original_matrix_ref=get_FP_amp_mat_ref(), # saves were submitted first, so don't deadlock
+                    profile_file_path=fp_dst,
+                    data_epistemology='predicted',
+                    epistemology_method='PICRUSt2',
+                    description=desc, 
+                    **kw
+                ))['func_profile_ref']
 
-            # update row AttributeMapping with traits
-            id2attr = appfile.parse_picrust2_traits(path_abun_predictions_tsv_gz_flpth)
-            ind, attribute = row_attrmap.add_attribute_slot(attribute, source)
-            row_attrmap.map_update_attribute(ind, id2attr)
-            row_attrmap_upa_new = row_attrmap.save()
+            fp_l = [] # in creation order
 
-            # update AmpliconMatrix which references row AttributeMapping
-            amp_mat.obj['row_attributemapping_ref'] = row_attrmap_upa_new
-            amp_mat_upa_new = amp_mat.save(name=params['output_name'])         
+            for func in Var.func_l:
+                if not Var.params.getd(func):
+                    continue
 
-            Var.objects_created.extend([
-                {
-                    'ref': row_attrmap_upa_new, 
-                    'description': 'Added attribute `%s`' % attribute,
-                }, 
-                {
-                    'ref': amp_mat_upa_new, 
-                    'description': 'Updated amplicon AttributeMapping reference to `%s`' % row_attrmap_upa_new
-                },
-            ])
+                func_name = Var.func_2_cfg[func]['name']
+
+                if Var.params.getd('create_amplicon_fps') and Var.params.has_amplicon_output(func):
+                    fp_l.append(dict(
+                        id='amplicon_' + func,
+                        desc='Amplicon %s abundance' % func_name,
+                        fp_src=os.path.join(Var.out_dir, Var.func_2_cfg[func]['relfp'][0]),
+                        profile_type='amplicon',
+                        profile_category='organism',
+                        stages=(
+                            ['pathways'] if func == 'metacyc' else
+                            [f'store_{func.upper()}'] + (['expand_duplicates'] if is_collapsed else [])
+                        ),
+                    ))
+
+                if Var.params.getd('create_sample_fps'):
+                    fp_l.append(dict(
+                        id='metagenome_' + func,
+                        desc='Metagenome %s abundance' % func_name,
+                        fp_src=os.path.join(Var.out_dir, Var.func_2_cfg[func]['relfp'][1]),
+                        profile_type='mg',
+                        profile_category='community',
+                        stages=['pathways'] if func == 'metacyc' else ['metagenome'],
+                    ))
+
+            done_stage_s = set()
+
+            def import_fps(done_stage=None, ready_only=True):
+                '''
+                Submit imports of FunctionalProfiles whose stages are done,
+                or of all those left with `ready_only=False`
+                '''
+                if done_stage is not None:
+                    done_stage_s.add(done_stage)
+
+                for fp in fp_l:
+                    name = 'import_fp:' + fp['id']
+                    if name in io_pool.name_2_future:
+                        continue
+                    if ready_only and not (eager_fps and set(fp['stages']) <= done_stage_s):
+                        continue
+
+                    io_pool.submit(
+                        name,
+                        import_fp,
+                        fp['id'],
+                        fp['fp_src'],
+                        fp['desc'],
+                        profile_type=fp['profile_type'],
+                        profile_category=fp['profile_category'],
+                        num_retries=Var.fp_import_retries,
+                    )
+
+
+            # whole-run outputs only depend on input files, tool version, and which functions
+            result_cache = ResultCache(
+                os.path.join(Var.shared_folder, Var.result_cache_dirname),
+                max_bytes=Var.result_cache_max_gb * GB,
+            )
+            result_key = hash_inputs(
+                [study_seq_flpth, study_seq_abundance_table_flpth], # ids matter, not just unique sequences
+                [Var.picrust2_version] + ['%s=%s' % (func, params.getd(func)) for func in Var.func_l] + [
+                    'full_contrib=%s' % full_contrib],
+            )
 
-    
-        #
-        ##
-        ### html report w/ heatmaps
-        ####
-        #####
+            with spans.span('result_cache_get'):
+                hit = result_cache.get(result_key, Var.out_dir)
+
+            if not hit:
+                with spans.span('picrust2'):
+                    run_stages(
+                        stage_l,
+                        run=run_sampled,
+                        run_func=run_func,
+                        max_cores=plan.ncores,
+                        max_mem=plan.mem,
+                        checkpoint=Checkpoint(os.path.join(Var.run_dir, 'checkpoint')),
+                        spans=spans,
+                        on_done=import_fps,
+                    )
+                with spans.span('result_cache_put'):
+                    result_cache.put(result_key, Var.out_dir)
+            else:
+                for stage in stage_l: # all restored
+                    import_fps(stage.name)
+
+            # not checkpointed, since restoring from the result cache replaces `out_dir`
+            if contrib_stage_l:
+                with spans.span('per_sequence_contrib'):
+                    run_stages(
+                        contrib_stage_l,
+                        run=run_sampled,
+                        run_func=run_func,
+                        max_cores=plan.ncores,
+                        max_mem=plan.mem,
+                        spans=spans,
+                        on_done=import_fps,
+                    )
+
+            collect_summaries(sample_dir, os.path.join(Var.return_dir, 'process_summary.json'))
+
+
+            #
+            ##
+            ### sanity checks
+            ####
+            #####
+
+            if Var.debug:
+                for func in Var.func_l:
+                    if not Var.params.getd(func): 
+                        continue
+                    
+                    fp0 = os.path.join(Var.out_dir, Var.func_2_cfg[func]['relfp'][0])
+                    fp1 = os.path.join(Var.out_dir, Var.func_2_cfg[func]['relfp'][1])
 
-        logging.info('Beginning report business')
+                    # Check dropped amplicons are the unaligned/distant ones (debug)
+                    if params.has_amplicon_output(func):
+                        appfile.check_dropped_amplicon_ids(fp0, amp_mat)
+                    # Check no samples dropped (debug)
+                    appfile.check_dropped_sample_ids(fp1, amp_mat)
 
-        ##
-        ## report
 
-        Var.report_dir = os.path.join(Var.run_dir, 'report')
 
-        report_html_flpth = report.HTMLReportWriter(
-            [cmd_pipeline, cmd_description] + cmd_func_l, 
-        ).write()
+            #
+            ##
+            ### update/save Amplicon workflow objects 
+            ####
+            #####
 
-        html_links = [{
-            'path': Var.report_dir,
-            'name': os.path.basename(report_html_flpth),
-        }]
+            # saves and FunctionalProfile imports run in the background,
+            # alongside the report's heatmaps
 
+            path_abun_predictions_tsv_gz_flpth = os.path.join(
+                Var.out_dir, 'pathways_out/path_abun_predictions.tsv.gz') 
 
-        #
-        ##
-        ### FunctionalProfile
-        ####
-        #####
-        logging.info('Starting saving FunctionalProfiles if any')
+            attribute = 'MetaCyc Predictions'
+            source = 'PICRUSt2'
 
-        if Var.debug:
-            FP_amp_mat_ref = params['amplicon_matrix_upa']  # this makes mocking more flexible in case something makes a fake UPA
-        else:
-            FP_amp_mat_ref = amp_mat_upa_new # this AmpliconMatrix is new one with new AttributeMapping
+            # a subset of contributions would give partial per-amplicon predictions
+            skipped_l = [
+                'the MetaCyc traits for the row AttributeMapping' 
+                if amp_mat.row_attrmap_upa is not None else None,
+                'the amplicon MetaCyc FunctionalProfile' 
+                if params.getd('metacyc') and params.getd('create_amplicon_fps') else None,
+            ]
+            skipped_l = [skipped for skipped in skipped_l if skipped is not None]
+            if skipped_l and params.getd('metacyc') and not full_contrib:
+                msg = (
+                    'Per-amplicon MetaCyc predictions come from per-sequence contributions '
+                    'for all pathways and samples, '
+                    'so %s %s not created. '
+                    'Turn on per-sequence contributions, and leave the pathway and sample subsets empty, '
+                    'to create them' % (' and '.join(skipped_l), 'were' if len(skipped_l) > 1 else 'was')
+                )
+                logging.warning(msg)
+                Var.warnings.append(msg)
+
+            def save_objects() -> tuple:
+                '''
+                Update row AttributeMapping with traits, then AmpliconMatrix which references it
+                Return new AmpliconMatrix UPA and objects created
+                '''
+                row_attrmap = io_pool.result('load_row_attrmap')
+
+                with spans.span('parse_traits'):
+                    id2attr = appfile.parse_picrust2_traits(path_abun_predictions_tsv_gz_flpth)
+                ind, attribute_ = row_attrmap.add_attribute_slot(attribute, source)
+                row_attrmap.map_update_attribute(ind, id2attr)
+                with spans.span('save_row_attrmap'):
+                    row_attrmap_upa_new = row_attrmap.save()
+
+                amp_mat.row_attrmap_upa = row_attrmap_upa_new
+                with spans.span('save_amp_mat'):
+                    amp_mat_upa_new = amp_mat.save(name=params['output_name'])         
+
+                return amp_mat_upa_new, [
+                    {
+                        'ref': row_attrmap_upa_new, 
+                        'description': 'Added attribute `%s`' % attribute_,
+                    }, 
+                    {
+                        'ref': amp_mat_upa_new, 
+                        'description': 'Updated amplicon AttributeMapping reference to `%s`' % row_attrmap_upa_new
+                    },
+                ]
+
+            # if row AttributeMapping, 
+            # update that and referencing objs
+            if saves_objects: 
+                io_pool.submit('save_objects', save_objects)
 
-        # gunzip TSVs out to another directory
-        tsv_dir = os.path.join(Var.run_dir, 'decompressed_tsv')
-        os.mkdir(tsv_dir)
+    
+            #
+            ##
+            ### FunctionalProfile
+            ####
+            #####
+            logging.info('Starting saving FunctionalProfiles if any')
 
-        for func in Var.func_l:
-            if not Var.params.getd(func):
-                continue
+            import_fps(ready_only=False) # the rest
 
-            func_name = Var.func_2_cfg[func]['name']
 
-            if Var.params.getd('create_amplicon_fps'):
-                id = 'amplicon_' + func
-                desc = 'Amplicon %s abundance' % func_name
+            #
+            ##
+            ### html report w/ heatmaps
+            ####
+            #####
 
-                fp_src = os.path.join(Var.out_dir, Var.func_2_cfg[func]['relfp'][0])
-                fp_dst = os.path.join(tsv_dir, id + '.tsv')
-                gunzip(fp_src, fp_dst)
-                
-                upa = Var.fpu.import_func_profile(dict(
-                    workspace_id=Var.params['workspace_id'],
-                    func_profile_obj_name='%s.%s' % (Var.params['output_name'], id),
-                    original_matrix_ref=FP_amp_mat_ref,
-                    profile_file_path=fp_dst,
-                    profile_type='amplicon',
-                    profile_category='organism',
-                    data_epistemology='predicted',
-                    epistemology_method='PICRUSt2',
-                    description=desc, 
-                ))['func_profile_ref']
+            logging.info('Beginning report business')
 
-                Var.objects_created.append(dict(
-                    ref=upa,
-                    description=desc
-                ))
+            ##
+            ## report
 
-            if Var.params.getd('create_sample_fps'):
-                id = 'metagenome_' + func
-                desc = 'Metagenome %s abundance' % func_name
+            Var.report_dir = os.path.join(Var.run_dir, 'report')
 
-                fp_src = os.path.join(Var.out_dir, Var.func_2_cfg[func]['relfp'][1])
-                fp_dst = os.path.join(tsv_dir, id + '.tsv')
-                gunzip(fp_src, fp_dst)
-                
-                upa = Var.fpu.import_func_profile(dict(
-                    workspace_id=Var.params['workspace_id'],
-                    func_profile_obj_name='%s.%s' % (Var.params['output_name'], id),
-                    original_matrix_ref=FP_amp_mat_ref,
-                    profile_file_path=fp_dst,
-                    profile_type='mg',
-                    profile_category='community',
-                    data_epistemology='predicted',
-                    epistemology_method='PICRUSt2',
-                    description=desc, 
-                ))['func_profile_ref']
+            # waits on background saves/imports before the performance tab, so it has them
+            with spans.span('report'):
+                report_html_flpth = report.HTMLReportWriter(
+                    [stage.cmd for stage in stage_l if isinstance(stage.cmd, str)],
+                    pending=io_pool.wait,
+                ).write()
 
-                Var.objects_created.append(dict(
-                    ref=upa,
-                    description=desc
-                ))
+            name_2_res = io_pool.wait() # re-raises any failure
 
+            spans.write(os.path.join(Var.return_dir, 'timings.json'))
 
+        if 'save_objects' in name_2_res:
+            Var.objects_created.extend(name_2_res['save_objects'][1])
+        for fp in fp_l:
+            Var.objects_created.append(dict(
+                ref=name_2_res['import_fp:' + fp['id']],
+                description=fp['desc']
+            ))
 
         # look at TSVs 
         dprint(
@@ -414,6 +886,11 @@ class kb_PICRUSt2:
             run='cli'
         )
 
+        html_links = [{
+            'path': Var.report_dir,
+            'name': os.path.basename(report_html_flpth),
+        }]
+
 
         #
         ##
@@ -427,12 +904,62 @@ class kb_PICRUSt2:
                 'name': 'PICRUSt2_results.zip', 
                 'description': 'Input, output, cmd, intermediate files, log'
         }]
+
+        return dict(
+            objects_created=Var.objects_created,
+            warnings=Var.warnings,
+            file_links=file_links,
+            html_links=html_links,
+        )
+    #END_CLASS_HEADER
+
+    # config contains contents of config file in a hash or None if it couldn't
+    # be found
+    def __init__(self, config):
+        #BEGIN_CONSTRUCTOR
+        logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
+                            level=logging.INFO)
+
+        self.callback_url = os.environ['SDK_CALLBACK_URL']
+        self.workspace_url = config['workspace-url']
+        self.shared_folder = config['scratch']
        
+        
+        #END_CONSTRUCTOR
+        pass
+
+
+    def run_picrust2_pipeline(self, ctx, params):
+        """
+        This example function accepts any number of parameters and returns results in a KBaseReport
+        :param params: instance of mapping from String to unspecified object
+        :returns: instance of type "ReportResults" -> structure: parameter
+           "report_name" of String, parameter "report_ref" of String
+        """
+        # ctx is the context object
+        # return Variables are: output
+        #BEGIN run_picrust2_pipeline
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+
+        logging.info(params)
+
+        res = self._run_picrust2(params, self._get_clients(ctx))
+
+        #
+        ##
+        ### report
+        ####
+        #####
+
         params_report = {
-            'warnings': Var.warnings,
-            'objects_created': Var.objects_created,
-            'file_links': file_links,
-            'html_links': html_links,
+            'warnings': res['warnings'],
+            'objects_created': res['objects_created'],
+            'file_links': res['file_links'],
+            'html_links': res['html_links'],
             'direct_html_link_index': 0,
             'report_object_name': 'kb_PICRUSt2_report',
             'workspace_name': params['workspace_name'],
@@ -456,6 +983,108 @@ class kb_PICRUSt2:
                              'output is not type dict as required.')
         # return the results
         return [output]
+
+    def run_picrust2_pipeline_batch(self, ctx, params):
+        """
+        Run PICRUSt2 on each AmpliconMatrix in `amplicon_matrix_upa_l`, with otherwise the same params,
+        in one job with one KBaseReport
+        :param params: instance of mapping from String to unspecified object
+        :returns: instance of type "ReportResults" -> structure: parameter
+           "report_name" of String, parameter "report_ref" of String
+        """
+        # ctx is the context object
+        # return Variables are: output
+        #BEGIN run_picrust2_pipeline_batch
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+
+        logging.info(params)
+
+        upa_l = params['amplicon_matrix_upa_l']
+
+        # per-matrix params
+        # output names get the matrix's index in the batch
+        params_l = [
+            {
+                **{k: v for k, v in params.items() if k != 'amplicon_matrix_upa_l'},
+                'amplicon_matrix_upa': upa,
+                'output_name': '%s_%d' % (params['output_name'], i),
+            }
+            for i, upa in enumerate(upa_l)
+        ]
+
+        # clients and the on-disk placement/HSP/result caches are shared by all matrices,
+        # so sequences recurring across matrices are placed and predicted once
+        clients = self._get_clients(ctx)
+        num_concurrent = get_num_concurrent_runs(len(upa_l))
+
+        logging.info('Running %d AmpliconMatrix, %d at a time' % (len(upa_l), num_concurrent))
+
+        # so a cancelled job takes forked runs, and through them their running tools, with it
+        forward_signals()
+
+        if num_concurrent == 1:
+            res_l = [self._run_picrust2(params_, clients) for params_ in params_l]
+        else:
+            # app-globals are per-process, so each matrix gets its own forked process
+            res_l = fork_map(
+                functools.partial(self._run_picrust2, clients=clients, share=num_concurrent),
+                params_l,
+                num_workers=num_concurrent,
+            )
+
+        #
+        ##
+        ### report
+        ####
+        #####
+
+        params_report = {
+            'warnings': [
+                '%s: %s' % (upa, warning) for upa, res in zip(upa_l, res_l) for warning in res['warnings']
+            ],
+            'objects_created': [obj for res in res_l for obj in res['objects_created']],
+            'file_links': [
+                {
+                    **file_link,
+                    'name': 'PICRUSt2_results_%d.zip' % i,
+                    'description': '%s. %s' % (upa, file_link['description']),
+                }
+                for i, (upa, res) in enumerate(zip(upa_l, res_l)) for file_link in res['file_links']
+            ],
+            'html_links': [
+                {
+                    **html_link,
+                    'description': upa,
+                }
+                for upa, res in zip(upa_l, res_l) for html_link in res['html_links']
+            ],
+            'direct_html_link_index': 0,
+            'report_object_name': 'kb_PICRUSt2_batch_report',
+            'workspace_name': params['workspace_name'],
+            'html_window_height': report.REPORT_HEIGHT,
+        }
+
+        Var.params_report = params_report
+
+        obj = clients['kbr'].create_extended_report(params_report)
+
+        output = {
+            'report_name': obj['name'],
+            'report_ref': obj['ref'],
+        }
+
+        #END run_picrust2_pipeline_batch
+
+        # At some point might do deeper type checking...
+        if not isinstance(output, dict):
+            raise ValueError('Method run_picrust2_pipeline_batch return value ' +
+                             'output is not type dict as required.')
+        # return the results
+        return [output]
     def status(self, ctx):
         #BEGIN_STATUS
         returnVal = {'state': "OK",
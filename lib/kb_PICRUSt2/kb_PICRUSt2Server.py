@@ -342,6 +342,10 @@ class Application(object):
                              name='kb_PICRUSt2.run_picrust2_pipeline',
                              types=[dict])
         self.method_authentication['kb_PICRUSt2.run_picrust2_pipeline'] = 'required'  # noqa
+        self.rpc_service.add(impl_kb_PICRUSt2.run_picrust2_pipeline_batch,
+                             name='kb_PICRUSt2.run_picrust2_pipeline_batch',
+                             types=[dict])
+        self.method_authentication['kb_PICRUSt2.run_picrust2_pipeline_batch'] = 'required'  # noqa
         self.rpc_service.add(impl_kb_PICRUSt2.status,
                              name='kb_PICRUSt2.status',
                              types=[dict])
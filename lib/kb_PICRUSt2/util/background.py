@@ -0,0 +1,108 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+RETRY_DELAY_S = 10 # doubled each retry
+
+
+
+####################################################################################################
+####################################################################################################
+def retrying(name, func, num_retries, delay_s=RETRY_DELAY_S):
+    '''
+    `func` retried on exception, with exponential backoff
+    '''
+    def wrapped(*args, **kwargs):
+        for i in range(num_retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if i == num_retries:
+                    raise
+                logging.warning('`%s` failed with `%r`, retrying in %gs (%d of %d)' % (
+                    name, e, delay_s * 2**i, i + 1, num_retries))
+                time.sleep(delay_s * 2**i)
+    return wrapped
+
+
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+class IOPool:
+    '''
+    Small thread pool for network-bound client calls, e.g., object fetches/saves and imports,
+    so they run alongside compute in the calling thread or the stage scheduler
+
+    Calls are named, for logs and, with `spans` (a `SpanRecorder`), a span each
+    Calls start in submission order, so a call may block on the result of one submitted before it
+    '''
+
+    def __init__(self, max_workers=4, spans=None):
+        self.spans = spans
+        self.name_2_future = {} # in submission order
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+
+####################################################################################################
+####################################################################################################
+    def submit(self, name, func, *args, num_retries=0, retry_delay_s=RETRY_DELAY_S, **kwargs):
+        '''
+        Return future of `func(*args, **kwargs)`, tried up to `1 + num_retries` times
+        '''
+        if name in self.name_2_future:
+            raise ValueError('Background call `%s` already submitted' % name)
+
+        logging.info('Submitting background call `%s`' % name)
+
+        fn = retrying(name, func, num_retries, retry_delay_s) if num_retries else func
+        fn = self.spans.wrap(name, fn) if self.spans is not None else fn
+        future = self._executor.submit(fn, *args, **kwargs)
+        self.name_2_future[name] = future
+
+        return future
+
+
+####################################################################################################
+####################################################################################################
+    def result(self, name):
+        return self.name_2_future[name].result()
+
+
+####################################################################################################
+####################################################################################################
+    def wait(self) -> dict:
+        '''
+        Block until everything submitted so far is done
+        Re-raise the first failure, in submission order
+        Return name to result
+        '''
+        wait(list(self.name_2_future.values()))
+
+        for name, future in self.name_2_future.items():
+            if future.exception() is not None:
+                logging.error('Background call `%s` failed' % name)
+                raise future.exception()
+
+        return {name: future.result() for name, future in self.name_2_future.items()}
+
+
+####################################################################################################
+####################################################################################################
+    def shutdown(self, cancel=False):
+        '''
+        `cancel` - drop calls that haven't started, e.g., when the run has already failed
+        '''
+        if cancel:
+            for future in self.name_2_future.values():
+                future.cancel()
+        self._executor.shutdown(wait=True)
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown(cancel=exc_type is not None)
@@ -0,0 +1,160 @@
+import os
+import fcntl
+import shutil
+import logging
+import uuid
+import contextlib
+
+
+LOCK_FLNM = '.lock'
+
+
+
+####################################################################################################
+####################################################################################################
+def get_size(path) -> int:
+    '''
+    Bytes under dir `path`
+    '''
+    size = 0
+    for dirpath, _, flnm_l in os.walk(path):
+        for flnm in flnm_l:
+            flpth = os.path.join(dirpath, flnm)
+            if not os.path.islink(flpth):
+                size += os.path.getsize(flpth)
+    return size
+
+
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+class ResultCache:
+    '''
+    Content-addressed dir cache on disk
+    One subdir per key, LRU eviction by subdir mtime once over `max_bytes`
+
+    Can be shared by processes, e.g., forked batch runs,
+    so restores hold a shared lock on the cache dir, and renames in and evictions an exclusive one,
+    so an entry is never evicted while being copied out
+    '''
+
+####################################################################################################
+####################################################################################################
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+####################################################################################################
+####################################################################################################
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+
+####################################################################################################
+####################################################################################################
+    @contextlib.contextmanager
+    def _lock(self, exclusive):
+        '''
+        `flock` on a file in the cache dir, released on close, including if the process dies
+        '''
+        with open(os.path.join(self.cache_dir, LOCK_FLNM), 'a') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+
+####################################################################################################
+####################################################################################################
+    def get(self, key, dst_dir) -> bool:
+        '''
+        Restore entry `key` to `dst_dir`, replacing it
+        Return whether it was a hit
+        '''
+        entry = self._entry(key)
+
+        with self._lock(exclusive=False):
+            if not os.path.isdir(entry):
+                self.misses += 1
+                logging.info('Result cache miss for key %s (%s)' % (key, self.stats_str()))
+                return False
+
+            if os.path.exists(dst_dir):
+                shutil.rmtree(dst_dir)
+            shutil.copytree(entry, dst_dir)
+            os.utime(entry) # most recently used
+
+        self.hits += 1
+        logging.info('Result cache hit for key %s (%s)' % (key, self.stats_str()))
+        return True
+
+
+####################################################################################################
+####################################################################################################
+    def put(self, key, src_dir):
+        '''
+        Copy `src_dir` in as entry `key`, then evict down to size
+        Entry is staged unlocked then renamed in so readers never see a partial one
+        '''
+        entry = self._entry(key)
+        with self._lock(exclusive=False):
+            if os.path.isdir(entry):
+                os.utime(entry)
+                return
+
+        if get_size(src_dir) > self.max_bytes:
+            logging.info('Not caching %s, larger than whole cache' % src_dir)
+            return
+
+        tmp = os.path.join(self.cache_dir, '.tmp_' + str(uuid.uuid4()))
+        shutil.copytree(src_dir, tmp)
+        with self._lock(exclusive=True):
+            try:
+                os.rename(tmp, entry)
+            except OSError: # someone else put it first
+                shutil.rmtree(tmp)
+
+            logging.info('Result cache put key %s' % key)
+            self._evict()
+
+
+####################################################################################################
+####################################################################################################
+    def evict(self):
+        '''
+        Drop least recently used entries until under `max_bytes`
+        '''
+        with self._lock(exclusive=True):
+            self._evict()
+
+    def _evict(self):
+        '''
+        Holding the exclusive lock
+        '''
+        entry_l = [
+            self._entry(key) for key in os.listdir(self.cache_dir)
+            if not key.startswith('.tmp_') and key != LOCK_FLNM
+        ]
+        entry_l.sort(key=os.path.getmtime) # oldest first
+        size_l = [get_size(entry) for entry in entry_l]
+
+        total = sum(size_l)
+        for entry, size in zip(entry_l, size_l):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry)
+            total -= size
+            self.evictions += 1
+            logging.info('Result cache evicted %s (%d bytes)' % (os.path.basename(entry), size))
+
+
+####################################################################################################
+####################################################################################################
+    def stats_str(self) -> str:
+        return 'hits=%d misses=%d evictions=%d' % (self.hits, self.misses, self.evictions)
@@ -0,0 +1,82 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import logging
+
+
+CHUNK_SIZE = 2 ** 20
+
+
+
+####################################################################################################
+####################################################################################################
+def hash_file(flpth, h=None):
+    '''
+    Feed file contents into hash `h`, or a new sha256 if none
+    Gzipped files are hashed decompressed, since the gzip header holds a timestamp
+    '''
+    h = h if h is not None else hashlib.sha256()
+    with (gzip.open if flpth.endswith('.gz') else open)(flpth, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h
+
+
+####################################################################################################
+####################################################################################################
+def hash_inputs(flpth_l=(), str_l=(), missing_ok=False) -> str:
+    '''
+    Digest of file contents and strings, order-sensitive
+    With `missing_ok`, a missing file counts as its own distinct content
+    '''
+    h = hashlib.sha256()
+    for s in str_l:
+        h.update(s.encode())
+        h.update(b'\0')
+    for flpth in flpth_l:
+        if missing_ok and not os.path.exists(flpth):
+            h.update(b'\1missing')
+        else:
+            hash_file(flpth, h)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+
+####################################################################################################
+####################################################################################################
+class Checkpoint:
+    '''
+    Completion markers for stages
+    One JSON file per stage holding the digest of what it ran on
+    '''
+
+    def __init__(self, dir):
+        self.dir = dir
+        os.makedirs(dir, exist_ok=True)
+
+    def _flpth(self, name):
+        return os.path.join(self.dir, name + '.done')
+
+    def is_done(self, name, digest) -> bool:
+        flpth = self._flpth(name)
+        if not os.path.exists(flpth):
+            return False
+        with open(flpth) as fh:
+            try:
+                return json.load(fh)['digest'] == digest
+            except (ValueError, KeyError): # partially written
+                return False
+
+    def mark_done(self, name, digest):
+        # write then rename so a crash never leaves a half marker
+        flpth = self._flpth(name)
+        with open(flpth + '.tmp', 'w') as fh:
+            json.dump({'digest': digest, 'time': time.time()}, fh)
+        os.replace(flpth + '.tmp', flpth)
+
+    def clear(self, name):
+        if os.path.exists(self._flpth(name)):
+            os.remove(self._flpth(name))
@@ -4,27 +4,234 @@ import subprocess
 import sys
 import gzip
 import shutil
+import os
+import signal
+import threading
+import collections
+import multiprocessing
+
+import psutil
+
+from .sampler import ProcessSampler, INTERVAL_S
+
+
+TAIL_LINES = 40 # last output lines kept for error messages
+LIMIT_POLL_S = 1 # how often to check a cmd's time/memory limits
+KILL_GRACE_S = 5 # between SIGTERM and SIGKILL
+
+_log_lock = threading.Lock() # concurrent cmds can share a log file
+_pgid_s = set() # process groups of running cmds, for signal forwarding
+_pgid_lock = threading.Lock()
 
 
 class NonZeroReturnException(Exception): pass
 
 
+class LimitException(Exception):
+    '''
+    Cmd killed for going over its wall-clock or memory limit
+    '''
+    def __init__(self, cmd, tag, limit, value):
+        self.cmd = cmd
+        self.tag = tag
+        self.limit = limit # 'timeout' or 'memory'
+        self.value = value
+        super().__init__(
+            'Stage `%s` was killed for going over its %s limit of %s. Command was `%s`' % (
+                tag or 'cmd',
+                limit,
+                '%ds' % value if limit == 'timeout' else '%.2fGB' % (value / 1024**3),
+                cmd,
+            )
+        )
+
+
+
+####################################################################################################
+####################################################################################################
+def _get_tree_rss(pid) -> int:
+    try:
+        root = psutil.Process(pid)
+        proc_l = [root] + root.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+    rss = 0
+    for proc in proc_l:
+        try:
+            rss += proc.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    return rss
+
 
 ####################################################################################################
 ####################################################################################################
-def run_check(cmd: str, shell=True):
+def _kill_group(pgid, sig=signal.SIGKILL):
+    try:
+        os.killpg(pgid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+####################################################################################################
+####################################################################################################
+def _terminate(proc):
+    '''
+    SIGTERM the cmd's process group, then SIGKILL it if it doesn't exit in time
+    '''
+    _kill_group(proc.pid, signal.SIGTERM)
+    try:
+        proc.wait(timeout=KILL_GRACE_S)
+    except subprocess.TimeoutExpired:
+        pass
+    _kill_group(proc.pid, signal.SIGKILL)
+
+
+####################################################################################################
+####################################################################################################
+def forward_signals(signum_l=(signal.SIGTERM, signal.SIGINT)):
+    '''
+    On these signals, pass them on to running cmds' process groups and forked child processes,
+    which don't get them otherwise since each cmd is its own session,
+    then do what the previous handler would have
+
+    Only installable from the main thread, otherwise a no-op
+    '''
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    for signum in signum_l:
+        prev = signal.getsignal(signum)
+        if getattr(prev, '_forwards', False):
+            continue
+
+        def handler(signum, frame, prev=prev):
+            logging.warning('Got signal %d, forwarding to running cmds' % signum)
+            with _pgid_lock:
+                pgid_l = list(_pgid_s)
+            for pgid in pgid_l:
+                _kill_group(pgid, signum)
+            for child in multiprocessing.active_children():
+                child.terminate()
+
+            if callable(prev):
+                prev(signum, frame)
+            elif prev != signal.SIG_IGN:
+                raise SystemExit(128 + signum)
+
+        handler._forwards = True
+        signal.signal(signum, handler)
+
+
+
+####################################################################################################
+####################################################################################################
+def _pump(stream, out, prefix, log_fh, tail):
+    '''
+    Copy lines from child's pipe to `out` and the log file as they come,
+    keeping the last ones in `tail`
+    '''
+    for line in iter(stream.readline, b''):
+        line = line.decode(errors='replace')
+        if not line.endswith('\n'):
+            line += '\n'
+        tail.append(line)
+        out.write(prefix + line)
+        out.flush()
+        if log_fh is not None:
+            with _log_lock:
+                log_fh.write(prefix + line)
+                log_fh.flush()
+    stream.close()
+
+
+####################################################################################################
+####################################################################################################
+def run_check(cmd: str, shell=True, sample_flpth=None, sample_interval_s=INTERVAL_S, log_flpth=None, tag=None,
+              timeout_s=None, max_mem_bytes=None):
+    '''
+    Child stdout/stderr are streamed by reader threads to this process's stdout/stderr,
+    and appended to `log_flpth` if given, each line prefixed with `[tag] ` if given
+    The last lines are included in the exception on failure
+
+    The cmd runs in its own process group, which is killed when the cmd finishes,
+    so nothing it started is left running
+    With `timeout_s` or `max_mem_bytes` (RSS summed over its process tree),
+    the group is killed on going over, raising `LimitException`
+
+    With `sample_flpth`, sample the cmd's process tree's per-executable CPU/RSS to there
+    '''
     logging.info('Running cmd `%s`' % cmd)
     t0 = time.time() 
     
-    completed_proc = subprocess.run(cmd, shell=shell, executable='/bin/bash', stdout=sys.stdout, stderr=sys.stderr)
+    prefix = '[%s] ' % tag if tag else ''
+    tail = collections.deque(maxlen=TAIL_LINES)
+    log_fh = open(log_flpth, 'a') if log_flpth is not None else None
+
+    try:
+        proc = subprocess.Popen(
+            cmd, shell=shell, executable='/bin/bash', stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=True, # own process group, with pgid the same as pid
+        )
+        with _pgid_lock:
+            _pgid_s.add(proc.pid)
+
+        reader_l = [
+            threading.Thread(target=_pump, args=(proc.stdout, sys.stdout, prefix, log_fh, tail), daemon=True),
+            threading.Thread(target=_pump, args=(proc.stderr, sys.stderr, prefix, log_fh, tail), daemon=True),
+        ]
+        for reader in reader_l:
+            reader.start()
+
+        sampler = (
+            ProcessSampler(proc.pid, sample_flpth, interval_s=sample_interval_s, cmd=cmd).start()
+            if sample_flpth is not None else None
+        )
+        limit_hit = None
+        try:
+            if timeout_s is None and max_mem_bytes is None:
+                returncode = proc.wait()
+            else:
+                while True:
+                    try:
+                        returncode = proc.wait(timeout=LIMIT_POLL_S)
+                        break
+                    except subprocess.TimeoutExpired:
+                        pass
+                    if timeout_s is not None and time.time() - t0 > timeout_s:
+                        limit_hit = ('timeout', timeout_s)
+                    elif max_mem_bytes is not None and _get_tree_rss(proc.pid) > max_mem_bytes:
+                        limit_hit = ('memory', max_mem_bytes)
+                    if limit_hit is not None:
+                        logging.error('Cmd went over its %s limit, killing its process group' % limit_hit[0])
+                        _terminate(proc)
+                        returncode = proc.wait()
+                        break
+        finally:
+            if proc.returncode is None: # e.g., interrupted
+                _terminate(proc)
+            _kill_group(proc.pid) # orphans
+            with _pgid_lock:
+                _pgid_s.discard(proc.pid)
+            if sampler is not None:
+                sampler.stop()
+            for reader in reader_l:
+                reader.join()
+
+    finally:
+        if log_fh is not None:
+            log_fh.close()
 
     logging.info('Cmd took %.2fmin' % ((time.time() - t0)/60))
 
-    if completed_proc.returncode != 0:
+    if limit_hit is not None:
+        raise LimitException(cmd, tag, *limit_hit)
+
+    if returncode != 0:
         raise NonZeroReturnException(
             "Command `%s` exited with non-zero return code `%d`. "
-            "Check logs for more details" %
-            (cmd, completed_proc.returncode)
+            "Check logs for more details. Last output:\n%s" %
+            (cmd, returncode, ''.join(tail))
         )
 
 
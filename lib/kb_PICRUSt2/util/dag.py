@@ -0,0 +1,214 @@
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .cli import run_check
+from .checkpoint import hash_inputs
+
+
+class DAGException(Exception): pass
+
+
+
+####################################################################################################
+####################################################################################################
+class Stage:
+    '''
+    One node in the stage graph
+
+    `cmd` - shell command handed to the scheduler's `run`,
+            or python callable handed to its `run_func`
+    `deps` - names of stages that must finish first
+    `ncores` - cores the stage occupies while running
+    `mem` - estimated peak memory in bytes
+    `inputs` - files the stage reads, including deps' outputs, which may not exist (yet).
+               Their contents, along with `key` and deps' checkpoint keys, key the stage's checkpoint
+    `key` - what of `cmd` keys the checkpoint, e.g., without thread counts.
+            Defaults to `cmd`, or the name for a callable
+    `clean` - paths to remove before (re-)running, e.g., output dirs the tool refuses to overwrite
+    '''
+
+    def __init__(self, name, cmd, deps=None, ncores=1, mem=0, inputs=None, key=None, clean=None):
+        self.name = name
+        self.cmd = cmd
+        self.key = key if key is not None else cmd if isinstance(cmd, str) else name
+        self.deps = list(deps) if deps is not None else []
+        self.ncores = ncores
+        self.mem = mem
+        self.inputs = list(inputs) if inputs is not None else []
+        self.clean = list(clean) if clean is not None else []
+
+    def __repr__(self):
+        return 'Stage(%s, deps=%s, ncores=%d, mem=%d)' % (self.name, self.deps, self.ncores, self.mem)
+
+
+
+####################################################################################################
+####################################################################################################
+def run_func(func):
+    '''
+    In-process counterpart of `run_check`
+    '''
+    name = getattr(func, '__name__', None) or getattr(getattr(func, 'func', None), '__name__', str(func))
+    logging.info('Running func `%s`' % name)
+    t0 = time.time()
+
+    func()
+
+    logging.info('Func took %.2fmin' % ((time.time() - t0)/60))
+
+
+
+####################################################################################################
+####################################################################################################
+def check_dag(stage_l):
+    '''
+    Unique names, known deps, no cycles
+    '''
+    names = [stage.name for stage in stage_l]
+    if len(set(names)) != len(names):
+        raise DAGException('Duplicate stage names in %s' % names)
+
+    for stage in stage_l:
+        for dep in stage.deps:
+            if dep not in names:
+                raise DAGException('Stage `%s` depends on unknown stage `%s`' % (stage.name, dep))
+
+    # Kahn's
+    name2deps = {stage.name: set(stage.deps) for stage in stage_l}
+    done = set()
+    while len(done) < len(names):
+        ready = [name for name, deps in name2deps.items() if name not in done and deps <= done]
+        if not ready:
+            raise DAGException(
+                'Cycle detected among stages %s' % sorted(set(names) - done))
+        done.update(ready)
+
+
+
+####################################################################################################
+####################################################################################################
+def run_stages(
+        stage_l, run=run_check, run_func=run_func, max_cores=None, max_mem=None, checkpoint=None, spans=None,
+        on_done=None):
+    '''
+    Run stages as soon as their deps are done and they fit in the core/memory budget
+    Stages are considered in list order, so list order breaks ties
+    A stage larger than the whole budget is clamped, i.e., runs once nothing else is running
+
+    With `checkpoint`, a stage is skipped if it finished before with the same `key`,
+    its `inputs` as they were, and its deps' checkpoint keys as they were,
+    which chain in everything upstream, including what's not in its own `inputs`.
+    So a dep that runs again on the same inputs and writes the same outputs doesn't force it to run again.
+    A stage without `inputs` can't tell what its deps wrote, so runs again whenever a dep ran
+
+    With `spans` (a `SpanRecorder`), each stage that runs is recorded as a span
+
+    With `on_done`, it's called with each stage's name once the stage is done, whether run or skipped,
+    in the calling thread, e.g., to start work on finished outputs while other stages run
+
+    On first failure, stop launching, let running stages finish, then re-raise
+    '''
+    check_dag(stage_l)
+
+    max_cores = max_cores if max_cores is not None else os.cpu_count()
+    max_mem = max_mem if max_mem is not None else float('inf')
+
+    logging.info(
+        'Scheduling %d stages with budget of %d cores and %s bytes' % (len(stage_l), max_cores, max_mem))
+
+    t0 = time.time()
+    pending = list(stage_l)
+    done = set()
+    ran = set() # done, and not skipped from checkpoint
+    name2digest = {} # checkpoint keys, once ready, so inputs aren't rehashed while waiting to fit
+    running = {} # future -> stage
+    used_cores = 0
+    used_mem = 0
+    err = None
+
+    def digest(stage):
+        return hash_inputs(
+            stage.inputs, [stage.key] + [name2digest[dep] for dep in stage.deps], missing_ok=True)
+
+    def fits(stage):
+        if not running:
+            return True
+        return (
+            used_cores + min(stage.ncores, max_cores) <= max_cores and
+            used_mem + min(stage.mem, max_mem) <= max_mem
+        )
+
+    with ThreadPoolExecutor(max_workers=max(len(stage_l), 1)) as executor:
+        while pending or running:
+
+            # launch everything ready that fits
+            # skipping a stage can ready others, so sweep until nothing changes
+            progress = err is None
+            while progress:
+                progress = False
+                for stage in list(pending):
+                    if not set(stage.deps) <= done:
+                        continue
+
+                    if checkpoint is not None and stage.name not in name2digest:
+                        name2digest[stage.name] = digest(stage)
+                        if (
+                            (stage.inputs or not set(stage.deps) & ran) and
+                            checkpoint.is_done(stage.name, name2digest[stage.name])
+                        ):
+                            logging.info('Skipping stage `%s`, already done' % stage.name)
+                            pending.remove(stage)
+                            done.add(stage.name)
+                            if on_done is not None:
+                                on_done(stage.name)
+                            progress = True
+                            continue
+
+                    if not fits(stage):
+                        continue
+
+                    logging.info('Launching stage `%s`' % stage.name)
+                    if checkpoint is not None:
+                        checkpoint.clear(stage.name)
+                    for path in stage.clean:
+                        if os.path.isdir(path):
+                            shutil.rmtree(path)
+                        elif os.path.exists(path):
+                            os.remove(path)
+                    pending.remove(stage)
+                    used_cores += min(stage.ncores, max_cores)
+                    used_mem += min(stage.mem, max_mem)
+                    fn = run if isinstance(stage.cmd, str) else run_func
+                    if spans is not None:
+                        fn = spans.wrap('stage:' + stage.name, fn)
+                    running[executor.submit(fn, stage.cmd)] = stage
+                    progress = True
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                used_cores -= min(stage.ncores, max_cores)
+                used_mem -= min(stage.mem, max_mem)
+                if future.exception() is not None:
+                    logging.error('Stage `%s` failed' % stage.name)
+                    if err is None:
+                        err = future.exception()
+                else:
+                    logging.info('Finished stage `%s`' % stage.name)
+                    done.add(stage.name)
+                    ran.add(stage.name)
+                    if checkpoint is not None:
+                        checkpoint.mark_done(stage.name, name2digest[stage.name])
+                    if on_done is not None:
+                        on_done(stage.name)
+
+    if err is not None:
+        raise err
+
+    logging.info('All %d stages took %.2fmin' % (len(stage_l), (time.time() - t0)/60))
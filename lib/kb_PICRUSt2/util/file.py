@@ -1,5 +1,7 @@
 import re
 import os
+import fcntl
+import numpy as np
 
 from .cli import gunzip
 
@@ -20,6 +22,21 @@ def get_numbered_duplicate(names, q):
     return q + ' (%d)' % i
 
 
+def lock_dir(dir, lock_flnm='.lock'):
+    '''
+    Non-blocking exclusive `flock` on a file in `dir`
+    Return the open file holding it, which releases it on close, including if the process dies,
+    or None if another process holds it
+    '''
+    fh = open(os.path.join(dir, lock_flnm), 'a')
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        fh.close()
+        return None
+    return fh
+
+
 def gunzip_out(src_flpth_l, dst_dir, gz_ext='.gz'):
     '''
     Given list of gzipped files, gunzip them to another location
@@ -41,3 +58,63 @@ def gunzip_out(src_flpth_l, dst_dir, gz_ext='.gz'):
         dst_flpth_l.append(dst_flpth)
 
     return dst_flpth_l
+
+
+def read_fasta(flpth) -> list:
+    '''
+    Return list of (id, seq)
+    Id is first whitespace-delimited token of header
+    Multi-line sequences are joined
+    '''
+    id_seq_l = []
+    id, seq_l = None, []
+    with open(flpth) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('>'):
+                if id is not None:
+                    id_seq_l.append((id, ''.join(seq_l)))
+                id, seq_l = line[1:].split()[0], []
+            else:
+                seq_l.append(line)
+    if id is not None:
+        id_seq_l.append((id, ''.join(seq_l)))
+    return id_seq_l
+
+
+def write_fasta(id_seq_l, flpth):
+    with open(flpth, 'w') as fh:
+        for id, seq in id_seq_l:
+            fh.write('>%s\n%s\n' % (id, seq))
+
+
+def _quote(s) -> str:
+    '''
+    Like `csv.QUOTE_MINIMAL` with tab delimiter
+    '''
+    s = str(s)
+    if any(c in s for c in '\t"\n\r'):
+        return '"' + s.replace('"', '""') + '"'
+    return s
+
+
+def write_tsv(a: np.ndarray, row_ids, col_ids, flpth, index_name='', float_format='%g', buffering=2**20):
+    '''
+    Write 2D float array as TSV with index column and header,
+    same bytes as `pd.DataFrame.to_csv(sep='\\t', float_format=float_format)`, NaN as empty
+
+    Formats a whole row with one `%`, then blanks its `nan`s if it has any
+    '''
+    num_cols = len(col_ids)
+    row_fmt = '%s' + ('\t' + float_format) * num_cols + '\n'
+    has_nan = np.isnan(a).any(axis=1) if a.size else np.zeros(len(row_ids), dtype=bool)
+
+    with open(flpth, 'w', buffering=buffering) as fh:
+        fh.write('\t'.join(_quote(id) for id in [index_name or ''] + list(col_ids)) + '\n')
+        for id, row, nan in zip(row_ids, a, has_nan):
+            line = row_fmt % (_quote(id), *row.tolist())
+            if nan: # ids with tabs are quoted, so only values start with a tab
+                line = line.replace('\tnan\t', '\t\t').replace('\tnan\t', '\t\t').replace('\tnan\n', '\t\n')
+            fh.write(line)
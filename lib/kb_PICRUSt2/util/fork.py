@@ -0,0 +1,78 @@
+import logging
+import traceback
+import multiprocessing
+import multiprocessing.connection
+
+
+
+####################################################################################################
+####################################################################################################
+def _child(func, arg, conn):
+    try:
+        conn.send((True, func(arg)))
+    except BaseException as e:
+        try:
+            conn.send((False, (e, traceback.format_exc())))
+        except Exception: # unpicklable exception
+            conn.send((False, (Exception(repr(e)), traceback.format_exc())))
+    finally:
+        conn.close()
+
+
+####################################################################################################
+####################################################################################################
+def fork_map(func, arg_l, num_workers, start_method='fork'):
+    '''
+    Like `map`, with each call in its own forked, non-daemonic process,
+    at most `num_workers` at a time
+    Forked children inherit app-globals and clients, and get their own copies to mutate
+
+    `start_method` - 'fork', only safe while no other threads are running,
+                     or 'forkserver' from a process with threads, which starts children from a clean server,
+                     so `func` and args must be picklable and children don't see app-globals
+
+    Non-daemonic so children can start their own subprocesses/process pools
+    Results and exceptions come back pickled
+    On first failure, stop launching, let running children finish, then re-raise
+    '''
+    ctx = multiprocessing.get_context(start_method)
+
+    result_l = [None] * len(arg_l)
+    todo = list(enumerate(arg_l))
+    running = {} # conn -> (i, proc)
+    err = None
+
+    while todo or running:
+        while todo and len(running) < num_workers and err is None:
+            i, arg = todo.pop(0)
+            conn_parent, conn_child = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_child, args=(func, arg, conn_child))
+            proc.start()
+            conn_child.close()
+            running[conn_parent] = (i, proc)
+
+        if not running:
+            break
+
+        for conn in multiprocessing.connection.wait(list(running)):
+            i, proc = running.pop(conn)
+            try:
+                ok, res = conn.recv()
+            except EOFError: # died without sending, e.g., killed
+                proc.join()
+                ok, res = False, (Exception('Child process for item %d died with exit code %s' % (i, proc.exitcode)), '')
+            conn.close()
+            proc.join()
+
+            if ok:
+                result_l[i] = res
+            else:
+                e, tb = res
+                logging.error('Child process for item %d failed:\n%s' % (i, tb))
+                if err is None:
+                    err = e
+
+    if err is not None:
+        raise err
+
+    return result_l
@@ -0,0 +1,207 @@
+import re
+import json
+import codecs
+import numpy as np
+
+
+STRUCT_RE = re.compile(r'[{}\[\]"]')
+STRING_REST_RE = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL) # after the opening quote
+WS_RE = re.compile(r'\s*')
+GROWTH = 1.25 # array buffer growth factor, which bounds its overallocation
+
+
+
+####################################################################################################
+####################################################################################################
+def loads_streamed(chunks, array_path: tuple, num_rows_hint=1024) -> tuple:
+    '''
+    Decode a JSON document from an iterable of bytes/str chunks, e.g., a streamed HTTP response,
+    parsing the nested number list at `array_path` straight into a 2D float array (NaN for `null`),
+    and everything else into the usual dicts/lists
+
+    `array_path` - keys from the top, with `None` for any list item,
+    e.g., `('result', None, 'data')`. Only the first match is streamed
+    `num_rows_hint` - rows to preallocate, grown by `GROWTH` as needed
+
+    The document minus that array is kept as text and decoded at the end,
+    so only the array's rows are ever held as Python objects, and one at a time
+    Return the document, with `None` in place of the array, and the array (`None` if not found)
+    '''
+    parser = _StreamParser(chunks, tuple(array_path), num_rows_hint)
+    return parser.parse()
+
+
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+class _StreamParser:
+    '''
+    Jumps between structural characters with regexes, tracking the key path,
+    and copies the text it passes to a skeleton
+    '''
+
+    def __init__(self, chunks, array_path, num_rows_hint):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.array_path = array_path
+        self.num_rows_hint = num_rows_hint
+
+        self.buf = ''
+        self.pos = 0 # scanned up to
+        self.mark = 0 # copied to skeleton up to
+        self.skel = []
+        self.stack = [] # key for objects, `None` for lists
+        self.array = None
+
+
+####################################################################################################
+####################################################################################################
+    def _more(self) -> bool:
+        '''
+        Copy what's been scanned to the skeleton and read the next chunk
+        Return whether there was one
+        '''
+        self.skel.append(self.buf[self.mark:self.pos])
+        self.buf = self.buf[self.pos:]
+        self.pos = self.mark = 0
+
+        for chunk in self.chunks:
+            chunk = self.decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+            if chunk:
+                self.buf += chunk
+                return True
+        return False
+
+
+####################################################################################################
+####################################################################################################
+    def parse(self) -> tuple:
+        while True:
+            m = STRUCT_RE.search(self.buf, self.pos)
+            if m is None:
+                self.pos = len(self.buf)
+                if not self._more():
+                    break
+                continue
+
+            c = m.group()
+            self.pos = m.start()
+
+            if c == '"':
+                if not self._string():
+                    if not self._more():
+                        raise ValueError('Unterminated string in JSON stream')
+                continue
+
+            self.pos = m.end()
+            if c == '{':
+                self.stack.append('')
+            elif c == '[':
+                if self.array is None and tuple(self.stack) == self.array_path:
+                    self.pos = m.start()
+                    self._array()
+                else:
+                    self.stack.append(None)
+            else:
+                self.stack.pop()
+
+        self.skel.append(self.buf[self.mark:])
+        return json.loads(''.join(self.skel)), self.array
+
+
+####################################################################################################
+####################################################################################################
+    def _string(self) -> bool:
+        '''
+        Skip the string at `pos`, noting it if it's an object key
+        Return False if it isn't all in the buffer yet
+        '''
+        m = STRING_REST_RE.match(self.buf, self.pos + 1)
+        if m is None:
+            return False
+
+        if self.stack and self.stack[-1] is not None: # in an object, so maybe a key
+            i = WS_RE.match(self.buf, m.end()).end()
+            if i == len(self.buf):
+                return False
+            if self.buf[i] == ':':
+                s = self.buf[self.pos:m.end()]
+                self.stack[-1] = json.loads(s) if '\\' in s else s[1:-1]
+
+        self.pos = m.end()
+        return True
+
+
+####################################################################################################
+####################################################################################################
+    def _array(self):
+        '''
+        Parse the nested number list at `pos` a row at a time into a growing float buffer,
+        leaving `null` in its place in the skeleton
+        '''
+        self.skel.append(self.buf[self.mark:self.pos])
+        self.skel.append('null')
+        self.pos += 1 # past `[`
+        self.mark = self.pos
+
+        a = None
+        num_rows = 0
+
+        while True:
+            self.pos = WS_RE.match(self.buf, self.pos).end()
+            self.mark = self.pos
+            if self.pos == len(self.buf):
+                if not self._more():
+                    raise ValueError('Unterminated array in JSON stream')
+                continue
+
+            c = self.buf[self.pos]
+            if c == ',':
+                self.pos += 1
+                continue
+            if c == ']':
+                self.pos += 1
+                self.mark = self.pos
+                break
+            if c != '[':
+                raise ValueError('Expected nested list of numbers at `%s`' % '.'.join(map(str, self.array_path)))
+
+            end = self.buf.find(']', self.pos)
+            if end == -1:
+                if not self._more():
+                    raise ValueError('Unterminated array in JSON stream')
+                continue
+
+            row = _parse_row(self.buf[self.pos + 1:end])
+            if a is None:
+                a = np.empty((self.num_rows_hint, len(row)))
+            elif len(row) != a.shape[1]:
+                raise ValueError('Rows of different lengths at `%s`' % '.'.join(map(str, self.array_path)))
+            if num_rows == a.shape[0]:
+                a.resize((int(GROWTH * num_rows) + 1, a.shape[1]), refcheck=False)
+            a[num_rows] = row
+            num_rows += 1
+
+            self.pos = self.mark = end + 1
+
+        if a is None:
+            a = np.empty((0, 0))
+        else:
+            a.resize((num_rows, a.shape[1]), refcheck=False)
+        self.array = a
+
+
+
+####################################################################################################
+####################################################################################################
+def _parse_row(s: str) -> np.ndarray:
+    '''
+    Inside of a JSON list of numbers/`null`
+    '''
+    if not s.strip():
+        return np.empty(0)
+    if '"' in s:
+        raise ValueError('Non-numeric value in streamed array')
+    return np.array(s.replace('null', 'nan').split(','), dtype=float)
@@ -0,0 +1,117 @@
+import os
+import math
+import logging
+
+
+CGROUP_DIR = '/sys/fs/cgroup'
+MEMINFO_FLPTH = '/proc/meminfo'
+GB = 1024 ** 3
+NO_LIMIT = 2 ** 60 # cgroup v1 reports no memory limit as a huge page-aligned number
+
+
+
+####################################################################################################
+####################################################################################################
+def _read(flpth):
+    try:
+        with open(flpth) as fh:
+            return fh.read().strip()
+    except (OSError, IOError):
+        return None
+
+
+####################################################################################################
+####################################################################################################
+def get_cgroup_cpu_limit(cgroup_dir=CGROUP_DIR):
+    '''
+    Cores allowed by the CFS quota, rounded up, or None if unlimited
+    Checks cgroup v2 then v1
+    '''
+    # v2
+    s = _read(os.path.join(cgroup_dir, 'cpu.max'))
+    if s is not None:
+        quota, period = s.split()
+        if quota == 'max':
+            return None
+        return max(1, math.ceil(int(quota) / int(period)))
+
+    # v1
+    quota = _read(os.path.join(cgroup_dir, 'cpu/cpu.cfs_quota_us'))
+    period = _read(os.path.join(cgroup_dir, 'cpu/cpu.cfs_period_us'))
+    if quota is not None and period is not None and int(quota) > 0:
+        return max(1, math.ceil(int(quota) / int(period)))
+
+    return None
+
+
+####################################################################################################
+####################################################################################################
+def get_cgroup_mem_avail(cgroup_dir=CGROUP_DIR):
+    '''
+    Bytes left under the cgroup memory limit, or None if unlimited
+    Checks cgroup v2 then v1
+    '''
+    # v2
+    limit = _read(os.path.join(cgroup_dir, 'memory.max'))
+    usage = _read(os.path.join(cgroup_dir, 'memory.current'))
+    if limit is not None:
+        if limit == 'max':
+            return None
+        return max(0, int(limit) - int(usage or 0))
+
+    # v1
+    limit = _read(os.path.join(cgroup_dir, 'memory/memory.limit_in_bytes'))
+    usage = _read(os.path.join(cgroup_dir, 'memory/memory.usage_in_bytes'))
+    if limit is not None and int(limit) < NO_LIMIT:
+        return max(0, int(limit) - int(usage or 0))
+
+    return None
+
+
+####################################################################################################
+####################################################################################################
+def get_mem_avail(meminfo_flpth=MEMINFO_FLPTH):
+    '''
+    MemAvailable in bytes, or None if unreadable
+    '''
+    s = _read(meminfo_flpth)
+    if s is None:
+        return None
+    for line in s.split('\n'):
+        if line.startswith('MemAvailable:'):
+            return int(line.split()[1]) * 1024 # kB
+    return None
+
+
+####################################################################################################
+####################################################################################################
+def get_num_cores():
+    '''
+    Usable cores, i.e., min of CPU affinity and cgroup quota
+    '''
+    try:
+        ncores = len(os.sched_getaffinity(0))
+    except AttributeError: # not on Linux
+        ncores = os.cpu_count() or 1
+
+    cgroup_ncores = get_cgroup_cpu_limit()
+    if cgroup_ncores is not None:
+        ncores = min(ncores, cgroup_ncores)
+
+    return ncores
+
+
+####################################################################################################
+####################################################################################################
+def get_mem_bytes():
+    '''
+    Usable memory, i.e., min of free memory and room under cgroup limit
+    None if neither could be read
+    '''
+    mem_l = [mem for mem in [get_mem_avail(), get_cgroup_mem_avail()] if mem is not None]
+
+    if not mem_l:
+        logging.warning('Could not determine available memory')
+        return None
+
+    return min(mem_l)
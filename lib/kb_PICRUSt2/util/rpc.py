@@ -0,0 +1,114 @@
+import json
+import time
+import random
+import logging
+import traceback
+import requests
+from requests.exceptions import ConnectionError
+from urllib3.exceptions import ProtocolError
+
+from installed_clients.baseclient import BaseClient, ServerError
+from .jsonstream import loads_streamed
+
+
+CHUNK_SIZE = 2**20
+CHECK_JOB_RETRIES = 3 # as `baseclient`
+
+
+
+####################################################################################################
+####################################################################################################
+def can_stream(client) -> bool:
+    '''
+    Whether `client` is a generated SDK client talking to a real service, e.g., not a test mock
+    '''
+    return isinstance(getattr(client, '_client', None), BaseClient)
+
+
+####################################################################################################
+####################################################################################################
+def _call_streamed(base: BaseClient, url, method, params: list, array_path: tuple, context=None) -> tuple:
+    '''
+    `BaseClient._call`, but with the response streamed through `loads_streamed`
+
+    `array_path` - in the first result
+    Return the first result, with `None` in place of the array, and the array
+    '''
+    body = {
+        'method': method,
+        'params': params,
+        'version': '1.1',
+        'id': str(random.random())[2:],
+    }
+    if context:
+        body['context'] = context
+
+    with requests.post(
+        url,
+        data=json.dumps(body),
+        headers=base._headers,
+        timeout=base.timeout,
+        verify=not base.trust_all_ssl_certificates,
+        stream=True,
+    ) as ret:
+        ret.encoding = 'utf-8'
+        if ret.status_code == 500:
+            if ret.headers.get('content-type') == 'application/json':
+                err = ret.json()
+                if 'error' in err:
+                    raise ServerError(**err['error'])
+            raise ServerError('Unknown', 0, ret.text)
+        if not ret.ok:
+            ret.raise_for_status()
+
+        resp, a = loads_streamed(
+            ret.iter_content(chunk_size=CHUNK_SIZE),
+            ('result', None) + tuple(array_path),
+        )
+
+    if 'result' not in resp:
+        raise ServerError('Unknown', 0, 'An unknown server error occurred')
+    if not resp['result']:
+        return None, a
+    return resp['result'][0], a
+
+
+####################################################################################################
+####################################################################################################
+def run_job_streamed(client, service_method, args: list, array_path: tuple) -> tuple:
+    '''
+    `client.<method>(...)` for an SDK method run through the callback server, i.e., `BaseClient.run_job`,
+    but with the finished job's result streamed, so the nested number list at `array_path`
+    comes back as a float array without ever being a nested Python list
+
+    `client` - generated SDK client, e.g., `DataFileUtil`
+    `array_path` - in the method's first result, e.g., `('data', None, 'data', 'data', 'values')`
+    Return the method's first result, with `None` in place of the array, and the array
+    '''
+    base = client._client
+    mod, _ = service_method.split('.')
+
+    logging.info('Running `%s` with streamed result' % service_method)
+
+    job_id = base._submit_job(service_method, args, client._service_ver)
+
+    check_time = base.async_job_check_time
+    num_failures = 0
+    while num_failures < CHECK_JOB_RETRIES:
+        time.sleep(check_time)
+        check_time = min(check_time * base.async_job_check_time_scale_percent / 100, base.async_job_check_max_time)
+
+        try:
+            job_state, a = _call_streamed(
+                base, base.url, mod + '._check_job', [job_id], ('result', None) + tuple(array_path))
+        except (ConnectionError, ProtocolError):
+            traceback.print_exc()
+            num_failures += 1
+            continue
+
+        if job_state['finished']:
+            if not job_state['result']:
+                return None, a
+            return job_state['result'][0], a
+
+    raise RuntimeError('_check_job failed %d times and exceeded limit' % num_failures)
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import logging
+import threading
+
+import psutil
+
+
+INTERVAL_S = 2
+FLUSH_S = 30 # rewrite output this often, so it survives the job being OOM-killed
+
+
+
+####################################################################################################
+####################################################################################################
+def _write_json(obj, flpth):
+    '''
+    Atomically, so a kill mid-write leaves the last complete version
+    '''
+    tmp_flpth = flpth + '.tmp'
+    with open(tmp_flpth, 'w') as fh:
+        json.dump(obj, fh)
+    os.replace(tmp_flpth, flpth)
+
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+class ProcessSampler:
+    '''
+    Background thread that walks the process tree under `pid` every `interval_s`
+    and records CPU percent and RSS per executable name, summed over that executable's processes
+
+    Output JSON has the time series and a compact summary:
+    total CPU seconds and peak RSS of the whole tree,
+    which executables held the most memory when it peaked,
+    and per executable, number of processes, total CPU seconds, peak RSS, peak CPU percent, first/last seen
+    and total bytes read/written through the block layer
+
+    CPU seconds and bytes are as last sampled, so miss whatever processes did after their last sample
+    '''
+
+    def __init__(self, pid, flpth=None, interval_s=INTERVAL_S, flush_s=FLUSH_S, cmd=None):
+        self.pid = pid
+        self.flpth = flpth
+        self.interval_s = interval_s
+        self.flush_s = flush_s
+        self.cmd = cmd
+
+        self.t0 = time.time()
+        self.series = {} # exe -> [[t, cpu_pct, rss], ...]
+        self.pid_2_proc = {} # kept so `cpu_percent` has a previous sample to diff against
+        self.pid_2_exe = {}
+        self.pid_2_cpu_s = {} # last seen
+        self.pid_2_io = {} # last seen (read, written)
+        self.peak_tree_rss = 0
+        self.peak_tree_t = None
+        self.peak_tree_exe_2_rss = {}
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+
+####################################################################################################
+####################################################################################################
+    def start(self):
+        self._thread.start()
+        return self
+
+
+####################################################################################################
+####################################################################################################
+    def stop(self) -> dict:
+        self._stop.set()
+        self._thread.join()
+        self.sample() # catch anything still around
+        if self.flpth is not None:
+            self.write(self.flpth)
+        return self.summary()
+
+
+####################################################################################################
+####################################################################################################
+    def _loop(self):
+        last_flush = time.time()
+        while not self._stop.is_set():
+            self.sample()
+            if self.flpth is not None and time.time() - last_flush >= self.flush_s:
+                self.write(self.flpth)
+                last_flush = time.time()
+            self._stop.wait(self.interval_s)
+
+
+####################################################################################################
+####################################################################################################
+    def _get_tree(self) -> list:
+        try:
+            root = self.pid_2_proc.get(self.pid) or psutil.Process(self.pid)
+            return [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return []
+
+
+####################################################################################################
+####################################################################################################
+    def sample(self):
+        t = round(time.time() - self.t0, 2)
+        exe_2_cpu = {}
+        exe_2_rss = {}
+
+        for proc in self._get_tree():
+            proc = self.pid_2_proc.setdefault(proc.pid, proc)
+            try:
+                with proc.oneshot():
+                    exe = proc.name()
+                    cpu_pct = proc.cpu_percent(None) # 0 on first sample of a process
+                    rss = proc.memory_info().rss
+                    cpu_times = proc.cpu_times()
+                    io = proc.io_counters() if hasattr(proc, 'io_counters') else None
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                continue
+
+            self.pid_2_exe[proc.pid] = exe
+            self.pid_2_cpu_s[proc.pid] = cpu_times.user + cpu_times.system
+            if io is not None:
+                self.pid_2_io[proc.pid] = (io.read_bytes, io.write_bytes)
+            exe_2_cpu[exe] = exe_2_cpu.get(exe, 0) + cpu_pct
+            exe_2_rss[exe] = exe_2_rss.get(exe, 0) + rss
+
+        for exe in exe_2_rss:
+            self.series.setdefault(exe, []).append([t, round(exe_2_cpu[exe], 1), exe_2_rss[exe]])
+
+        tree_rss = sum(exe_2_rss.values())
+        if tree_rss > self.peak_tree_rss:
+            self.peak_tree_rss = tree_rss
+            self.peak_tree_t = t
+            self.peak_tree_exe_2_rss = exe_2_rss
+
+
+####################################################################################################
+####################################################################################################
+    def summary(self) -> dict:
+        exe_2_cpu_s = {}
+        exe_2_num_procs = {}
+        for pid, exe in list(self.pid_2_exe.items()):
+            exe_2_cpu_s[exe] = exe_2_cpu_s.get(exe, 0) + self.pid_2_cpu_s[pid]
+            exe_2_num_procs[exe] = exe_2_num_procs.get(exe, 0) + 1
+
+        return dict(
+            cmd=self.cmd,
+            wall_s=round(time.time() - self.t0, 2),
+            cpu_s=round(sum(exe_2_cpu_s.values()), 2),
+            read_bytes=sum(io[0] for io in list(self.pid_2_io.values())),
+            write_bytes=sum(io[1] for io in list(self.pid_2_io.values())),
+            peak_tree_rss_bytes=self.peak_tree_rss,
+            peak_tree_t_s=self.peak_tree_t,
+            peak_tree_rss_bytes_by_exe=self.peak_tree_exe_2_rss,
+            by_exe={
+                exe: dict(
+                    num_procs=exe_2_num_procs.get(exe, 0),
+                    cpu_s=round(exe_2_cpu_s.get(exe, 0), 2),
+                    peak_rss_bytes=max(sample[2] for sample in sample_l),
+                    peak_cpu_pct=max(sample[1] for sample in sample_l),
+                    first_s=sample_l[0][0],
+                    last_s=sample_l[-1][0],
+                )
+                for exe, sample_l in list(self.series.items())
+            },
+        )
+
+
+####################################################################################################
+####################################################################################################
+    def write(self, flpth):
+        _write_json(dict(
+            interval_s=self.interval_s,
+            summary=self.summary(),
+            series=self.series,
+        ), flpth)
+
+
+####################################################################################################
+####################################################################################################
+def collect_summaries(sample_dir, out_flpth) -> dict:
+    '''
+    Gather the summary of every sampler output in `sample_dir`, keyed by file name,
+    and log which run peaked highest in memory
+    '''
+    name_2_summary = {}
+    for flnm in sorted(os.listdir(sample_dir)) if os.path.isdir(sample_dir) else []:
+        if not flnm.endswith('.json'):
+            continue
+        with open(os.path.join(sample_dir, flnm)) as fh:
+            name_2_summary[flnm[:-len('.json')]] = json.load(fh)['summary']
+
+    _write_json(name_2_summary, out_flpth)
+
+    if name_2_summary:
+        name, summary = max(name_2_summary.items(), key=lambda kv: kv[1]['peak_tree_rss_bytes'])
+        by_exe = summary['peak_tree_rss_bytes_by_exe']
+        logging.info(
+            'Highest peak RSS of sampled cmds was `%s` at %.2fGB, mostly `%s`' % (
+                name,
+                summary['peak_tree_rss_bytes'] / 1024**3,
+                max(by_exe, key=by_exe.get) if by_exe else None,
+            )
+        )
+
+    return name_2_summary
@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import resource
+import logging
+import threading
+import contextlib
+
+
+BLOCK_SIZE = 512 # bytes per rusage in/out block
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF) # linux only
+
+
+
+####################################################################################################
+####################################################################################################
+def _usage() -> dict:
+    '''
+    Of the calling thread, so spans in other threads, e.g., concurrent stages, aren't counted
+    '''
+    thread = resource.getrusage(RUSAGE_THREAD)
+    return dict(
+        wall=time.time(),
+        cpu=thread.ru_utime + thread.ru_stime,
+        read=thread.ru_inblock * BLOCK_SIZE,
+        write=thread.ru_oublock * BLOCK_SIZE,
+    )
+
+
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+####################################################################################################
+class SpanRecorder:
+    '''
+    Records named, possibly nested, spans of a run:
+    wall time, and CPU time and bytes read/written through the block layer by the thread running it
+
+    So a span doesn't count concurrent spans' work, but neither what it hands to other threads or processes.
+    A cmd stage's own CPU, IO and peak RSS come from sampling its process tree (see `ProcessSampler`)
+    '''
+
+    def __init__(self):
+        self.t0 = time.time()
+        self.span_l = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+
+####################################################################################################
+####################################################################################################
+    @contextlib.contextmanager
+    def span(self, name):
+        stack = self._local.__dict__.setdefault('stack', [])
+        parent = stack[-1] if stack else None
+        stack.append(name)
+
+        u0 = _usage()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            u1 = _usage()
+            stack.pop()
+
+            rec = dict(
+                name=name,
+                parent=parent,
+                depth=len(stack),
+                start_s=round(u0['wall'] - self.t0, 3),
+                wall_s=round(u1['wall'] - u0['wall'], 3),
+                cpu_s=round(u1['cpu'] - u0['cpu'], 3),
+                read_bytes=u1['read'] - u0['read'],
+                write_bytes=u1['write'] - u0['write'],
+                ok=ok,
+            )
+            with self._lock:
+                self.span_l.append(rec)
+
+            logging.info('Span `%s` took %.2fs wall, %.2fs cpu' % (name, rec['wall_s'], rec['cpu_s']))
+
+
+####################################################################################################
+####################################################################################################
+    def wrap(self, name, func):
+        '''
+        `func` run inside span `name`, e.g., for handing to another thread
+        '''
+        def wrapped(*args, **kwargs):
+            with self.span(name):
+                return func(*args, **kwargs)
+        return wrapped
+
+
+####################################################################################################
+####################################################################################################
+    def to_list(self) -> list:
+        '''
+        Finished spans in start order, parents before children
+        '''
+        with self._lock:
+            return sorted(self.span_l, key=lambda rec: (rec['start_s'], rec['depth']))
+
+
+####################################################################################################
+####################################################################################################
+    def write(self, flpth):
+        with open(flpth, 'w') as fh:
+            json.dump({'spans': self.to_list()}, fh, indent=2)
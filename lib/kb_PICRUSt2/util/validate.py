@@ -91,6 +91,28 @@ def as_numeric(a: np.ndarray, rep=np.nan, dtype=float):
 
 
 
+####################################################################################################
+####################################################################################################
+def to_float_array(values: list) -> np.ndarray:
+    '''
+    Nested list of numbers and missing values to float array with NaN for missing
+
+    NumPy converts numbers and `None` in one C-level pass,
+    and only if that trips on string missing values, e.g., `''`, are those swapped out first
+    Float arrays pass through without a copy
+    '''
+    try:
+        return np.asarray(values, dtype=float)
+    except ValueError:
+        pass
+
+    a = np.array(values, dtype=object)
+    for missing in MISSING_VALS:
+        if isinstance(missing, str):
+            a[a == missing] = None
+    return a.astype(float)
+
+
 ####################################################################################################
 ####################################################################################################
 def is_int_like(a: np.ndarray, missingOk=True):
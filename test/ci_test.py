@@ -51,8 +51,10 @@ class kb_PICRUSt2Test(config.BaseTest):
 ####################################################################################################
 ####################################################################################################
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.DataFileUtil', new=lambda *a: get_mock_dfu('enigma50by30'))  # ?
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.Workspace', new=lambda *a, **k: get_mock_ws('enigma50by30'))
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.GenericsAPI', new=lambda *a, **k: get_mock_gapi('enigma50by30'))
     @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_check', new=get_mock_run_check('enigma50by30'))
+    @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_func', new=get_mock_run_func())
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.FunctionalProfileUtil', new=lambda *a, **k: get_mock_fpu(''))
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.KBaseReport', new=lambda *a, **k: get_mock_kbr())
     def test_has_row_AttributeMapping_create_all(self):
@@ -64,14 +66,16 @@ class kb_PICRUSt2Test(config.BaseTest):
             }
         )
 
-        assert len(Var.objects_created) == 8, Var.objects_created 
+        assert len(Var.objects_created) == 5, Var.objects_created # no traits or amplicon MetaCyc by default
 
 
 ####################################################################################################
 ####################################################################################################
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.DataFileUtil', new=lambda *args: get_mock_dfu('enigma50by30_noAttrMaps_noSampleSet'))
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.Workspace', new=lambda *a, **k: get_mock_ws('enigma50by30_noAttrMaps_noSampleSet'))
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.GenericsAPI', new=lambda *a, **k: get_mock_gapi('enigma50by30_noAttrMaps_noSampleSet'))
     @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_check', new=get_mock_run_check('enigma50by30_noAttrMaps_noSampleSet'))
+    @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_func', new=get_mock_run_func())
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.FunctionalProfileUtil', new=lambda *a, **k: get_mock_fpu(''))
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.KBaseReport', new=lambda *args, **kwargs: get_mock_kbr())
     def test_has_no_row_AttributeMapping(self):
@@ -87,13 +91,47 @@ class kb_PICRUSt2Test(config.BaseTest):
             }
         )
         
-        assert len(Var.objects_created) == 6, Var.objects_created
+        assert len(Var.objects_created) == 5, Var.objects_created
+
+####################################################################################################
+####################################################################################################
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.DataFileUtil', new=lambda *a: get_mock_dfu('enigma50by30'))
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.Workspace', new=lambda *a, **k: get_mock_ws('enigma50by30'))
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.GenericsAPI', new=lambda *a, **k: get_mock_gapi('enigma50by30'))
+    @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_check', new=get_mock_run_check('enigma50by30'))
+    @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_func', new=get_mock_run_func())
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.FunctionalProfileUtil', new=lambda *a, **k: get_mock_fpu(''))
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.KBaseReport', new=lambda *a, **k: get_mock_kbr())
+    def test_per_sequence_contrib(self):
+        '''
+        Contributions for all pathways and samples bring back traits and amplicon MetaCyc,
+        which are left out, with a warning, when off (the default) or subset
+        '''
+        for contrib_options, num_objects in [
+            ({'per_sequence_contrib': 1, 'contrib_pathways': [''], 'contrib_samples': ['']}, 8),
+            ({'per_sequence_contrib': 0}, 5),
+            ({'per_sequence_contrib': 1, 'contrib_pathways': ['PWY-7219', ''], 'contrib_samples': ['']}, 5),
+        ]:
+            with self.subTest(contrib_options=contrib_options):
+                ret = config.get_serviceImpl().run_picrust2_pipeline(
+                    config.ctx, {
+                        **config.get_ws(),
+                        'amplicon_matrix_upa': enigma50by30,
+                        'contrib_options': contrib_options,
+                        'output_name': 'an_output_name',
+                    }
+                )
+
+                assert len(Var.objects_created) == num_objects, Var.objects_created 
+                assert any('MetaCyc' in warning for warning in Var.warnings) == (num_objects == 5), Var.warnings
 
 ####################################################################################################
 ####################################################################################################
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.DataFileUtil', new=lambda *a: get_mock_dfu('enigma50by30')) # ?
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.Workspace', new=lambda *a, **k: get_mock_ws('enigma50by30'))
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.GenericsAPI', new=lambda *a, **k: get_mock_gapi('enigma50by30'))
     @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_check', new=get_mock_run_check('enigma50by30'))
+    @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_func', new=get_mock_run_func())
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.FunctionalProfileUtil', new=lambda *a, **k: get_mock_fpu(''))
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.KBaseReport', new=lambda *a, **k: get_mock_kbr())
     def test_FP_options(self):
@@ -114,7 +152,7 @@ class kb_PICRUSt2Test(config.BaseTest):
                 }
             )
 
-            assert len(Var.objects_created) == 2, Var.objects_created
+            assert len(Var.objects_created) == 0, Var.objects_created
 
 
         with self.subTest():
@@ -130,13 +168,15 @@ class kb_PICRUSt2Test(config.BaseTest):
                 }
             )
 
-            assert len(Var.objects_created) == 8, Var.objects_created
+            assert len(Var.objects_created) == 5, Var.objects_created
 
 ####################################################################################################
 ####################################################################################################
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.DataFileUtil', new=lambda *a: get_mock_dfu('enigma50by30')) # ?
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.Workspace', new=lambda *a, **k: get_mock_ws('enigma50by30'))
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.GenericsAPI', new=lambda *a, **k: get_mock_gapi('enigma50by30'))
     @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_check', new=get_mock_run_check('enigma50by30'))
+    @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_func', new=get_mock_run_func())
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.FunctionalProfileUtil', new=lambda *a, **k: get_mock_fpu(''))
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.KBaseReport', new=lambda *a, **k: get_mock_kbr())
     def test_func_options(self):
@@ -159,7 +199,7 @@ class kb_PICRUSt2Test(config.BaseTest):
                 }
             )
 
-            assert len(Var.objects_created) == 16, Var.objects_created
+            assert len(Var.objects_created) == 13, Var.objects_created
 
         '''
         with self.subTest():
@@ -188,8 +228,10 @@ class kb_PICRUSt2Test(config.BaseTest):
 ####################################################################################################
 ####################################################################################################
     @patch('kb_PICRUSt2.kb_PICRUSt2Impl.DataFileUtil', new=lambda *a: get_mock_dfu('enigma17770by511'))
+    @patch('kb_PICRUSt2.kb_PICRUSt2Impl.Workspace', new=lambda *a, **k: get_mock_ws('enigma17770by511'))
     @patch('kb_PICRUSt2.kb_PICRUSt2Impl.GenericsAPI', new=lambda *a, **k: get_mock_gapi('enigma17770by511'))
     @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_check', new=get_mock_run_check('enigma17770by511'))
+    @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_func', new=get_mock_run_func())
     @patch('kb_PICRUSt2.kb_PICRUSt2Impl.FunctionalProfileUtil', new=lambda *a, **k: get_mock_fpu(''))
     @patch('kb_PICRUSt2.kb_PICRUSt2Impl.KBaseReport', new=lambda *a, **k: get_mock_kbr())
     def test_large_dataset(self):
@@ -208,14 +250,16 @@ class kb_PICRUSt2Test(config.BaseTest):
             }
         )
 
-        assert len(Var.objects_created) == 8, Var.objects_created
+        assert len(Var.objects_created) == 5, Var.objects_created
         
 
 ####################################################################################################
 ####################################################################################################
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.DataFileUtil', new=lambda u: get_mock_dfu('userTest'))
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.Workspace', new=lambda *a, **k: get_mock_ws('userTest'))
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.GenericsAPI', new=lambda *a, **k: get_mock_gapi('userTest'))
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.run_check', new=get_mock_run_check('userTest'))
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.run_func', new=get_mock_run_func())
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.FunctionalProfileUtil', new=lambda *a, **k: get_mock_fpu(''))
     @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.KBaseReport', new=lambda u: get_mock_kbr())
     def test_userTest_data(self):
@@ -235,7 +279,35 @@ class kb_PICRUSt2Test(config.BaseTest):
                 },
                 'output_name': 'an_output_name',
             })
-        assert len(Var.objects_created) == 14, Var.objects_created
+        assert len(Var.objects_created) == 13, Var.objects_created
+
+####################################################################################################
+####################################################################################################
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.DataFileUtil', new=lambda *a: get_mock_dfu('enigma50by30'))
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.Workspace', new=lambda *a, **k: get_mock_ws('enigma50by30'))
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.GenericsAPI', new=lambda *a, **k: get_mock_gapi('enigma50by30'))
+    @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_check', new=get_mock_run_check('enigma50by30'))
+    @patch('kb_PICRUSt2.kb_PICRUSt2Impl.run_func', new=get_mock_run_func())
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.FunctionalProfileUtil', new=lambda *a, **k: get_mock_fpu(''))
+    @patch_('kb_PICRUSt2.kb_PICRUSt2Impl.KBaseReport', new=lambda *a, **k: get_mock_kbr())
+    def test_batch(self):
+        '''
+        Matrices side by side in forked processes, one report
+        '''
+        for num_concurrent in [1, 2]:
+            with self.subTest(num_concurrent=num_concurrent):
+                with patch('kb_PICRUSt2.kb_PICRUSt2Impl.get_num_concurrent_runs', new=lambda *a: num_concurrent):
+                    ret = config.get_serviceImpl().run_picrust2_pipeline_batch(
+                        config.ctx, {
+                            **config.get_ws(),
+                            'amplicon_matrix_upa_l': [enigma50by30, enigma50by30],
+                            'output_name': 'an_output_name',
+                        }
+                    )
+
+                assert len(Var.params_report['objects_created']) == 10, Var.params_report['objects_created']
+                assert len(Var.params_report['html_links']) == 2
+                assert len(Var.params_report['file_links']) == 2
 
 #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 #!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
@@ -0,0 +1,82 @@
+import os
+import pandas as pd
+from unittest.mock import patch
+from pytest import raises
+
+from kb_PICRUSt2.impl import contrib
+from mock import *
+
+
+####################################################################################################
+####################################################################################################
+def test_subset_inputs(tmp_path):
+    unstrat_flpth = str(tmp_path / 'unstrat.tsv.gz')
+    seqtab_norm_flpth = str(tmp_path / 'seqtab_norm.tsv.gz')
+    map_flpth = str(tmp_path / 'map.txt')
+
+    pd.DataFrame(
+        [[1, 2, 3], [4, 5, 6]],
+        index=pd.Index(['EC:1', 'EC:2'], name='function'),
+        columns=['s0', 's1', 's2'],
+    ).to_csv(unstrat_flpth, sep='\t', compression='gzip')
+    pd.DataFrame(
+        [[1, 0, 0], [0, 2, 1], [0, 0, 3]],
+        index=pd.Index(['amp0', 'amp1', 'amp2'], name='normalized'),
+        columns=['s0', 's1', 's2'],
+    ).to_csv(seqtab_norm_flpth, sep='\t', compression='gzip')
+    with open(map_flpth, 'w') as fh:
+        fh.write('PWY-1 ( RXN-1 RXN-2 )\nPWY-2 RXN-3\nPWY-3 RXN-4\n')
+
+    contrib_dir = str(tmp_path / 'contrib')
+
+    with patch.dict('kb_PICRUSt2.impl.contrib.Var', values={'metacyc_pathway_map_flpth': map_flpth}):
+        flpths = contrib.subset_inputs(
+            unstrat_flpth, seqtab_norm_flpth, contrib_dir, pathway_l=['PWY-1', 'PWY-3'], sample_l=['s1', 's2'])
+
+    unstrat = pd.read_csv(flpths['unstrat'], sep='\t', index_col=0)
+    assert unstrat.columns.tolist() == ['s1', 's2']
+
+    seqtab_norm = pd.read_csv(flpths['seqtab_norm'], sep='\t', index_col=0)
+    assert seqtab_norm.index.tolist() == ['amp1', 'amp2'] # amp0 absent from s1, s2
+
+    # all
+    flpths = contrib.subset_inputs(unstrat_flpth, seqtab_norm_flpth, contrib_dir)
+    assert pd.read_csv(flpths['seqtab_norm'], sep='\t', index_col=0).shape == (3, 3)
+
+    with raises(Exception, match='s9'):
+        contrib.subset_inputs(unstrat_flpth, seqtab_norm_flpth, contrib_dir, sample_l=['s9'])
+    with raises(Exception, match='PWY-9'):
+        contrib.check_pathways(map_flpth, ['PWY-1', 'PWY-9'])
+
+
+####################################################################################################
+####################################################################################################
+def test_collect_outputs(tmp_path):
+    '''
+    Pathways are subset after a run on the full map
+    '''
+    contrib_out_dir = tmp_path / 'contrib'
+    pathways_out_dir = tmp_path / 'pathways_out'
+    contrib_out_dir.mkdir()
+    pathways_out_dir.mkdir()
+
+    pd.DataFrame(
+        [['amp0', '1.5', '0'], ['amp1', '0', '2']], columns=['sequence', 'PWY-1', 'PWY-2'],
+    ).to_csv(str(contrib_out_dir / 'path_abun_predictions.tsv.gz'), sep='\t', index=False, compression='gzip')
+    pd.DataFrame(
+        [['PWY-1', '1.50'], ['PWY-2', '2']], columns=['pathway', 's0'],
+    ).to_csv(str(contrib_out_dir / 'path_abun_unstrat_per_seq.tsv.gz'), sep='\t', index=False, compression='gzip')
+    pd.DataFrame(
+        [['s0', 'PWY-1', 'amp0', '1'], ['s0', 'PWY-2', 'amp1', '2']], columns=['sample', 'function', 'taxon', 'taxon_abun'],
+    ).to_csv(str(contrib_out_dir / 'path_abun_contrib.tsv.gz'), sep='\t', index=False, compression='gzip')
+
+    contrib.collect_outputs(str(contrib_out_dir), str(pathways_out_dir), ['PWY-2'])
+
+    read = lambda flnm: pd.read_csv(str(pathways_out_dir / flnm), sep='\t', dtype=str)
+    assert read('path_abun_predictions.tsv.gz').columns.tolist() == ['sequence', 'PWY-2']
+    assert read('path_abun_unstrat_per_seq.tsv.gz').values.tolist() == [['PWY-2', '2']]
+    assert read('path_abun_contrib.tsv.gz')['function'].tolist() == ['PWY-2']
+
+    # all
+    contrib.collect_outputs(str(contrib_out_dir), str(pathways_out_dir))
+    assert read('path_abun_unstrat_per_seq.tsv.gz').values.tolist() == [['PWY-1', '1.50'], ['PWY-2', '2']]
@@ -0,0 +1,87 @@
+import os
+import pandas as pd
+
+from kb_PICRUSt2.impl import dedup
+from kb_PICRUSt2.impl import metagenome
+from kb_PICRUSt2.impl.config import Var
+from kb_PICRUSt2.util.file import read_fasta, write_fasta
+from mock import *
+
+
+####################################################################################################
+####################################################################################################
+def test_collapse_expand(tmp_path):
+    '''
+    Metagenome from collapsed predictions, expanded, same as from all amplicons,
+    including normalized abundances rounded per amplicon before summing duplicates
+    '''
+    write_fasta([
+        ('amp0', 'ACGT'),
+        ('amp1', 'GGGG'),
+        ('amp2', 'acgt'), # same as amp0
+        ('amp3', 'TTTT'),
+        ('amp4', 'GG-GG'), # same as amp1
+    ], str(tmp_path / 'seqs.fna'))
+    pd.DataFrame(
+        [[10, 0], [1, 6], [4, 4], [7, 1], [1, 2]],
+        index=pd.Index(['amp0', 'amp1', 'amp2', 'amp3', 'amp4'], name=Var.amplicon_header_name),
+        columns=['s0', 's1'],
+    ).to_csv(str(tmp_path / 'seqabun.tsv'), sep='\t')
+
+    flpth = lambda flnm: str(tmp_path / flnm)
+
+    num_uniq = dedup.collapse(flpth('seqs.fna'), flpth('uniq.fna'), flpth('rep.tsv'))
+
+    assert num_uniq == 3
+    assert [id for id, _ in read_fasta(flpth('uniq.fna'))] == ['amp0', 'amp1', 'amp3']
+    assert dedup.read_rep(flpth('rep.tsv')) == dict(amp0='amp0', amp1='amp1', amp2='amp0', amp3='amp3', amp4='amp1')
+
+    # predictions, as if from the unique sequences
+    def write_predicted(out_dir, id_l):
+        os.makedirs(out_dir, exist_ok=True)
+        id2marker = dict(amp0=[2, 0.1], amp1=[3, 0.5], amp2=[2, 0.1], amp3=[1, 3.0], amp4=[3, 0.5]) # amp3 over max NSTI
+        id2func = dict(amp0=[1, 0], amp1=[2, 1], amp2=[1, 0], amp3=[5, 5], amp4=[2, 1])
+        pd.DataFrame(
+            [id2marker[id] for id in id_l],
+            index=pd.Index(id_l, name='sequence'),
+            columns=['16S_rRNA_Count', 'metadata_NSTI'],
+        ).to_csv(os.path.join(out_dir, 'marker_predicted_and_nsti.tsv.gz'), sep='\t', compression='gzip')
+        pd.DataFrame(
+            [id2func[id] for id in id_l],
+            index=pd.Index(id_l, name='sequence'),
+            columns=['EC:1', 'EC:2'],
+        ).to_csv(os.path.join(out_dir, 'EC_predicted.tsv.gz'), sep='\t', compression='gzip')
+        metagenome.predict_metagenomes(
+            flpth('seqabun.tsv'),
+            os.path.join(out_dir, 'marker_predicted_and_nsti.tsv.gz'),
+            {'EC': (os.path.join(out_dir, 'EC_predicted.tsv.gz'), os.path.join(out_dir, 'EC_metagenome_out'))},
+            id2rep=dedup.read_rep(flpth('rep.tsv')) if len(id_l) == 3 else None,
+        )
+
+    collapsed_dir, full_dir = flpth('collapsed'), flpth('full')
+    write_predicted(collapsed_dir, ['amp0', 'amp1', 'amp3'])
+    write_predicted(full_dir, ['amp0', 'amp1', 'amp2', 'amp3', 'amp4'])
+
+    # to another dir, leaving the collapsed predictions as they were
+    expanded_dir = flpth('expanded')
+    os.mkdir(expanded_dir)
+    mtime = os.path.getmtime(os.path.join(collapsed_dir, 'EC_predicted.tsv.gz'))
+    dedup.expand_outputs(collapsed_dir, expanded_dir, ['16S', 'EC'], flpth('rep.tsv'))
+    assert os.path.getmtime(os.path.join(collapsed_dir, 'EC_predicted.tsv.gz')) == mtime
+
+    for out_dir, relflpth in [
+        (expanded_dir, 'marker_predicted_and_nsti.tsv.gz'),
+        (expanded_dir, 'EC_predicted.tsv.gz'),
+        (collapsed_dir, 'EC_metagenome_out/seqtab_norm.tsv.gz'),
+        (collapsed_dir, 'EC_metagenome_out/pred_metagenome_unstrat.tsv.gz'),
+        (collapsed_dir, 'EC_metagenome_out/weighted_nsti.tsv.gz'),
+    ]:
+        collapsed = pd.read_csv(os.path.join(out_dir, relflpth), sep='\t', index_col=0)
+        full = pd.read_csv(os.path.join(full_dir, relflpth), sep='\t', index_col=0)
+        pd.testing.assert_frame_equal(collapsed, full)
+
+    # amp1 and amp4 each have 1/3 normalized to 0.33, so their EC:1 in s0 is 2 * (0.33 + 0.33),
+    # not the 2 * 0.67 from rounding their summed 2/3
+    unstrat = pd.read_csv(
+        os.path.join(collapsed_dir, 'EC_metagenome_out/pred_metagenome_unstrat.tsv.gz'), sep='\t', index_col=0)
+    assert unstrat.loc['EC:1', 's0'] == 10/2 + 4/2 + 1.32
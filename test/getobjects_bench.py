@@ -0,0 +1,130 @@
+'''
+Benchmark peak memory and time of decoding the finished `DataFileUtil.get_objects` job's `_check_job` response
+for an AmpliconMatrix, whole (`requests`' `.json()` as in `BaseClient._call`, then `to_float_array`)
+against streamed (`loads_streamed`, as in `run_job_streamed`),
+across matrix sizes, and check both give the same object and values
+
+The response is read from a temp file, whole or in chunks like `iter_content`
+Peak memory is from `tracemalloc`, which NumPy reports its buffers to, in a separate untimed pass
+
+Run from `test/` with `PYTHONPATH=../lib`, e.g.:
+
+    python getobjects_bench.py --sizes 1000x100 17770x511
+'''
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+from kb_PICRUSt2.util.jsonstream import loads_streamed
+from kb_PICRUSt2.util.validate import to_float_array
+from kb_PICRUSt2.util.rpc import CHUNK_SIZE
+
+VALUES_PATH = ('result', None, 'result', None, 'data', None, 'data', 'data', 'values')
+
+
+
+####################################################################################################
+####################################################################################################
+def write_response(num_rows, num_cols, flpth, missing_frac=0.01, seed=0):
+    '''
+    Float counts with some `null`, like the workspace returns
+    '''
+    rng = np.random.RandomState(seed)
+    a = (rng.poisson(2, size=(num_rows, num_cols)) * rng.randint(0, 2, size=(num_rows, num_cols))).astype(float)
+    values = a.tolist()
+    for i, j in zip(*np.nonzero(rng.random_sample((num_rows, num_cols)) < missing_frac)):
+        values[i][j] = None
+
+    row_ids = ['amplicon_id_%d' % i for i in range(num_rows)]
+    obj = dict(
+        amplicon_set_ref='1/2/3',
+        row_attributemapping_ref='1/3/1',
+        row_mapping={id: id for id in row_ids},
+        data=dict(
+            row_ids=row_ids,
+            col_ids=['sample_%d' % i for i in range(num_cols)],
+            values=values,
+        ),
+    )
+    resp = dict(
+        version='1.1',
+        result=[dict(
+            finished=1,
+            result=[dict(data=[dict(data=obj, info=[2, 'AmpMat', 'KBaseMatrices.AmpliconMatrix-1.2'])])],
+        )],
+        id='1',
+    )
+    with open(flpth, 'w') as fh:
+        json.dump(resp, fh)
+
+
+####################################################################################################
+####################################################################################################
+def decode_whole(flpth):
+    with open(flpth, 'rb') as fh:
+        content = fh.read() # `Response.content`
+    resp = json.loads(content.decode('utf-8')) # `Response.json()`
+    del content
+    obj = resp['result'][0]['result'][0]['data'][0]['data']
+    a = to_float_array(obj['data']['values'])
+    obj['data']['values'] = None
+    return resp, a
+
+
+def decode_streamed(flpth):
+    with open(flpth, 'rb') as fh:
+        return loads_streamed(iter(lambda: fh.read(CHUNK_SIZE), b''), VALUES_PATH)
+
+
+####################################################################################################
+####################################################################################################
+def measure(decode, flpth) -> tuple:
+    t0 = time.time()
+    res = decode(flpth)
+    t = time.time() - t0
+    del res
+
+    tracemalloc.start()
+    res = decode(flpth)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return t, peak, res
+
+
+####################################################################################################
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', default=['100x10', '1000x100', '5000x300'])
+    args = parser.parse_args()
+
+    dir = tempfile.mkdtemp()
+    try:
+        for size in args.sizes:
+            num_rows, num_cols = [int(n) for n in size.split('x')]
+            flpth = os.path.join(dir, '%s.json' % size)
+            write_response(num_rows, num_cols, flpth)
+
+            t_whole, peak_whole, (resp_whole, a_whole) = measure(decode_whole, flpth)
+            t_streamed, peak_streamed, (resp_streamed, a_streamed) = measure(decode_streamed, flpth)
+
+            same = resp_whole == resp_streamed and np.array_equal(a_whole, a_streamed, equal_nan=True)
+            print('%-12s %.0fMB response; whole %.2fs %.0fMB peak, streamed %.2fs %.0fMB peak (%.1fx less), %s' % (
+                size, os.path.getsize(flpth) / 1e6,
+                t_whole, peak_whole / 1e6, t_streamed, peak_streamed / 1e6, peak_whole / peak_streamed,
+                'same' if same else 'DIFFER',
+            ))
+
+    finally:
+        shutil.rmtree(dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+import os
+import numpy as np
+import pandas as pd
+from pytest import raises
+
+from kb_PICRUSt2.impl import hsp
+from kb_PICRUSt2.impl.hsp import HSPStore
+from kb_PICRUSt2.impl.placement import PlacementCache, hash_seq
+from kb_PICRUSt2.util.file import write_fasta
+from mock import *
+
+
+TREE = '((a:1{0},b:1{1}):1{2},c:1{3}){4};'
+FIELDS = ['edge_num', 'likelihood', 'like_weight_ratio', 'distal_length', 'pendant_length']
+
+
+####################################################################################################
+####################################################################################################
+def test_HSPStore(tmp_path):
+    store = HSPStore(str(tmp_path / 'hsp.sqlite'), ref_version='test')
+
+    assert store.get_meta('EC') is None
+    assert not store.has('EC', 't0')
+
+    ##
+    ## copy numbers stored as int
+    store.insert('EC', 't0', pd.DataFrame([[1., 0.], [3., 2.]], index=['h0', 'h1'], columns=['EC:1', 'EC:2']))
+    cols, dtype = store.get_meta('EC')
+    assert cols == ['EC:1', 'EC:2']
+    assert dtype.kind == 'i'
+
+    df = store.lookup('EC', 't0', ['h1', 'h0', 'h1'])
+    assert df.index.tolist() == ['h1', 'h0', 'h1']
+    assert df.values.tolist() == [[3, 2], [1, 0], [3, 2]]
+
+    ##
+    ## 16S stored as float for NSTI, even if the first batch's are whole
+    store.insert('16S', 't0', pd.DataFrame([[1, 0.]], index=['h0'], columns=['16S_rRNA_Count', 'metadata_NSTI']))
+    assert store.get_meta('16S')[1].kind == 'f'
+    store.insert('16S', 't1', pd.DataFrame([[1, 0.125]], index=['h0'], columns=['16S_rRNA_Count', 'metadata_NSTI']))
+
+    ##
+    ## same sequence on another tree is kept apart
+    assert store.lookup('16S', 't0', ['h0']).values.tolist() == [[1, 0]]
+    assert store.lookup('16S', 't1', ['h0']).values.tolist() == [[1, 0.125]]
+
+    assert store.has('EC', 't0') and not store.has('EC', 't1')
+
+    with raises(Exception, match='missing'):
+        store.lookup('EC', 't0', ['h2'])
+    with raises(Exception, match='missing'):
+        store.lookup('EC', 't1', ['h0'])
+    with raises(Exception, match='differ'):
+        store.insert('EC', 't1', pd.DataFrame([[1]], index=['h2'], columns=['EC:1']))
+    with raises(Exception, match='not integers'):
+        store.insert('EC', 't1', pd.DataFrame([[1.5, 0]], index=['h2'], columns=['EC:1', 'EC:2']))
+    with raises(Exception, match='not integers'): # even first batch
+        store.insert('KO', 't1', pd.DataFrame([[1.5]], index=['h2'], columns=['K1']))
+    assert not store.has('EC', 't1')
+
+    # other reference version sees nothing
+    assert not HSPStore(str(tmp_path / 'hsp.sqlite'), ref_version='other').has('EC', 't0')
+
+
+####################################################################################################
+####################################################################################################
+def test_store_and_assemble(tmp_path):
+    store = HSPStore(str(tmp_path / 'hsp.sqlite'), ref_version='test')
+    cache = PlacementCache(str(tmp_path / 'cache.sqlite'), ref_version='test')
+
+    seq_flpth = str(tmp_path / 'study.fna')
+    write_fasta([('amp0', 'ACGT'), ('amp1', 'acgu'), ('amp2', 'GGGG'), ('amp3', 'TTTT')], seq_flpth)
+    cache.insert({
+        hash_seq('ACGT'): [[0, -1., 1., .1, .2]],
+        hash_seq('GGGG'): [[1, -1., 1., .1, .2]],
+        hash_seq('TTTT'): None, # dropped
+    }, TREE, FIELDS)
+
+    # keyed on the distinct sequences
+    tree_key = hsp.get_tree_key(seq_flpth)
+    write_fasta([('x', 'TTTT'), ('y', 'GGGG'), ('z', 'ACGT')], str(tmp_path / 'other.fna'))
+    assert hsp.get_tree_key(str(tmp_path / 'other.fna')) == tree_key
+    write_fasta([('x', 'TTTT'), ('y', 'GGGG')], str(tmp_path / 'other.fna'))
+    assert hsp.get_tree_key(str(tmp_path / 'other.fna')) != tree_key
+
+    # like hsp.py on the study tree, named by amplicon id
+    predicted_flpth = str(tmp_path / 'EC_hsp.tsv.gz')
+    pd.DataFrame(
+        [[2], [2], [5]], index=pd.Index(['amp0', 'amp1', 'amp2'], name='sequence'), columns=['EC:1']
+    ).to_csv(predicted_flpth, sep='\t', compression='gzip')
+
+    out_flpth = str(tmp_path / 'out' / 'EC_predicted.tsv.gz')
+    hsp.store_and_assemble('EC', seq_flpth, tree_key, store, cache, out_flpth, predicted_flpth=predicted_flpth)
+    assert store.has('EC', tree_key)
+
+    # then from the store alone
+    os.remove(out_flpth)
+    hsp.store_and_assemble('EC', seq_flpth, tree_key, store, cache, out_flpth)
+
+    df = pd.read_csv(out_flpth, sep='\t', index_col=0)
+    assert df.index.name == 'sequence'
+    assert df.index.tolist() == ['amp0', 'amp1', 'amp2']
+    assert df['EC:1'].tolist() == [2, 2, 5]
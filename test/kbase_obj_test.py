@@ -1,6 +1,10 @@
 import unittest
 from unittest.mock import patch
+import os
+import copy
+import json
 import uuid
+import pickle
 import pandas as pd
 import numpy as np
 import itertools
@@ -40,60 +44,169 @@ def test_AmpliconMatrix_validation():
     amp_mat = AmpliconMatrix(dummy_10by8_AmpMat) # these values have been truncated to ints
     amp_mat.validate_amplicon_abundance_data()
 
-    amp_mat.obj['data']['values'] = [0.0, 0.0, 1319.0, 1.0] # float
+    amp_mat.set_values([0.0, 0.0, 1319.0, 1.0]) # float
     amp_mat.validate_amplicon_abundance_data()
 
-    amp_mat.obj['data']['values'] = [0, 0, 1319, 1] # int
+    amp_mat.set_values([0, 0, 1319, 1]) # int
     amp_mat.validate_amplicon_abundance_data()
 
-    amp_mat.obj['data']['values'] = [None, 0., 0., 1319., 1.] # float, with missing
+    amp_mat.set_values([None, 0., 0., 1319., 1.]) # float, with missing
     amp_mat.validate_amplicon_abundance_data()
 
-    amp_mat.obj['data']['values'] = [None, 0, 0, 1319, 1] # int, with missing
+    amp_mat.set_values([None, 0, 0, 1319, 1]) # int, with missing
     amp_mat.validate_amplicon_abundance_data()
 
-    amp_mat.obj['data']['values'] = [None, 0, -0., 1319.0, 1] # int/float, with missing
+    amp_mat.set_values([None, 0, -0., 1319.0, 1]) # int/float, with missing
     amp_mat.validate_amplicon_abundance_data()
 
-    amp_mat.obj['data']['values'] = [None, None, 0, -0, 0.0, 0, 0.] # 0s, with missing
+    amp_mat.set_values([None, None, 0, -0, 0.0, 0, 0.]) # 0s, with missing
     amp_mat.validate_amplicon_abundance_data()
 
-    amp_mat.obj['data']['values'] = [None, 0.999999999] # close enough
+    amp_mat.set_values([None, 0.999999999]) # close enough
     amp_mat.validate_amplicon_abundance_data() 
 
-    amp_mat.obj['data']['values'] = [None, -0.0000000001] # close enough
+    amp_mat.set_values([None, -0.0000000001]) # close enough
     amp_mat.validate_amplicon_abundance_data() 
 
-    amp_mat.obj['data']['values'] = [0.9]
+    amp_mat.set_values([0.9])
     with raises(ValidationException): amp_mat.validate_amplicon_abundance_data() 
 
-    amp_mat.obj['data']['values'] = [-1]
+    amp_mat.set_values([-1])
     with raises(ValidationException): amp_mat.validate_amplicon_abundance_data() 
 
-    amp_mat.obj['data']['values'] = [None, None, None]
+    amp_mat.set_values([None, None, None])
     with raises(ValidationException): amp_mat.validate_amplicon_abundance_data() 
 
-    amp_mat.obj['data']['values'] = [None]
+    amp_mat.set_values([None])
     with raises(ValidationException): amp_mat.validate_amplicon_abundance_data()
 
-    amp_mat.obj['data']['values'] = [None, -1]
+    amp_mat.set_values([None, -1])
     with raises(ValidationException): amp_mat.validate_amplicon_abundance_data()
 
-    amp_mat.obj['data']['values'] = [None, None, 1.00001]
+    amp_mat.set_values([None, None, 1.00001])
     with raises(ValidationException): amp_mat.validate_amplicon_abundance_data()
 
-    amp_mat.obj['data']['values'] = [-1.0, 0, 1319]
+    amp_mat.set_values([-1.0, 0, 1319])
     with raises(ValidationException): amp_mat.validate_amplicon_abundance_data()
 
-    amp_mat.obj['data']['values'] = [None, 0, 1, 2, 3, 4.5]
+    amp_mat.set_values([None, 0, 1, 2, 3, 4.5])
     with raises(ValidationException): amp_mat.validate_amplicon_abundance_data()
 
-    amp_mat.obj['data']['values'] = [None, 0.0, 1.0, 2.0, 3.0, 4.00001] # 4.00001 would pass with np.allclose default rtol
+    amp_mat.set_values([None, 0.0, 1.0, 2.0, 3.0, 4.00001]) # 4.00001 would pass with np.allclose default rtol
     with raises(ValidationException): amp_mat.validate_amplicon_abundance_data()
 
 
 
 
+####################################################################################################
+####################################################################################################
+@patch.dict('kb_PICRUSt2.impl.kbase_obj.Var', values={'dfu': get_mock_dfu('dummy_10by8')})
+def test_AmpliconMatrix_prefilter(tmp_path):
+    amp_mat = AmpliconMatrix(dummy_10by8_AmpMat)
+    amp_mat.set_data(
+        row_ids=['amp0', 'amp1', 'amp2', 'amp3'],
+        col_ids=['s0', 's1', 's2'],
+        values=[
+            [1, 0, None], # total 1, prevalence 1
+            [5, 5, 5], # total 15, prevalence 3
+            [0, 20, 0], # total 20, prevalence 1
+            [2, 2, 0], # total 4, prevalence 2
+        ],
+    )
+
+    assert amp_mat.prefilter() == []
+    assert amp_mat.prefilter(min_total_count=4) == ['amp0']
+    assert amp_mat.prefilter(min_prevalence=2) == ['amp0', 'amp2']
+    assert amp_mat.prefilter(top_n=2) == ['amp0', 'amp3']
+    assert amp_mat.prefilter(min_prevalence=2, top_n=1) == ['amp0', 'amp2', 'amp3']
+
+    with raises(ValidationException):
+        amp_mat.prefilter(min_total_count=100)
+
+    # filtered amplicons left out of PICRUSt2 inputs
+    amp_mat.prefilter(min_total_count=4)
+    flpth = str(tmp_path / 'seqabun.tsv')
+    amp_mat.to_seq_abundance_table(flpth)
+    assert pd.read_csv(flpth, sep='\t', index_col=0).index.tolist() == ['amp1', 'amp2', 'amp3']
+    assert len(amp_mat.row_ids) == 4 # but kept in object
+
+
+####################################################################################################
+####################################################################################################
+@patch.dict('kb_PICRUSt2.impl.kbase_obj.Var', values={'dfu': get_mock_dfu('dummy_10by8')})
+def test_AmpliconMatrix_compact():
+    '''
+    Parsed into arrays on load, and rebuilt into the same workspace object for saving
+    '''
+    with open(os.path.join(testData_dir, 'by_dataset_input/dummy_10by8/get_objects/get_objects_AmpliconMatrix.json')) as fh:
+        obj = json.load(fh)['data'][0]['data']
+
+    amp_mat = AmpliconMatrix(dummy_10by8_AmpMat)
+    assert amp_mat.values.shape == (len(obj['data']['row_ids']), len(obj['data']['col_ids']))
+    assert amp_mat.row_attrmap_upa == obj['row_attributemapping_ref']
+    assert amp_mat.to_obj() == obj
+
+    with raises(AttributeError):
+        amp_mat.obj = obj # no `__dict__`
+
+    amp_mat.set_data(['amp0', 'amp1'], ['s0', 's1'], [[1, None], [5, '']])
+    assert amp_mat.missing.tolist() == [[False, True], [False, True]]
+    assert amp_mat.to_obj()['data']['values'] == [[1, None], [5, None]]
+
+    with raises(ValidationException):
+        amp_mat.set_values([['a', 1]])
+
+    amp_mat.row_attrmap_upa = '1/2/3'
+    with patch.dict('kb_PICRUSt2.impl.kbase_obj.Var', values={'gapi': get_mock_gapi('dummy_10by8'), 'params': {'workspace_id': 0}}):
+        amp_mat.save(name='saved')
+        data = Var.gapi.save_object.call_args[0][0]['data']
+        assert data['data']['values'] == [[1, None], [5, None]]
+        assert data['row_attributemapping_ref'] == '1/2/3'
+
+
+####################################################################################################
+####################################################################################################
+@patch.dict('kb_PICRUSt2.impl.kbase_obj.Var', values={'dfu': get_mock_dfu('dummy_10by8'), 'ws': get_mock_ws('dummy_10by8')})
+def test_lazy_fetch():
+    '''
+    AmpliconMatrix ids fetched first, by included paths, and the rest on first use
+    AttributeMapping fetched whole, once
+    '''
+    with open(os.path.join(testData_dir, 'by_dataset_input/dummy_10by8/get_objects/get_objects_AmpliconMatrix.json')) as fh:
+        obj = json.load(fh)['data'][0]['data']
+
+    amp_mat = AmpliconMatrix(dummy_10by8_AmpMat)
+    assert Var.ws.get_objects2.call_args[0][0]['objects'][0]['included'] == AmpliconMatrix.HEAD_PATHS
+    assert amp_mat.row_ids.tolist() == obj['data']['row_ids']
+    assert amp_mat.row_attrmap_upa == obj['row_attributemapping_ref']
+    assert not Var.dfu.get_objects.called
+
+    # copying, pickling and dunder probes don't fetch
+    amp_mat_copy = copy.deepcopy(amp_mat)
+    amp_mat_unpickled = pickle.loads(pickle.dumps(amp_mat))
+    assert amp_mat_unpickled.row_ids.tolist() == obj['data']['row_ids']
+    assert not hasattr(amp_mat, '__len__') and not hasattr(amp_mat, '_repr_html_')
+    assert not Var.dfu.get_objects.called
+
+    amp_mat.validate_amplicon_abundance_data() # fetches values
+    assert Var.dfu.get_objects.call_count == 1
+    assert amp_mat.to_obj() == obj
+    amp_mat.fetch_values()
+    assert Var.dfu.get_objects.call_count == 1
+    assert copy.copy(amp_mat).values is amp_mat.values
+    assert amp_mat_copy.to_obj() == obj # fetches its own values
+    assert Var.dfu.get_objects.call_count == 2
+
+    attr_map = AttributeMapping(dummy_10by8_AttrMap, amp_mat)
+    assert Var.dfu.get_objects.call_count == 3
+    assert 'instances' in attr_map.obj
+
+    ind, _ = attr_map.add_attribute_slot('cloud type', 'testing')
+    attr_map.map_update_attribute(ind, {'amplicon_id_4': 'dummy0'})
+    assert Var.dfu.get_objects.call_count == 3
+    assert attr_map.obj['instances']['amplicon_id_4'][ind] == 'dummy0'
+
+
 ####################################################################################################
 ####################################################################################################
 @patch.dict('kb_PICRUSt2.impl.kbase_obj.Var', values={'dfu': get_mock_dfu('dummy_10by8'), })
@@ -0,0 +1,131 @@
+'''
+Benchmark in-process `predict_metagenomes` against one `metagenome_pipeline.py` subprocess per function,
+on synthetic tables shaped like a real study
+
+Run from `test/` with `PYTHONPATH=../lib`, e.g., in the module's container:
+
+    python metagenome_bench.py --num_seqs 5000 --num_samples 100
+
+The subprocess path is only run, and outputs compared, if `metagenome_pipeline.py` is on the PATH
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+from kb_PICRUSt2.impl import metagenome
+from kb_PICRUSt2.impl.config import Var
+
+
+FUNC2NUM = dict(EC=2500, KO=10000, COG=5000)
+
+
+
+####################################################################################################
+####################################################################################################
+def write_inputs(dir, num_seqs, num_samples, seed=0):
+    rng = np.random.RandomState(seed)
+    seq_l = ['amp%d' % i for i in range(num_seqs)]
+
+    seqabun_flpth = os.path.join(dir, 'seqabun.tsv')
+    seqabun = pd.DataFrame(
+        rng.poisson(2, size=(num_seqs, num_samples)) * rng.randint(0, 2, size=(num_seqs, num_samples)),
+        index=pd.Index(seq_l, name=Var.amplicon_header_name),
+        columns=['sample%d' % i for i in range(num_samples)],
+    )
+    seqabun.to_csv(seqabun_flpth, sep='\t', float_format='%g')
+
+    marker_flpth = os.path.join(dir, 'marker_predicted_and_nsti.tsv.gz')
+    pd.DataFrame(
+        {
+            '16S_rRNA_Count': rng.randint(1, 8, size=num_seqs),
+            'metadata_NSTI': rng.exponential(0.3, size=num_seqs).round(6),
+        },
+        index=pd.Index(seq_l, name='sequence'),
+    ).to_csv(marker_flpth, sep='\t', compression='gzip')
+
+    func2flpths = {}
+    for FUNC, num_funcs in FUNC2NUM.items():
+        predicted_flpth = os.path.join(dir, '%s_predicted.tsv.gz' % FUNC)
+        pd.DataFrame(
+            rng.poisson(0.2, size=(num_seqs, num_funcs)),
+            index=pd.Index(seq_l, name='sequence'),
+            columns=['%s:%d' % (FUNC, i) for i in range(num_funcs)],
+        ).to_csv(predicted_flpth, sep='\t', compression='gzip')
+        func2flpths[FUNC] = (predicted_flpth, os.path.join(dir, 'engine', '%s_metagenome_out' % FUNC))
+
+    return seqabun_flpth, marker_flpth, func2flpths
+
+
+####################################################################################################
+####################################################################################################
+def compare(engine_dir, subprocess_dir):
+    '''
+    Same rows, same columns in the same order, and the same text in every cell,
+    i.e., the written TSVs are identical up to row order,
+    since metagenome_pipeline.py's sequence order is set order
+    '''
+    for flnm in ['pred_metagenome_unstrat.tsv.gz', 'seqtab_norm.tsv.gz', 'weighted_nsti.tsv.gz']:
+        df0, df1 = [
+            pd.read_csv(os.path.join(dir, flnm), sep='\t', index_col=0, dtype=str, keep_default_na=False)
+            for dir in [engine_dir, subprocess_dir]
+        ]
+        if df0.index.name != df1.index.name or df0.columns.tolist() != df1.columns.tolist():
+            diff = 'DIFFER in header'
+        elif df0.index.has_duplicates or df1.index.has_duplicates or set(df0.index) != set(df1.index):
+            diff = 'DIFFER in rows (%d vs %d)' % (df0.shape[0], df1.shape[0])
+        else:
+            num_cells = (df0.values != df1.loc[df0.index].values).sum()
+            diff = 'DIFFER in %d cells' % num_cells if num_cells else None
+        print('    %-32s %s' % (flnm, diff or 'match'))
+
+
+####################################################################################################
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_seqs', type=int, default=2000)
+    parser.add_argument('--num_samples', type=int, default=50)
+    args = parser.parse_args()
+
+    dir = tempfile.mkdtemp()
+    try:
+        seqabun_flpth, marker_flpth, func2flpths = write_inputs(dir, args.num_seqs, args.num_samples)
+
+        t0 = time.time()
+        metagenome.predict_metagenomes(seqabun_flpth, marker_flpth, func2flpths)
+        t_engine = time.time() - t0
+        print('in-process, %d functions: %.2fs' % (len(func2flpths), t_engine))
+
+        if shutil.which('metagenome_pipeline.py') is None:
+            print('metagenome_pipeline.py not on PATH, skipping subprocess comparison')
+            return
+
+        t0 = time.time()
+        for FUNC, (predicted_flpth, engine_dir) in func2flpths.items():
+            subprocess_dir = os.path.join(dir, 'subprocess', '%s_metagenome_out' % FUNC)
+            subprocess.run([
+                'metagenome_pipeline.py',
+                '-i', seqabun_flpth,
+                '-m', marker_flpth,
+                '-f', predicted_flpth,
+                '-o', subprocess_dir,
+            ], check=True, stdout=subprocess.DEVNULL)
+        t_subprocess = time.time() - t0
+        print('subprocess, %d functions: %.2fs (%.1fx)' % (len(func2flpths), t_subprocess, t_subprocess / t_engine))
+
+        for FUNC, (_, engine_dir) in func2flpths.items():
+            print('  %s' % FUNC)
+            compare(engine_dir, os.path.join(dir, 'subprocess', '%s_metagenome_out' % FUNC))
+
+    finally:
+        shutil.rmtree(dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
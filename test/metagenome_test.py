@@ -0,0 +1,57 @@
+import os
+import pandas as pd
+
+from kb_PICRUSt2.impl import metagenome
+from kb_PICRUSt2.impl.config import Var
+from mock import *
+
+
+####################################################################################################
+####################################################################################################
+def write_inputs(tmp_path):
+    seqabun = pd.DataFrame(
+        [[10, 0], [3, 6], [4, 4], [7, 1]],
+        index=pd.Index(['amp0', 'amp1', 'amp2', 'amp3'], name=Var.amplicon_header_name),
+        columns=['s0', 's1'],
+    )
+    marker = pd.DataFrame(
+        [[2, 0.1], [3, 0.5], [1, 2.5], [1, 0.2]], # amp2 over max NSTI
+        index=pd.Index(['amp0', 'amp1', 'amp2', 'amp3'], name='sequence'),
+        columns=['16S_rRNA_Count', 'metadata_NSTI'],
+    )
+    func = pd.DataFrame(
+        [[1, 0, 0], [2, 1, 0], [5, 5, 0]], # amp3 not predicted
+        index=pd.Index(['amp0', 'amp1', 'amp2'], name='sequence'),
+        columns=['EC:1', 'EC:2', 'EC:3'],
+    )
+
+    flpths = [str(tmp_path / flnm) for flnm in ['seqabun.tsv', 'marker.tsv.gz', 'EC.tsv.gz']]
+    seqabun.to_csv(flpths[0], sep='\t')
+    marker.to_csv(flpths[1], sep='\t', compression='gzip')
+    func.to_csv(flpths[2], sep='\t', compression='gzip')
+    return flpths
+
+
+####################################################################################################
+####################################################################################################
+def test_predict_metagenomes(tmp_path):
+    seqabun_flpth, marker_flpth, func_flpth = write_inputs(tmp_path)
+    out_dir = str(tmp_path / 'EC_metagenome_out')
+
+    metagenome.predict_metagenomes(seqabun_flpth, marker_flpth, {'EC': (func_flpth, out_dir)})
+
+    # only amp0, amp1 overlap
+    norm = pd.read_csv(os.path.join(out_dir, 'seqtab_norm.tsv.gz'), sep='\t', index_col=0)
+    assert norm.index.name == 'normalized'
+    assert norm.index.tolist() == ['amp0', 'amp1']
+    assert norm.values.tolist() == [[5, 0], [1, 2]]
+
+    unstrat = pd.read_csv(os.path.join(out_dir, 'pred_metagenome_unstrat.tsv.gz'), sep='\t', index_col=0)
+    assert unstrat.index.name == 'function'
+    assert unstrat.index.tolist() == ['EC:1', 'EC:2'] # all-zero EC:3 dropped
+    assert unstrat.columns.tolist() == ['s0', 's1']
+    assert unstrat.values.tolist() == [[7, 4], [1, 2]]
+
+    nsti = pd.read_csv(os.path.join(out_dir, 'weighted_nsti.tsv.gz'), sep='\t', index_col=0)
+    assert nsti.index.tolist() == ['s0', 's1']
+    assert nsti['weighted_NSTI'].round(6).tolist() == [round((10*0.1 + 3*0.5)/13, 6), 0.5]
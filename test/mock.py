@@ -6,12 +6,14 @@ import logging
 import json
 
 from installed_clients.DataFileUtilClient import DataFileUtil
+from installed_clients.WorkspaceClient import Workspace
 from installed_clients.KBaseReportClient import KBaseReport
 from installed_clients.GenericsAPIClient import GenericsAPI
 from installed_clients.FunctionalProfileUtilClient import FunctionalProfileUtil
 
 from kb_PICRUSt2.impl.config import Var
 from kb_PICRUSt2.util.cli import run_check
+from kb_PICRUSt2.util.dag import run_func
 from kb_PICRUSt2.util.debug import dprint
 
 
@@ -91,6 +93,68 @@ def get_mock_gapi(dataset):
         
 
 
+####################################################################################################
+####################################################################################################
+def _load_get_objects(dataset, upa_path) -> dict:
+    upa = upa_path.split(';')[-1] # last UPA in ref path
+    flnm = {
+        enigma50by30_noAttrMaps_noSampleSet : 'AmpliconMatrix.json',
+        enigma50by30 : 'AmpliconMatrix.json',
+        enigma50by30_rowAttrMap : 'row_AttributeMapping.json',
+        enigma17770by511: 'AmpliconMatrix.json',
+        enigma17770by511_rowAttrMap: 'row_AttributeMapping.json',
+        #dummy_10by8: 'get_objects_AmpliconSet.json',
+        dummy_10by8_AmpMat: 'get_objects_AmpliconMatrix.json',
+        dummy_10by8_AttrMap: 'get_objects_AttributeMapping.json',
+        userTest : 'AmpliconMatrix.json',
+        }[upa]
+    flpth = os.path.join(testData_dir, 'by_dataset_input', dataset, 'get_objects', flnm)
+
+    with open(flpth) as f:
+        obj = json.load(f)
+
+    return obj
+
+
+####################################################################################################
+####################################################################################################
+def get_mock_ws(dataset):
+    '''
+    `get_objects2` from the same files as `get_mock_dfu`,
+    projected to `included` paths (plain keys only)
+    '''
+    mock_ws = create_autospec(Workspace, instance=True)
+
+    def mock_ws_get_objects2(params):
+        logging.info('Mocking `ws.get_objects2` with `params=%s`' % str(params))
+
+        spec = params['objects'][0]
+        obj = _load_get_objects(dataset, spec['ref'])
+        if 'included' not in spec:
+            return obj
+
+        data = obj['data'][0]['data']
+        data_included = {}
+        for path in spec['included']:
+            *keys, key = path.strip('/').split('/')
+            src, dst = data, data_included
+            for k in keys:
+                if k not in src:
+                    break
+                src = src[k]
+                dst = dst.setdefault(k, {})
+            else:
+                if key in src:
+                    dst[key] = src[key]
+
+        obj['data'][0]['data'] = data_included
+        return obj
+
+    mock_ws.get_objects2.side_effect = mock_ws_get_objects2
+
+    return mock_ws
+
+
 ####################################################################################################
 ####################################################################################################
 def get_mock_dfu(dataset):
@@ -116,25 +180,7 @@ def get_mock_dfu(dataset):
     def mock_dfu_get_objects(params):
         logging.info('Mocking `dfu.get_objects` with `params=%s`' % str(params))
 
-        upa_path = params['object_refs'][0]
-        upa = upa_path.split(';')[-1] # last UPA in ref path
-        flnm = {
-            enigma50by30_noAttrMaps_noSampleSet : 'AmpliconMatrix.json',
-            enigma50by30 : 'AmpliconMatrix.json',
-            enigma50by30_rowAttrMap : 'row_AttributeMapping.json',
-            enigma17770by511: 'AmpliconMatrix.json',
-            enigma17770by511_rowAttrMap: 'row_AttributeMapping.json',
-            #dummy_10by8: 'get_objects_AmpliconSet.json',
-            dummy_10by8_AmpMat: 'get_objects_AmpliconMatrix.json',
-            dummy_10by8_AttrMap: 'get_objects_AttributeMapping.json',
-            userTest : 'AmpliconMatrix.json',
-            }[upa]
-        flpth = os.path.join(testData_dir, 'by_dataset_input', dataset, 'get_objects', flnm)
-
-        with open(flpth) as f:
-            obj = json.load(f)
-
-        return obj
+        return _load_get_objects(dataset, params['object_refs'][0])
 
     mock_dfu.get_objects.side_effect = mock_dfu_get_objects
 
@@ -151,7 +197,7 @@ def get_mock_run_check(dataset):
     mock_run_check = create_autospec(run_check)
 
     # side effect
-    def mock_run_check_(cmd):
+    def mock_run_check_(cmd, **kwargs):
         logging.info('Mocking running cmd `%s`' % cmd)
 
         # test data
@@ -169,6 +215,23 @@ def get_mock_run_check(dataset):
     return mock_run_check
 
 
+####################################################################################################
+####################################################################################################
+def get_mock_run_func():
+    '''
+    Avoid in-process compute stages,
+    whose outputs are already in the `Var.out_dir` copied over by `get_mock_run_check`
+    '''
+    mock_run_func = create_autospec(run_func)
+
+    def mock_run_func_(func):
+        logging.info('Mocking running func `%s`' % str(func))
+
+    mock_run_func.side_effect = mock_run_func_
+
+    return mock_run_func
+
+
 ####################################################################################################
 ####################################################################################################
 def get_mock_kbr(dataset=None): 
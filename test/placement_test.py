@@ -0,0 +1,163 @@
+import os
+import json
+from pytest import raises
+
+from kb_PICRUSt2.impl import placement
+from kb_PICRUSt2.impl.placement import PlacementCache, hash_seq
+from kb_PICRUSt2.impl.plan import ResourcePlan
+from kb_PICRUSt2.util.file import read_fasta, write_fasta
+from mock import *
+
+
+TREE = '((a:1{0},b:1{1}):1{2},c:1{3}){4};'
+FIELDS = ['edge_num', 'likelihood', 'like_weight_ratio', 'distal_length', 'pendant_length']
+
+
+####################################################################################################
+####################################################################################################
+def mock_place_seqs(novel_seq_flpth, intermediate_dir, drop=()):
+    '''
+    Write jplace like place_seqs.py would, dropping any hashes in `drop`
+    '''
+    os.makedirs(os.path.join(intermediate_dir, 'epa_out'))
+    placement_l = [
+        {'p': [[i, -100.0 - i, 1.0, 0.1, 0.2]], 'n': [seq_hash]}
+        for i, (seq_hash, _) in enumerate(read_fasta(novel_seq_flpth))
+        if seq_hash not in drop
+    ]
+    with open(os.path.join(intermediate_dir, 'epa_out', 'epa_result.jplace'), 'w') as fh:
+        json.dump({'tree': TREE, 'placements': placement_l, 'fields': FIELDS, 'version': 3}, fh)
+
+
+####################################################################################################
+####################################################################################################
+def test_placement_cache(tmp_path):
+    cache = PlacementCache(str(tmp_path / 'cache.sqlite'), ref_version='test')
+
+    ##
+    ## first study, nothing cached
+    seq_flpth = str(tmp_path / 'study0.fna')
+    write_fasta([
+        ('amp0', 'ACGT'), 
+        ('amp1', 'acgu'), # same as amp0 once normalized
+        ('amp2', 'GGGG'),
+        ('amp3', 'TTTT'), # will be dropped
+    ], seq_flpth)
+
+    novel_seq_flpth = str(tmp_path / 'novel0.fna')
+    assert placement.stage_novel(seq_flpth, novel_seq_flpth, cache) == 3
+
+    intermediate_dir = str(tmp_path / 'intermediate0')
+    mock_place_seqs(novel_seq_flpth, intermediate_dir, drop=[hash_seq('TTTT')])
+
+    merged_flpth = str(tmp_path / 'merged0.jplace')
+    placement.merge_placements(seq_flpth, novel_seq_flpth, [intermediate_dir], merged_flpth, cache)
+
+    with open(merged_flpth) as fh:
+        merged = json.load(fh)
+    name2p = {p['n'][0]: p['p'] for p in merged['placements']}
+    assert merged['tree'] == TREE
+    assert sorted(name2p) == ['amp0', 'amp1', 'amp2']
+    assert name2p['amp0'] == name2p['amp1']
+
+    ##
+    ## second study, only new sequence placed
+    seq_flpth = str(tmp_path / 'study1.fna')
+    write_fasta([
+        ('x0', 'GGGG'), 
+        ('x1', 'TTTT'), 
+        ('x2', 'CCCC'),
+    ], seq_flpth)
+
+    novel_seq_flpth = str(tmp_path / 'novel1.fna')
+    assert placement.stage_novel(seq_flpth, novel_seq_flpth, cache) == 1
+
+    intermediate_dir = str(tmp_path / 'intermediate1')
+    mock_place_seqs(novel_seq_flpth, intermediate_dir)
+
+    merged_flpth = str(tmp_path / 'merged1.jplace')
+    placement.merge_placements(seq_flpth, novel_seq_flpth, [intermediate_dir], merged_flpth, cache)
+
+    with open(merged_flpth) as fh:
+        merged = json.load(fh)
+    assert sorted(p['n'][0] for p in merged['placements']) == ['x0', 'x2'] # x1 remembered as dropped
+
+    ##
+    ## third study, all cached
+    novel_seq_flpth = str(tmp_path / 'novel2.fna')
+    assert placement.stage_novel(seq_flpth, novel_seq_flpth, cache) == 0
+    placement.merge_placements(seq_flpth, novel_seq_flpth, [], merged_flpth, cache)
+
+    ##
+    ## different reference tree can't be merged in
+    seq_flpth = str(tmp_path / 'study3.fna')
+    write_fasta([('y0', 'AAAA')], seq_flpth)
+    novel_seq_flpth = str(tmp_path / 'novel3.fna')
+    placement.stage_novel(seq_flpth, novel_seq_flpth, cache)
+    intermediate_dir = str(tmp_path / 'intermediate3')
+    mock_place_seqs(novel_seq_flpth, intermediate_dir)
+    jplace_flpth = os.path.join(intermediate_dir, 'epa_out', 'epa_result.jplace')
+    with open(jplace_flpth) as fh:
+        jplace = json.load(fh)
+    jplace['tree'] = '(a:1{0},b:1{1}){2};'
+    with open(jplace_flpth, 'w') as fh:
+        json.dump(jplace, fh)
+
+    with raises(Exception, match='differs'):
+        placement.merge_placements(seq_flpth, novel_seq_flpth, [intermediate_dir], merged_flpth, cache)
+
+
+####################################################################################################
+####################################################################################################
+def test_sharded_placement(tmp_path):
+    cache = PlacementCache(str(tmp_path / 'cache.sqlite'), ref_version='test')
+
+    seq_flpth = str(tmp_path / 'study.fna')
+    write_fasta([('amp%d' % i, 'ACGT' * (i + 1)) for i in range(7)], seq_flpth)
+
+    novel_seq_flpth = str(tmp_path / 'novel.fna')
+    assert placement.stage_novel(seq_flpth, novel_seq_flpth, cache) == 7
+
+    shard_flpth_l = [str(tmp_path / ('shard%d.fna' % i)) for i in range(3)]
+    placement.shard_fasta(novel_seq_flpth, shard_flpth_l)
+
+    # every sequence in exactly one shard, balanced by length
+    shard_l = [read_fasta(flpth) for flpth in shard_flpth_l]
+    assert sorted(id for shard in shard_l for id, _ in shard) == sorted(id for id, _ in read_fasta(novel_seq_flpth))
+    size_l = [sum(len(seq) for _, seq in shard) for shard in shard_l]
+    assert max(size_l) - min(size_l) <= 4 * 7
+
+    intermediate_dir_l = []
+    for i, flpth in enumerate(shard_flpth_l):
+        intermediate_dir = str(tmp_path / ('intermediate%d' % i))
+        mock_place_seqs(flpth, intermediate_dir)
+        intermediate_dir_l.append(intermediate_dir)
+
+    merged_flpth = str(tmp_path / 'merged.jplace')
+    placement.merge_placements(seq_flpth, novel_seq_flpth, intermediate_dir_l, merged_flpth, cache)
+
+    with open(merged_flpth) as fh:
+        merged = json.load(fh)
+    assert sorted(p['n'][0] for p in merged['placements']) == ['amp%d' % i for i in range(7)]
+
+
+####################################################################################################
+####################################################################################################
+def test_plan_place():
+    GB = 1024 ** 3
+
+    # small input, one shard with all cores
+    plan = ResourcePlan(num_hsp=3, ncores=8, mem=64 * GB)
+    plan.plan_place(500)
+    assert plan.num_place_shards == 1
+    assert plan.p_place == 8
+
+    # large input spread over slots that fit in memory
+    plan.plan_place(40000)
+    assert plan.num_concurrent_place == 7 # 64GB // (8GB base + 1GB for a minimum shard)
+    assert plan.num_place_shards * plan.place_shard_size >= 40000
+    assert plan.place_mem * plan.num_concurrent_place <= 64 * GB
+
+    # nothing to place
+    plan.plan_place(0)
+    assert plan.num_place_shards == 0
@@ -0,0 +1,34 @@
+'''
+Refresh the preflight calibration table from a benchmark run of `run_picrust2_pipeline`
+
+Run the app on cold caches (fresh `shared_folder`), then from `test/` with `PYTHONPATH=../lib`:
+
+    python preflight_calibrate.py /kb/module/work/tmp/run_dir_picrust2_<hash>/return
+
+That return dir must have the run's `preflight.json`, `timings.json` and `process_summary.json`
+Pass `--calib_flpth` to write somewhere other than the packaged table
+'''
+import sys
+import json
+import argparse
+import logging
+
+from kb_PICRUSt2.impl import preflight
+
+
+####################################################################################################
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('return_dir')
+    parser.add_argument('--calib_flpth', default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    calib = preflight.refresh_calibration(args.return_dir, args.calib_flpth)
+    print(json.dumps(calib, indent=2))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
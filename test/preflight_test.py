@@ -0,0 +1,113 @@
+import os
+import json
+
+from kb_PICRUSt2.impl import preflight
+from kb_PICRUSt2.impl.params import Params
+from kb_PICRUSt2.impl.plan import ResourcePlan
+from kb_PICRUSt2.util.resource import GB
+from mock import *
+
+
+FUNC_l = ['16S', 'EC', 'KO']
+
+
+####################################################################################################
+####################################################################################################
+def test_get_seq_stats(tmp_path):
+    flpth = str(tmp_path / 'seqs.fna')
+    with open(flpth, 'w') as fh:
+        fh.write('>a\nACGT\nAC\n>b\nACGTACGT\n')
+
+    assert preflight.get_seq_stats(flpth) == (2, 14)
+
+
+####################################################################################################
+####################################################################################################
+def test_estimate():
+    calib = preflight.load_calibration()
+
+    small = preflight.estimate(1000, 10, 250000, FUNC_l, 0, 8, calib)
+    big = preflight.estimate(20000, 500, 5000000, FUNC_l, 0, 8, calib)
+    more_funcs = preflight.estimate(1000, 10, 250000, FUNC_l + ['COG', 'PFAM'], 0, 8, calib)
+    contrib = preflight.estimate(1000, 10, 250000, FUNC_l, 10, 8, calib)
+
+    for k in ['cpu_s', 'wall_s', 'scratch_bytes']:
+        assert big[k] > small[k]
+        assert more_funcs[k] > small[k]
+    assert 'contrib' in contrib['by_stage'] and 'contrib' not in small['by_stage']
+    assert contrib['cpu_s'] > small['cpu_s']
+
+    # more cores, less wall
+    assert preflight.estimate(1000, 10, 250000, FUNC_l, 0, 1, calib)['wall_s'] > small['wall_s']
+
+
+####################################################################################################
+####################################################################################################
+def test_preflight(tmp_path):
+    calib = preflight.load_calibration()
+    calib['contrib']['mem_bytes_per_cell'] = 1e6 # contributions are what doesn't fit
+    params = Params(dict(
+        amplicon_matrix_upa='1/2/3',
+        output_name='out',
+        contrib_options=dict(per_sequence_contrib=1),
+    ))
+    plan = ResourcePlan(num_hsp=3, ncores=8, mem=64 * GB)
+    args = (2000, 100, 500000, FUNC_l, params, plan, str(tmp_path))
+
+    # only logged, nothing changed
+    res = preflight.preflight(*args, calib=calib, mode='log')
+    assert len(res['shortfalls']) == 1 and 'peak memory' in res['shortfalls'][0]
+    assert 'contrib' in res['estimate']['by_stage']
+    assert res['dims']['contrib_num_samples'] == 100 and res['dims']['full_contrib'] is True
+    assert params.getd('per_sequence_contrib')
+    json.dumps(res)
+
+    assert preflight.preflight(*args, calib=calib, mode='off')['estimate'] is None
+    assert preflight.load_calibration()['measured'] is False # shipped
+
+
+####################################################################################################
+####################################################################################################
+def test_refresh_calibration(tmp_path):
+    calib_flpth = str(tmp_path / 'calib.json')
+    calib = preflight.load_calibration()
+    with open(calib_flpth, 'w') as fh:
+        json.dump(calib, fh)
+
+    return_dir = str(tmp_path / 'return')
+    os.mkdir(return_dir)
+
+    def dump(obj, flnm):
+        with open(os.path.join(return_dir, flnm), 'w') as fh:
+            json.dump(obj, fh)
+
+    dump(dict(dims=dict(
+        num_seqs=2000, num_samples=100, total_seq_len=500000, FUNC_l=FUNC_l, contrib_num_samples=0)), 'preflight.json')
+    # cmd stages' spans only wait on them, so their CPU comes from sampling
+    span = lambda name, cpu_s: dict(name=name, cpu_s=cpu_s)
+    dump(dict(spans=[
+        span('stage:place_0', 0), span('stage:place_1', 0),
+        span('stage:hsp_novel_placements', 0),
+        span('stage:hsp_KO', 0),
+        span('stage:metagenome', 20), # in-process, so not sampled
+        span('stage:pathways', 0),
+    ]), 'timings.json')
+    summary = lambda cpu_s, peak_gb: dict(cpu_s=cpu_s, peak_tree_rss_bytes=peak_gb * GB)
+    dump(dict(
+        place_0=summary(300, 1),
+        place_1=summary(200, 1),
+        hsp_novel_placements=summary(1000, 20),
+        hsp_KO=summary(100, 3),
+        pathways=summary(50, 1),
+    ), 'process_summary.json')
+
+    calib_new = preflight.refresh_calibration(return_dir, calib_flpth)
+
+    assert calib_new['place']['cpu_s_per_kbp'] == 1 # 500s / 500kbp
+    assert calib_new['hsp']['cpu_s_per_kseq']['KO'] == 50
+    assert calib_new['hsp']['cpu_s_per_kseq']['EC'] == calib['hsp']['cpu_s_per_kseq']['EC'] # no span
+    assert calib_new['hsp']['mem_gb'] == 3 # not the placement run's
+    assert calib_new['pathways']['cpu_s_per_sample'] == 0.5
+    assert calib_new['metagenome']['cpu_s_per_gcell'] == round(20 / (2000 * 100 * (1 + 2913 + 10543) / 1e9), 4)
+    assert calib_new['measured'] is True and '_comment' not in calib_new
+    assert preflight.load_calibration(calib_flpth) == calib_new
@@ -13,7 +13,7 @@ from installed_clients.WorkspaceClient import Workspace
 from kb_PICRUSt2.kb_PICRUSt2Impl import kb_PICRUSt2 
 from kb_PICRUSt2.impl.kbase_obj import AmpliconMatrix, AttributeMapping
 from kb_PICRUSt2.impl import appfile
-from kb_PICRUSt2.impl.report import do_heatmap, HTMLReportWriter
+from kb_PICRUSt2.impl.report import do_heatmap, HTMLReportWriter, get_tsv_shape, estimate_heatmap_mem, render_heatmap
 from kb_PICRUSt2.impl.config import Var
 from kb_PICRUSt2.impl.error import * # Exceptions
 from kb_PICRUSt2.util.debug import dprint
@@ -64,6 +64,31 @@ class ReportTest(config.BaseTest):
 
 
 
+####################################################################################################
+####################################################################################################
+    def test_render_heatmap(self):
+        '''
+        Shape/memory estimate without parsing, and rendering in a child process
+        '''
+        run_dir = os.path.join(config.shared_folder, 'test_render_heatmap_' + str(uuid.uuid4()))
+        os.mkdir(run_dir)
+
+        tsvgz_flpth = os.path.join(run_dir, 'random.tsv.gz')
+        pd.DataFrame(
+            np.random.random((30, 7)),
+            index=['dummy_ind_%d' % i for i in range(30)],
+            columns=['dummy_col_%d' % i for i in range(7)],
+        ).to_csv(tsvgz_flpth, sep='\t', compression='gzip')
+
+        self.assertEqual(get_tsv_shape(tsvgz_flpth), (30, 7))
+        self.assertGreater(estimate_heatmap_mem(tsvgz_flpth), 30 * 7 * 8)
+
+        html_flpth = os.path.join(run_dir, 'heatmap_random.html')
+        render_heatmap('random', tsvgz_flpth, html_flpth, ('test', 'test'))
+        self.assertTrue(os.path.exists(html_flpth))
+
+
+
 ####################################################################################################
 ####################################################################################################
     def test_report(self):
@@ -0,0 +1,101 @@
+'''
+Benchmark writing the sequence abundance table from an AmpliconMatrix's nested-list values,
+vectorized (`to_float_array` + `write_tsv`) against the previous element-wise copy + `DataFrame.to_csv`,
+across matrix sizes, and check both write the same bytes
+
+Run from `test/` with `PYTHONPATH=../lib`, e.g.:
+
+    python seqabun_bench.py --sizes 1000x100 17770x511
+'''
+import os
+import sys
+import time
+import shutil
+import filecmp
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+from kb_PICRUSt2.util.validate import to_float_array
+from kb_PICRUSt2.util.file import write_tsv
+from kb_PICRUSt2.impl.config import Var
+
+
+
+####################################################################################################
+####################################################################################################
+def make_values(num_rows, num_cols, missing_frac=0.01, seed=0) -> list:
+    '''
+    Sparse-ish counts with some `None` and `''`, like workspace JSON
+    '''
+    rng = np.random.RandomState(seed)
+    a = rng.poisson(2, size=(num_rows, num_cols)) * rng.randint(0, 2, size=(num_rows, num_cols))
+    values = a.tolist()
+    for i, j in zip(*np.nonzero(rng.random_sample((num_rows, num_cols)) < missing_frac)):
+        values[i][j] = None if (i + j) % 2 else ''
+    return values
+
+
+####################################################################################################
+####################################################################################################
+def write_previous(values, row_ids, col_ids, flpth):
+    def copy_replace(nested: list, rep=None):
+        nested_ = []
+        for l in nested:
+            l_ = l.copy()
+            nested_.append(l_)
+            for i, e in enumerate(l_):
+                if e == '':
+                    l_[i] = None
+        return nested_
+
+    data = np.array(copy_replace(values), dtype=float)
+    data = pd.DataFrame(data, index=row_ids, columns=col_ids)
+    data.index.name = Var.amplicon_header_name
+    data.to_csv(flpth, sep='\t', float_format='%g')
+
+
+####################################################################################################
+####################################################################################################
+def write_vectorized(values, row_ids, col_ids, flpth):
+    data = to_float_array(values)
+    write_tsv(data, row_ids, col_ids, flpth, index_name=Var.amplicon_header_name, float_format='%g')
+
+
+####################################################################################################
+####################################################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', default=['100x10', '1000x100', '5000x300'])
+    parser.add_argument('--missing_frac', type=float, default=0.01)
+    args = parser.parse_args()
+
+    dir = tempfile.mkdtemp()
+    try:
+        for size in args.sizes:
+            num_rows, num_cols = [int(n) for n in size.split('x')]
+            values = make_values(num_rows, num_cols, missing_frac=args.missing_frac)
+            row_ids = ['amp%d' % i for i in range(num_rows)]
+            col_ids = ['sample%d' % i for i in range(num_cols)]
+
+            flpth_l = []
+            t_l = []
+            for name, write in [('previous', write_previous), ('vectorized', write_vectorized)]:
+                flpth = os.path.join(dir, '%s_%s.tsv' % (size, name))
+                t0 = time.time()
+                write(values, row_ids, col_ids, flpth)
+                t_l.append(time.time() - t0)
+                flpth_l.append(flpth)
+
+            print('%-12s previous %.2fs, vectorized %.2fs (%.1fx), %s' % (
+                size, t_l[0], t_l[1], t_l[0] / t_l[1],
+                'same bytes' if filecmp.cmp(*flpth_l, shallow=False) else 'DIFFER',
+            ))
+
+    finally:
+        shutil.rmtree(dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,27 @@
+import time
+import os
+import sys
+import json
+import signal
+import threading
+import subprocess
+import psutil
+import numpy as np
 from pytest import raises
 
 from kb_PICRUSt2.util.debug import dprint
-from kb_PICRUSt2.util.cli import run_check, NonZeroReturnException
-from kb_PICRUSt2.util.file import get_numbered_duplicate
+from kb_PICRUSt2.util.cli import run_check, NonZeroReturnException, LimitException
+from kb_PICRUSt2.util.file import get_numbered_duplicate, write_tsv, lock_dir
+from kb_PICRUSt2.util.validate import to_float_array
+from kb_PICRUSt2.util.jsonstream import loads_streamed
+from kb_PICRUSt2.util.dag import Stage, run_stages, DAGException
+from kb_PICRUSt2.util import resource
+from kb_PICRUSt2.util.checkpoint import Checkpoint
+from kb_PICRUSt2.util.cache import ResultCache
+from kb_PICRUSt2.util.fork import fork_map
+from kb_PICRUSt2.util.span import SpanRecorder
+from kb_PICRUSt2.util.sampler import collect_summaries
+from kb_PICRUSt2.util.background import IOPool
 from mock import *
 import config
 
@@ -17,6 +36,114 @@ def test_run_check():
     run_check('set -o pipefail && echo hi |& tee tmp') # run correctly
 
 
+def test_run_check_log(tmp_path):
+    log_flpth = str(tmp_path / 'log.txt')
+
+    run_check('echo out; echo err >&2; printf partial', log_flpth=log_flpth, tag='stage0')
+    run_check('echo again', log_flpth=log_flpth) # appended, untagged
+
+    with open(log_flpth) as fh:
+        line_l = fh.read().splitlines()
+    assert sorted(line_l[:3]) == ['[stage0] err', '[stage0] out', '[stage0] partial']
+    assert line_l[3] == 'again'
+
+    # last lines in error
+    with raises(NonZeroReturnException, match='(?s)`3`.*\nline 61\n.*\nline 100\n$') as e:
+        run_check('for i in $(seq 100); do echo line $i; done; exit 3', log_flpth=log_flpth, tag='stage1')
+    assert 'line 60\n' not in str(e.value)
+
+    with open(log_flpth) as fh:
+        assert fh.read().splitlines()[-1] == '[stage1] line 100'
+
+
+def _is_dead(pid):
+    time.sleep(0.1)
+    try:
+        return psutil.Process(pid).status() == psutil.STATUS_ZOMBIE # reparented, not yet reaped
+    except psutil.NoSuchProcess:
+        return True
+
+
+def test_run_check_limits(tmp_path):
+    pid_flpth = str(tmp_path / 'pid')
+
+    # timeout kills the whole group, including backgrounded grandchildren
+    t0 = time.time()
+    with raises(LimitException, match='`place_0`.*timeout limit of 1s') as e:
+        run_check('sleep 60 & echo $! > %s; wait' % pid_flpth, tag='place_0', timeout_s=1)
+    assert time.time() - t0 < 10
+    assert (e.value.tag, e.value.limit, e.value.value) == ('place_0', 'timeout', 1)
+    with open(pid_flpth) as fh:
+        pid = int(fh.read())
+    assert _is_dead(pid)
+
+    # memory
+    with raises(LimitException, match='memory limit of 0.10GB'):
+        run_check(
+            'python -c "import time; x = bytearray(300 * 1024**2); time.sleep(30)"',
+            max_mem_bytes=0.1 * 1024**3,
+        )
+
+    # orphans left running by a finished cmd are killed
+    run_check('(sleep 60 & echo $! > %s)' % pid_flpth, timeout_s=10)
+    with open(pid_flpth) as fh:
+        pid = int(fh.read())
+    assert _is_dead(pid)
+
+    run_check('true', timeout_s=10, max_mem_bytes=1024**3) # within limits
+
+
+def test_forward_signals(tmp_path):
+    pid_flpth = str(tmp_path / 'pid')
+    script = (
+        'import threading\n'
+        'from kb_PICRUSt2.util.cli import run_check, forward_signals\n'
+        'forward_signals()\n'
+        'th = threading.Thread(target=run_check, args=("sleep 60 & echo $! > %s; wait",))\n'
+        'th.start()\n'
+        'th.join()\n' % pid_flpth
+    )
+    proc = subprocess.Popen([sys.executable, '-c', script], env=dict(os.environ, PYTHONPATH=':'.join(sys.path)))
+
+    for _ in range(100):
+        if os.path.exists(pid_flpth) and os.path.getsize(pid_flpth):
+            break
+        time.sleep(0.1)
+    with open(pid_flpth) as fh:
+        pid = int(fh.read())
+
+    proc.send_signal(signal.SIGTERM)
+    assert proc.wait(timeout=10) == 128 + signal.SIGTERM
+    assert _is_dead(pid)
+
+
+def test_run_check_sampled(tmp_path):
+    sample_dir = str(tmp_path / 'samples')
+    os.makedirs(sample_dir)
+    flpth = os.path.join(sample_dir, 'alloc.json')
+
+    # ~200MB held for a few samples
+    run_check(
+        'python -c "import time; x = bytearray(200 * 1024**2); time.sleep(1)" && sleep 0.2',
+        sample_flpth=flpth,
+        sample_interval_s=0.1,
+    )
+
+    with open(flpth) as fh:
+        out = json.load(fh)
+
+    by_exe = out['summary']['by_exe']
+    exe = [exe for exe in by_exe if exe.startswith('python')][0]
+    assert by_exe[exe]['peak_rss_bytes'] > 200 * 1024**2
+    assert by_exe[exe]['num_procs'] == 1
+    assert len(out['series'][exe]) >= 5
+    assert out['summary']['peak_tree_rss_bytes'] >= by_exe[exe]['peak_rss_bytes']
+    assert out['summary']['cpu_s'] == round(sum(rec['cpu_s'] for rec in by_exe.values()), 2)
+
+    name_2_summary = collect_summaries(sample_dir, str(tmp_path / 'summary.json'))
+    assert list(name_2_summary) == ['alloc']
+
+
 def test_get_numbered_duplicate():
     # test numbering system
     q = 'the_attr'
@@ -41,3 +168,419 @@ def test_get_numbered_duplicate():
     assert get_numbered_duplicate(names, q) == q + ' (1)'
 
 
+
+def test_lock_dir(tmp_path):
+    fh = lock_dir(str(tmp_path))
+    assert fh is not None
+    assert lock_dir(str(tmp_path)) is None # held
+
+    fh.close()
+    fh = lock_dir(str(tmp_path))
+    assert fh is not None
+    fh.close()
+
+
+
+def test_to_float_array():
+    assert to_float_array([[1, 2.5], [0, 3]]).tolist() == [[1, 2.5], [0, 3]]
+
+    a = to_float_array([[1, None], ['', 'None'], [0, 3]])
+    assert a.dtype == float
+    assert np.isnan(a).tolist() == [[False, True], [True, True], [False, False]]
+    assert a[2].tolist() == [0, 3]
+
+
+def test_loads_streamed():
+    doc = dict(
+        version='1.1',
+        result=[dict(data=[dict(
+            info=[1, 'na\\me "q" ]}[ é'],
+            data=dict(
+                row_mapping={'values': 'x', 'a]': 'b'}, # not the path
+                data=dict(
+                    row_ids=['a', 'b', 'c'],
+                    values=[[1, None], [2.5, -0.], [1e3, 0]],
+                ),
+            ),
+        )])],
+    )
+    path = ('result', None, 'data', None, 'data', 'data', 'values')
+    text = json.dumps(doc, indent=1, ensure_ascii=False).encode()
+
+    for n in [1, 3, 64, len(text)]: # chunk boundaries anywhere, even mid-character
+        obj, a = loads_streamed([text[i:i + n] for i in range(0, len(text), n)], path, num_rows_hint=1)
+        assert a.shape == (3, 2)
+        assert np.isnan(a).tolist() == [[False, True], [False, False], [False, False]]
+        assert np.nan_to_num(a).tolist() == [[1, 0], [2.5, 0], [1000, 0]]
+
+        expected = json.loads(text)
+        expected['result'][0]['data'][0]['data']['data']['values'] = None
+        assert obj == expected
+
+    assert loads_streamed(['{"values": 3}'], ('values',)) == ({'values': 3}, None)
+    assert loads_streamed(['{"values": []}'], ('values',))[1].shape == (0, 0)
+
+    with raises(ValueError, match='different lengths'):
+        loads_streamed(['{"values": [[1], [1, 2]]}'], ('values',))
+    with raises(ValueError, match='Non-numeric'):
+        loads_streamed(['{"values": [["a"]]}'], ('values',))
+
+
+def test_write_tsv(tmp_path):
+    import pandas as pd
+
+    a = np.array([
+        [0, 1, 2.5],
+        [np.nan, np.nan, 1234567], # `%g` rounds
+        [np.nan, 3, np.nan],
+        [-0., 1e-7, 10],
+    ])
+    row_ids = ['amp0', 'amp\t1', 'amp"2"', 'amp3']
+    col_ids = ['s0', 's 1', 's2']
+
+    flpth = str(tmp_path / 'fast.tsv')
+    write_tsv(a, row_ids, col_ids, flpth, index_name='Amplicon_Id')
+
+    flpth_pd = str(tmp_path / 'pandas.tsv')
+    df = pd.DataFrame(a, index=pd.Index(row_ids, name='Amplicon_Id'), columns=col_ids)
+    df.to_csv(flpth_pd, sep='\t', float_format='%g')
+
+    with open(flpth) as fh, open(flpth_pd) as fh_pd:
+        assert fh.read() == fh_pd.read()
+
+    # empty
+    write_tsv(np.empty((0, 3)), [], col_ids, flpth)
+    with open(flpth) as fh:
+        assert fh.read() == '\ts0\ts 1\ts2\n'
+
+
+def test_run_stages():
+    import threading
+    lock = threading.Lock()
+    order = []
+    live = [0, 0] # current, max concurrent
+
+    def run(cmd):
+        with lock:
+            live[0] += 1
+            live[1] = max(live)
+        time.sleep(0.2)
+        with lock:
+            live[0] -= 1
+            order.append(cmd)
+
+    stage_l = [
+        Stage('a', 'a', ncores=2),
+        Stage('b', 'b', deps=['a'], ncores=2),
+        Stage('c', 'c', deps=['a'], ncores=2),
+        Stage('d', 'd', deps=['b', 'c'], ncores=2),
+    ]
+
+    # independent chains run concurrently within budget
+    # `on_done` hears of each as it finishes
+    done = []
+    run_stages(stage_l, run=run, max_cores=4, on_done=done.append)
+    assert order[0] == 'a' and order[-1] == 'd'
+    assert live[1] == 2
+    assert done[0] == 'a' and sorted(done[1:3]) == ['b', 'c'] and done[-1] == 'd' # b, c may finish together
+
+    # budget forces serial
+    order.clear(); live[1] = 0
+    run_stages(stage_l, run=run, max_cores=2)
+    assert live[1] == 1
+
+    # memory budget too
+    order.clear(); live[1] = 0
+    stage_l_mem = [Stage(s.name, s.cmd, s.deps, ncores=1, mem=10) for s in stage_l]
+    run_stages(stage_l_mem, run=run, max_cores=4, max_mem=15)
+    assert live[1] == 1
+
+    # failure propagates, dependents not launched
+    def run_fail(cmd):
+        order.append(cmd)
+        if cmd == 'b':
+            raise NonZeroReturnException(cmd)
+
+    order.clear()
+    with raises(NonZeroReturnException):
+        run_stages(stage_l, run=run_fail)
+    assert 'd' not in order
+
+    # bad graphs
+    with raises(DAGException):
+        run_stages([Stage('a', 'a', deps=['b']), Stage('b', 'b', deps=['a'])], run=run)
+    with raises(DAGException):
+        run_stages([Stage('a', 'a', deps=['z'])], run=run)
+
+
+def test_resource(tmp_path):
+    # cgroup v2
+    (tmp_path / 'cpu.max').write_text('250000 100000\n')
+    (tmp_path / 'memory.max').write_text('%d\n' % (8 * resource.GB))
+    (tmp_path / 'memory.current').write_text('%d\n' % (3 * resource.GB))
+    assert resource.get_cgroup_cpu_limit(str(tmp_path)) == 3
+    assert resource.get_cgroup_mem_avail(str(tmp_path)) == 5 * resource.GB
+
+    (tmp_path / 'cpu.max').write_text('max 100000\n')
+    (tmp_path / 'memory.max').write_text('max\n')
+    assert resource.get_cgroup_cpu_limit(str(tmp_path)) is None
+    assert resource.get_cgroup_mem_avail(str(tmp_path)) is None
+
+    # cgroup v1
+    v1 = tmp_path / 'v1'
+    (v1 / 'cpu').mkdir(parents=True)
+    (v1 / 'memory').mkdir()
+    (v1 / 'cpu/cpu.cfs_quota_us').write_text('-1\n')
+    (v1 / 'cpu/cpu.cfs_period_us').write_text('100000\n')
+    (v1 / 'memory/memory.limit_in_bytes').write_text('9223372036854771712\n')
+    assert resource.get_cgroup_cpu_limit(str(v1)) is None
+    assert resource.get_cgroup_mem_avail(str(v1)) is None
+
+    # meminfo
+    (tmp_path / 'meminfo').write_text('MemTotal: 100 kB\nMemAvailable: 50 kB\n')
+    assert resource.get_mem_avail(str(tmp_path / 'meminfo')) == 50 * 1024
+
+    assert resource.get_num_cores() >= 1
+
+
+def test_run_stages_checkpoint(tmp_path):
+    flpth = lambda name: str(tmp_path / name)
+    with open(flpth('input'), 'w') as fh: fh.write('v0')
+
+    # each stage copies its input to its output, unless told what to write
+    ran = []
+    out = {}
+    def run(cmd):
+        name = cmd.split()[0]
+        ran.append(name)
+        if name in fail:
+            raise NonZeroReturnException(cmd)
+        src, dst = {'a': ('input', 'a.out'), 'b': ('a.out', 'b.out'), 'c': ('b.out', 'c.out')}[name]
+        with open(flpth(src)) as fh: content = fh.read()
+        with open(flpth(dst), 'w') as fh: fh.write(out.get(name, content))
+
+    stage_l = [
+        Stage('a', 'a -p 4', inputs=[flpth('input')], key='a'),
+        Stage('b', 'b', deps=['a'], inputs=[flpth('a.out')]),
+        Stage('c', 'c', deps=['b'], inputs=[flpth('b.out')]),
+    ]
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'))
+
+    # fail at last stage
+    fail = ['c']
+    with raises(NonZeroReturnException):
+        run_stages(stage_l, run=run, checkpoint=checkpoint)
+    assert ran == ['a', 'b', 'c']
+
+    # resume at last stage
+    # skipped stages count as done
+    ran.clear(); fail = []
+    done = []
+    run_stages(stage_l, run=run, checkpoint=checkpoint, on_done=done.append)
+    assert ran == ['c']
+    assert done == ['a', 'b', 'c']
+
+    # all done
+    ran.clear()
+    run_stages(stage_l, run=run, checkpoint=checkpoint)
+    assert ran == []
+
+    # changed input reruns everything downstream
+    with open(flpth('input'), 'w') as fh: fh.write('v1')
+    run_stages(stage_l, run=run, checkpoint=checkpoint)
+    assert ran == ['a', 'b', 'c']
+
+    # stage rerun writing the same output doesn't rerun dependents
+    ran.clear()
+    checkpoint.clear('a')
+    run_stages(stage_l, run=run, checkpoint=checkpoint)
+    assert ran == ['a']
+
+    # but writing a different one does
+    ran.clear()
+    checkpoint.clear('a')
+    out['a'] = 'v2'
+    run_stages(stage_l, run=run, checkpoint=checkpoint)
+    assert ran == ['a', 'b', 'c']
+
+    # key stands in for cmd, e.g., thread counts don't matter
+    ran.clear()
+    stage_l[0] = Stage('a', 'a -p 8', inputs=[flpth('input')], key='a')
+    run_stages(stage_l, run=run, checkpoint=checkpoint)
+    assert ran == []
+
+    # dep rerun on changed inputs reruns dependents,
+    # even when their own inputs don't show what it wrote
+    stage_l = [
+        Stage('a', 'a', inputs=[flpth('input')]),
+        Stage('b', 'b', deps=['a'], inputs=[flpth('unrelated')]),
+    ]
+    with open(flpth('unrelated'), 'w') as fh: fh.write('')
+    run_stages(stage_l, run=run, checkpoint=checkpoint)
+    ran.clear()
+    run_stages(stage_l, run=run, checkpoint=checkpoint)
+    assert ran == []
+    with open(flpth('input'), 'w') as fh: fh.write('v3')
+    run_stages(stage_l, run=run, checkpoint=checkpoint)
+    assert ran == ['a', 'b']
+
+    # without inputs, stages rerun whenever deps do
+    ran.clear()
+    stage_l = [Stage('a', 'a', inputs=[flpth('input')]), Stage('b', 'b', deps=['a'])]
+    run_stages(stage_l, run=run, checkpoint=checkpoint)
+    ran.clear()
+    checkpoint.clear('a')
+    run_stages(stage_l, run=run, checkpoint=checkpoint)
+    assert ran == ['a', 'b']
+
+
+def test_ResultCache(tmp_path):
+    def make_dir(name, nbytes):
+        dir = tmp_path / name
+        dir.mkdir()
+        (dir / 'sub').mkdir()
+        (dir / 'sub' / 'f').write_bytes(b'x' * nbytes)
+        return str(dir)
+
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=250)
+    dst = str(tmp_path / 'dst')
+
+    assert cache.get('k0', dst) is False
+    cache.put('k0', make_dir('src0', 100))
+    assert cache.get('k0', dst) is True
+    assert open(os.path.join(dst, 'sub', 'f'), 'rb').read() == b'x' * 100
+
+    time.sleep(0.01)
+    cache.put('k1', make_dir('src1', 100))
+    time.sleep(0.01)
+    cache.get('k0', dst) # k0 now most recently used
+    time.sleep(0.01)
+    cache.put('k2', make_dir('src2', 100)) # over budget, evict LRU k1
+
+    assert cache.get('k1', dst) is False
+    assert cache.get('k0', dst) is True
+    assert cache.get('k2', dst) is True
+    assert (cache.hits, cache.misses, cache.evictions) == (4, 2, 1)
+
+    cache.put('k3', make_dir('src3', 1000)) # larger than whole cache
+    assert cache.get('k3', dst) is False
+
+    # eviction, e.g., by another batch process, waits for restores in progress
+    cache.max_bytes = 0
+    with cache._lock(exclusive=False):
+        thread = threading.Thread(target=cache.evict)
+        thread.start()
+        thread.join(0.2)
+        assert thread.is_alive()
+        assert os.path.isdir(os.path.join(str(tmp_path / 'cache'), 'k0'))
+    thread.join()
+    assert cache.get('k0', dst) is False
+
+
+def _square_or_fail(x):
+    if x < 0:
+        raise ValueError('negative %d' % x)
+    return x * x
+
+
+def test_fork_map():
+    assert fork_map(_square_or_fail, [3, 1, 2, 0], num_workers=2) == [9, 1, 4, 0]
+    assert fork_map(_square_or_fail, [], num_workers=2) == []
+
+    with raises(ValueError, match='negative'):
+        fork_map(_square_or_fail, [1, -1, 2], num_workers=3)
+
+    # from a thread, while others run
+    # with a builtin, since children from the fork server import `func`'s module afresh
+    res_l = []
+    thread_l = [
+        threading.Thread(target=lambda: res_l.append(
+            fork_map(abs, [-4, 5], num_workers=2, start_method='forkserver')))
+        for _ in range(2)
+    ]
+    for thread in thread_l:
+        thread.start()
+    for thread in thread_l:
+        thread.join()
+    assert res_l == [[4, 5], [4, 5]]
+
+
+def test_SpanRecorder(tmp_path):
+    spans = SpanRecorder()
+
+    # a concurrent span's CPU isn't counted
+    def spin():
+        with spans.span('concurrent'):
+            t0 = time.time()
+            while time.time() - t0 < 0.5:
+                pass
+    thread = threading.Thread(target=spin)
+    thread.start()
+
+    with spans.span('outer'):
+        with spans.span('inner'):
+            sum(range(10**6))
+            time.sleep(0.5)
+        with raises(ZeroDivisionError):
+            with spans.span('fail'):
+                1 / 0
+    thread.join()
+
+    rec_l = spans.to_list()
+    name2rec = {rec['name']: rec for rec in rec_l}
+
+    assert [rec['name'] for rec in rec_l if rec['name'] != 'concurrent'][0] == 'outer'
+    assert name2rec['outer']['parent'] is None
+    assert name2rec['inner']['parent'] == 'outer'
+    assert name2rec['inner']['ok'] is True
+    assert name2rec['fail']['ok'] is False
+    assert name2rec['concurrent']['cpu_s'] > 0.3
+    assert 0 < name2rec['inner']['cpu_s'] < 0.3
+    assert name2rec['outer']['wall_s'] >= name2rec['inner']['wall_s']
+
+    assert spans.wrap('wrapped', lambda x: x + 1)(1) == 2
+    assert 'wrapped' in [rec['name'] for rec in spans.to_list()]
+
+    flpth = str(tmp_path / 'timings.json')
+    spans.write(flpth)
+    with open(flpth) as fh:
+        assert len(json.load(fh)['spans']) == 5
+
+
+def test_IOPool():
+    spans = SpanRecorder()
+    event = threading.Event()
+
+    with IOPool(max_workers=2, spans=spans) as io_pool:
+        io_pool.submit('first', lambda: event.wait(5) and 1)
+        io_pool.submit('second', lambda: io_pool.result('first') + 1) # blocks on earlier call
+
+        event.set() # caller kept going while `first` waited
+        assert io_pool.wait() == {'first': 1, 'second': 2}
+        assert io_pool.result('second') == 2
+
+        with raises(ValueError, match='already submitted'):
+            io_pool.submit('first', lambda: None)
+
+    assert sorted(rec['name'] for rec in spans.to_list()) == ['first', 'second']
+
+    # retried
+    tries = []
+    def flaky():
+        tries.append(1)
+        if len(tries) < 3:
+            raise ConnectionError('flaky')
+        return len(tries)
+
+    with IOPool() as io_pool:
+        assert io_pool.submit('flaky', flaky, num_retries=2, retry_delay_s=0.01).result() == 3
+        tries.clear()
+        with raises(ConnectionError):
+            io_pool.submit('flaky_again', flaky, num_retries=1, retry_delay_s=0.01).result()
+
+    io_pool = IOPool()
+    io_pool.submit('ok', lambda: 1)
+    io_pool.submit('fail', lambda: 1 / 0)
+    with raises(ZeroDivisionError):
+        io_pool.wait()
+    io_pool.shutdown()